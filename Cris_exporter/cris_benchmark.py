@@ -0,0 +1,149 @@
+import argparse
+import multiprocessing
+import resource
+import time
+import tracemalloc
+from os import path
+
+import pymongo as pm
+
+from cris_stub_server import CrisStubServer
+from graphql_exporter import GraphqlExporter
+from graphql_list_exporter import GraphqlListExporter
+from graphql_connenction_exporter import GraphqlConnectionExporter
+from graphql_organisation_hierarchy_exporter import GraphqlOrganisationHierarchyExporter
+from rate_limiter import AdaptiveRateLimiter
+
+QUERIES_FOLDER = path.join(path.dirname(path.realpath(__file__)), 'queries')
+
+BENCHMARKS = [
+    (GraphqlListExporter, 'get_publications.graphql', 'publication'),
+    (GraphqlListExporter, 'get_persons.graphql', 'person'),
+    (GraphqlListExporter, 'get_organisations.graphql', 'organisation'),
+    (GraphqlConnectionExporter, 'get_connection_person_publication.graphql', 'person_publications'),
+    (GraphqlOrganisationHierarchyExporter, 'get_organisations_hierarchy.graphql', 'organisation_organisation'),
+]
+
+
+def serve(server_arguments: dict, ports: multiprocessing.Queue, requests):
+    """
+    Run the stand-in server in a child process, so it does not distort the measurements of the exporters.
+    :param server_arguments: keyword arguments of CrisStubServer
+    :param ports: queue to report the port of the server
+    :param requests: shared counter of the requests answered by the server
+    :return: None
+    """
+    server = CrisStubServer(**server_arguments)
+    handle = server.handle
+
+    async def count_requests(request):
+        with requests.get_lock():
+            requests.value += 1
+        return await handle(request)
+
+    server.handle = count_requests
+    server.start()
+    ports.put(server.port)
+    server.thread.join()
+
+
+def run_benchmark(exporter_class, query_template: str, db_collection: str, requests, trace_memory: bool = False):
+    """
+    Run one exporter and measure it.
+    :param exporter_class: exporter class to benchmark
+    :param query_template: file name of the query template
+    :param db_collection: collection written by the exporter
+    :param requests: shared counter of the requests answered by the server
+    :param trace_memory: measure the peak Python heap of the export with tracemalloc, which slows the export down.
+                         Otherwise the peak resident memory of the whole process so far is reported, which includes
+                         the exports benchmarked before.
+    :return: measurements, pages counts the results CRIS returned and requests every request the server answered,
+             including retries
+    """
+    requests_before = requests.value
+    if trace_memory:
+        tracemalloc.start()
+    started = time.perf_counter()
+    exporter = exporter_class(path.join(QUERIES_FOLDER, query_template))
+    exporter.export()
+    wall_time = time.perf_counter() - started
+    if trace_memory:
+        _, peak_memory = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    else:
+        peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    mongodb_instance = pm.MongoClient(GraphqlExporter.MONGODB_URI)
+    documents = mongodb_instance[GraphqlExporter.DATABASE][db_collection].count_documents({})
+    mongodb_instance.close()
+    metrics = exporter.metrics.summary()
+    pages = metrics['pages']
+    return {
+        'template': query_template,
+        'pages': pages,
+        'requests': requests.value - requests_before,
+        'documents': documents,
+        'seconds': wall_time,
+        'pages_per_second': pages / wall_time,
+        'documents_per_second': documents / wall_time,
+        'peak_memory_mb': peak_memory / 1024 / 1024,
+        'p90_latency_ms': (metrics['latency_seconds']['p90'] or 0) * 1000,
+        'mongo_write_seconds': metrics['mongo_write_seconds'],
+    }
+
+
+def print_report(results: list, trace_memory: bool = False):
+    """
+    Print the measurements as a table.
+    :param results: measurements of run_benchmark
+    :param trace_memory: the measurements hold the peak Python heap of each export instead of the process peak
+    :return: None
+    """
+    print("{:<45} {:>8} {:>8} {:>10} {:>9} {:>9} {:>10} {:>9} {:>9} {:>12}".format(
+        'template', 'pages', 'requests', 'documents', 'seconds', 'pages/s', 'docs/s', 'p90 ms', 'write s',
+        'heap peak MB' if trace_memory else 'proc peak MB'))
+    for result in results:
+        print("{template:<45} {pages:>8} {requests:>8} {documents:>10} {seconds:>9.2f} {pages_per_second:>9.1f} "
+              "{documents_per_second:>10.1f} {p90_latency_ms:>9.1f} {mongo_write_seconds:>9.2f} "
+              "{peak_memory_mb:>12.1f}".format(**result))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the exporters against the local CRIS stand-in server.')
+    parser.add_argument('--list-size', type=int, default=5000, help='number of publications and persons')
+    parser.add_argument('--organisations', type=int, default=500, help='number of organisations')
+    parser.add_argument('--max-connections', type=int, default=12, help='highest number of connections per object')
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds every request is delayed')
+    parser.add_argument('--database', default='FLK_Benchmark', help='MongoDB database the exporters write to')
+    parser.add_argument('--requests-per-second', type=float, default=None,
+                        help='start and upper rate of the rate limiter, defaults to the configured rate limiter')
+    parser.add_argument('--trace-memory', action='store_true',
+                        help='report the peak Python heap per export (slower) instead of the peak resident memory '
+                             'of the process')
+    arguments = parser.parse_args()
+
+    server_arguments = {
+        'list_sizes': {'publication': arguments.list_size, 'person': arguments.list_size,
+                       'organisation': arguments.organisations},
+        'max_connections': arguments.max_connections,
+        'latency': arguments.latency,
+    }
+    ports = multiprocessing.Queue()
+    request_counter = multiprocessing.Value('i', 0)
+    server_process = multiprocessing.Process(target=serve, args=(server_arguments, ports, request_counter),
+                                             daemon=True)
+    server_process.start()
+
+    GraphqlExporter.GRAPHQL_URL = 'http://127.0.0.1:{}/'.format(ports.get())
+    GraphqlExporter.DATABASE = arguments.database
+    if arguments.requests_per_second:
+        GraphqlExporter.RATE_LIMITER = AdaptiveRateLimiter(rate=arguments.requests_per_second,
+                                                           max_rate=arguments.requests_per_second)
+    print("Benchmark against " + GraphqlExporter.GRAPHQL_URL + " writing to " + GraphqlExporter.DATABASE +
+          " (connection concurrency " + str(GraphqlConnectionExporter.CONCURRENCY) +
+          ", batch size " + str(GraphqlConnectionExporter.BATCH_SIZE) + ")")
+    benchmark_results = [run_benchmark(exporter_class, query_template, db_collection, request_counter,
+                                       arguments.trace_memory)
+                         for exporter_class, query_template, db_collection in BENCHMARKS]
+    server_process.terminate()
+    print_report(benchmark_results, arguments.trace_memory)
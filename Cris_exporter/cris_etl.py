@@ -1,6 +1,15 @@
+import os
+
 from cris_exporter import CrisExporter
 
 exporter = CrisExporter()
-exporter.export_connections()
-exporter.export_lists()
-exporter.export_organisation_hierarchy()
+mode = os.getenv("CRISETL_MODE", 'export').lower()
+if mode == 'rebuild':
+    exporter.rebuild_all(os.getenv("CRISETL_REBUILD_DATE"))
+elif mode == 'connection-worker':
+    # a worker only joins the connection exports of the run of the main export
+    if not os.getenv("CRISETL_RUN_ID"):
+        raise ValueError("Set CRISETL_RUN_ID to the run id of the main export to work on its connections")
+    exporter.work_on_connections()
+else:
+    exporter.export_all()
@@ -1,11 +1,15 @@
 import pathlib
 import os
+import time
 from os import path
 
 
 from graphql_list_exporter import GraphqlListExporter
 from graphql_connenction_exporter import GraphqlConnectionExporter
 from graphql_organisation_hierarchy_exporter import GraphqlOrganisationHierarchyExporter
+from export_scheduler import ExportScheduler
+from graphql_exporter import GraphqlExporter
+from page_archive import PageArchive
 
 
 GRAPHQL_TO_REGEX = "([A-Za-z].+)\(first:"  # Example https://regex101.com/r/JMTXsT/1
@@ -32,6 +36,38 @@ class CrisExporter:
 
     """
 
+    def export_all(self, max_parallel_exports: int = None, concurrency: int = None, batch_size: int = None):
+        """
+        Export lists, connections and the organisation hierarchy in dependency order,
+        running independent exports concurrently.
+        :param max_parallel_exports: number of exports that may run at the same time
+        :param concurrency: number of requests each connection export sends at the same time,
+                            defaults to CRISETL_CONNECTION_CONCURRENCY
+        :param batch_size: number of ids combined into one request, defaults to CRISETL_CONNECTION_BATCH_SIZE
+        :return:
+        """
+        ExportScheduler(max_parallel_exports=max_parallel_exports, concurrency=concurrency,
+                        batch_size=batch_size).run()
+
+    def rebuild_all(self, snapshot_date: str = None, archive_folder: os.PathLike = None):
+        """
+        Rebuild the Data Lake from the archived pages of an earlier export, without requests to CRIS.
+        Every collection is replaced by the segments of the latest export of its query template on the given date.
+        :param snapshot_date: date partition of the archive, e.g. 2023-01-31, defaults to the latest partition
+        :param archive_folder: folder of the archive, defaults to CRISETL_ARCHIVE_FOLDER
+        :return:
+        """
+        archive_folder = archive_folder if archive_folder else GraphqlExporter.ARCHIVE_FOLDER
+        if not archive_folder:
+            raise ValueError("Set CRISETL_ARCHIVE_FOLDER to the archive to rebuild from")
+        snapshots = PageArchive.segments(archive_folder, snapshot_date)
+        for task in ExportScheduler().tasks:
+            template_name = path.splitext(task.name)[0]
+            if template_name not in snapshots:
+                print("No snapshot of " + template_name + ", keep collection " + task.produces)
+                continue
+            task.rebuild(snapshots[template_name])
+
     def export_lists(self):
         """
         Export the data via the lists.
@@ -47,22 +83,50 @@ class CrisExporter:
 
             exporter = GraphqlListExporter(query_template)
             exporter.export()
+            exporter.save_metrics()
 
-    def export_connections(self):
+    def export_connections(self, concurrency: int = None, batch_size: int = None):
         """
-        Export the data via the connections.
+        Export the data via the connections. Connections of organisations are exported first, because scoped
+        exports of person connections read the members of the organisations from organisation_persons.
+        :param concurrency: number of requests sent at the same time, defaults to CRISETL_CONNECTION_CONCURRENCY
+        :param batch_size: number of ids combined into one request, defaults to CRISETL_CONNECTION_BATCH_SIZE
         :return:
         """
         dir_path = path.dirname(path.realpath(__file__))
         graphql_queries_folder = os.path.join(dir_path, 'queries')
 
-        for query_template in pathlib.Path(graphql_queries_folder).glob('**/*'):
+        query_templates = sorted(pathlib.Path(graphql_queries_folder).glob('**/*'),
+                                 key=lambda query_template: "get_connection_organisation_" not in query_template.name)
+        for query_template in query_templates:
             filename = query_template.name
             if "get_" not in filename or "connection" not in filename:
                 continue
 
-            exporter = GraphqlConnectionExporter(query_template)
+            exporter = GraphqlConnectionExporter(query_template, concurrency, batch_size)
             exporter.export()
+            exporter.save_metrics()
+
+    def work_on_connections(self, poll_interval: float = 30):
+        """
+        Help the main export with the connections by leasing shards of ids, e.g. in additional worker containers.
+        The main export seeds the shards of each connection once its source list is exported. The worker polls
+        until the connection exports of the run (CRISETL_RUN_ID, shared with the main export) are finalised.
+        :param poll_interval: seconds between two rounds over the connection exports
+        :return:
+        """
+        dir_path = path.dirname(path.realpath(__file__))
+        graphql_queries_folder = os.path.join(dir_path, 'queries')
+        query_templates = sorted(pathlib.Path(graphql_queries_folder).glob('**/*'))
+        pending_templates = [query_template for query_template in query_templates
+                             if "get_" in query_template.name and "connection" in query_template.name]
+        while pending_templates:
+            for query_template in list(pending_templates):
+                exporter = GraphqlConnectionExporter(query_template, leases=True)
+                if exporter.join_export():
+                    pending_templates.remove(query_template)
+            if pending_templates:
+                time.sleep(poll_interval)
 
     def export_organisation_hierarchy(self):
         """
@@ -77,4 +141,5 @@ class CrisExporter:
             if "organisations_hierarchy" not in filename:
                 continue
             exporter = GraphqlOrganisationHierarchyExporter(query_template)
-            exporter.export()
\ No newline at end of file
+            exporter.export()
+            exporter.save_metrics()
\ No newline at end of file
@@ -0,0 +1,220 @@
+import argparse
+import asyncio
+import threading
+import zlib
+from os import path
+
+from aiohttp import web
+from graphql import (build_schema, graphql, get_named_type, is_enum_type, is_list_type, is_non_null_type,
+                     is_object_type, is_scalar_type)
+
+SCHEMA_LOCATION = path.join(path.dirname(path.realpath(__file__)), 'queries', 'schema.graphql')
+
+
+class CrisStubServer:
+    """
+    Local stand-in for the CRIS GraphQL API, used to test and benchmark the exporters without network access.
+    It serves queries/schema.graphql with synthetic, deterministic data:
+    - every xyzList returns list_sizes['xyz'] (or default_list_size) nodes, paginated with first/after
+    - every connection of an object returns between 0 and max_connections nodes of the target list
+    - organisation n has the child organisations 2n+1 and 2n+2
+    Every request is answered after `latency` seconds.
+    """
+
+    def __init__(self, list_sizes: dict = None, default_list_size: int = 250, max_connections: int = 12,
+                 latency: float = 0.0, host: str = '127.0.0.1', port: int = 0,
+                 schema_location: str = SCHEMA_LOCATION):
+        """
+        Prepare the server.
+        :param list_sizes: number of nodes per list, e.g. {'publication': 10000}
+        :param default_list_size: number of nodes of the lists that are not in list_sizes
+        :param max_connections: highest number of connections of one object
+        :param latency: seconds every request is delayed
+        :param host: host to listen on
+        :param port: port to listen on, 0 picks a free port
+        :param schema_location: path to the GraphQL schema
+        """
+        with open(schema_location, 'r') as schema_file:
+            self.schema = build_schema(schema_file.read())
+        self.list_sizes = list_sizes or {}
+        self.default_list_size = default_list_size
+        self.max_connections = max_connections
+        self.latency = latency
+        self.host = host
+        self.port = port
+        self.requests = 0
+        self.loop = None
+        self.runner = None
+        self.thread = None
+        self.started = threading.Event()
+
+    @property
+    def url(self):
+        """
+        :return: url of the GraphQL endpoint
+        """
+        return 'http://{}:{}/'.format(self.host, self.port)
+
+    def list_size(self, object_type: str):
+        """
+        :param object_type: name of the list without the List suffix, e.g. publication
+        :return: number of nodes of the list
+        """
+        return self.list_sizes.get(object_type, self.default_list_size)
+
+    def start(self):
+        """
+        Start the server on a background thread.
+        :return: the server
+        """
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        self.started.wait()
+        return self
+
+    def stop(self):
+        """
+        Stop the server started by start.
+        :return: None
+        """
+        asyncio.run_coroutine_threadsafe(self.runner.cleanup(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+    def serve_forever(self):
+        """
+        Run the server on a new event loop until the loop is stopped.
+        :return: None
+        """
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        app = web.Application()
+        app.router.add_post('/', self.handle)
+        self.runner = web.AppRunner(app)
+        self.loop.run_until_complete(self.runner.setup())
+        site = web.TCPSite(self.runner, self.host, self.port)
+        self.loop.run_until_complete(site.start())
+        self.port = self.runner.addresses[0][1]
+        self.started.set()
+        self.loop.run_forever()
+
+    async def handle(self, request):
+        """
+        Answer a GraphQL request.
+        :param request: POST request with query, variables and operationName
+        :return: GraphQL response
+        """
+        self.requests += 1
+        payload = await request.json()
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        result = await graphql(self.schema, payload['query'], variable_values=payload.get('variables'),
+                               operation_name=payload.get('operationName'), field_resolver=self.resolve)
+        response = {'data': result.data}
+        if result.errors:
+            response['errors'] = [error.formatted for error in result.errors]
+        return web.json_response(response)
+
+    def resolve(self, source, info, **args):
+        """
+        Resolve any field of the schema. Objects are dicts that know the kind and id of the CRIS object they
+        belong to, scalars are derived from that id and the field name.
+        """
+        name = info.field_name
+        named_type = get_named_type(info.return_type)
+        if source is None:
+            if name.endswith('List'):
+                return self.list_page(name[:-4], args)
+            return {'__kind': name, '__id': str(args['id'])}
+        if name in source:
+            return source[name]
+        if name == 'connections':
+            return dict(source)
+        if is_object_type(named_type) and 'edges' in named_type.fields:
+            return self.connection_page(source, name, args)
+        if name == 'node':
+            return {'__kind': source['__kind'], '__id': source['__id']}
+        return self.synthetic_value(source, name, info.return_type)
+
+    def list_page(self, object_type: str, args: dict):
+        """
+        Create one page of a list.
+        :param object_type: name of the list without the List suffix
+        :param args: arguments of the list field
+        :return: list wrapper
+        """
+        first = args.get('first', 10)
+        offset = int(args.get('after') or 0)
+        size = self.list_size(object_type)
+        end = min(offset + first, size)
+        items = [{'cursor': str(index + 1), 'node': {'__kind': object_type, '__id': str(index)}}
+                 for index in range(offset, end)]
+        return {'list': items, 'totalCount': size,
+                'pageInfo': {'startCursor': str(offset), 'endCursor': str(end), 'hasNextPage': end < size,
+                             'hasPreviousPage': offset > 0}}
+
+    def connection_page(self, source: dict, name: str, args: dict):
+        """
+        Create one page of the connections of an object.
+        :param source: object the connections belong to
+        :param name: name of the connection field, e.g. publications
+        :param args: arguments of the connection field
+        :return: connection
+        """
+        from_kind = source['__kind']
+        from_id = int(source['__id'])
+        if from_kind == 'organisation' and name == 'organisations':
+            size = self.list_size('organisation')
+            children = [child for child in (2 * from_id + 1, 2 * from_id + 2) if child < size]
+            return {'edges': [{'node': {'__kind': 'organisation', '__id': str(child)}} for child in children]}
+        to_kind = name[:-1]
+        count = zlib.crc32('{}-{}-{}'.format(from_kind, from_id, name).encode()) % (self.max_connections + 1)
+        first = args.get('first', 10)
+        offset = int(args.get('after') or 0)
+        end = min(offset + first, count)
+        to_size = max(self.list_size(to_kind), 1)
+        edges = [{'cursor': str(index + 1), 'node': {'__kind': to_kind, '__id': str((from_id * 7919 + index) % to_size)}}
+                 for index in range(offset, end)]
+        return {'edges': edges, 'totalCount': count,
+                'pageInfo': {'startCursor': str(offset), 'endCursor': str(end), 'hasNextPage': end < count,
+                             'hasPreviousPage': offset > 0}}
+
+    def synthetic_value(self, source: dict, name: str, return_type):
+        """
+        Create the value of a field that is neither a list nor a connection.
+        :param source: object the field belongs to
+        :param name: name of the field
+        :param return_type: GraphQL type of the field
+        :return: value of the field
+        """
+        if is_non_null_type(return_type):
+            return_type = return_type.of_type
+        if is_list_type(return_type):
+            return [self.synthetic_value(source, name, return_type.of_type)]
+        if name == 'id':
+            return source['__id']
+        if is_enum_type(return_type):
+            return list(return_type.values)[0]
+        if is_scalar_type(return_type):
+            if return_type.name == 'Int':
+                return len(source['__id']) + len(name)
+            if return_type.name == 'Float':
+                return float(len(name))
+            if return_type.name == 'Boolean':
+                return False
+            return '{} {}'.format(name, source['__id'])
+        return {'__kind': name, '__id': source['__id']}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve synthetic CRIS data for local exporter runs.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=4000)
+    parser.add_argument('--list-size', type=int, default=250, help='number of nodes of every list')
+    parser.add_argument('--max-connections', type=int, default=12, help='highest number of connections per object')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds every request is delayed')
+    arguments = parser.parse_args()
+    server = CrisStubServer(default_list_size=arguments.list_size, max_connections=arguments.max_connections,
+                            latency=arguments.latency, host=arguments.host, port=arguments.port)
+    print("Serving synthetic CRIS data on " + server.url)
+    server.serve_forever()
@@ -1,11 +1,59 @@
+import asyncio
+import importlib
 import pathlib
+import sys
+import tempfile
+import time
 import unittest
 import re
 import pymongo as pm
 
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
 from os import path, getenv
+from unittest import mock
+from aiohttp import ClientResponseError
 from gql import gql, Client
 from gql.transport.aiohttp import AIOHTTPTransport
+from gql.transport.exceptions import TransportQueryError, TransportServerError
+from graphql import parse, validate
+from pymongo.errors import BulkWriteError, DuplicateKeyError, ServerSelectionTimeoutError
+from cris_exporter import CrisExporter
+from cris_stub_server import CrisStubServer
+from delta_export import DeltaExport
+from export_errors import FatalExportError, RetryableExportError, classify_error
+from export_metrics import RUN_ID
+from export_scheduler import ExportScheduler
+from graphql_connenction_exporter import GraphqlConnectionExporter
+from graphql_exporter import GraphqlExporter
+from graphql_list_exporter import GraphqlListExporter
+from graphql_organisation_hierarchy_exporter import GraphqlOrganisationHierarchyExporter
+from mongo_page_writer import MongoPageWriter
+from page_sizer import AdaptivePageSizer
+from query_compiler import QueryCompiler
+from rate_limiter import AdaptiveRateLimiter
+
+QUERIES_FOLDER = path.join(path.dirname(path.realpath(__file__)), 'queries')
+WEB_PIPELINE_FOLDER = path.join(path.dirname(path.dirname(path.realpath(__file__))), 'web_pipeline')
+SHARED_FOLDER = path.join(path.dirname(path.dirname(path.realpath(__file__))), 'shared')
+
+
+def import_pipeline_module(test_case: unittest.TestCase, module_name: str):
+    """
+    Import a module of the web_pipeline or of the shared modules of the pipelines, which are checked out next to the
+    exporter.
+    :param test_case: test that is skipped if the module is missing
+    :param module_name: name of the module, e.g. web_export
+    :return: module
+    """
+    folders = [WEB_PIPELINE_FOLDER, SHARED_FOLDER]
+    if not any(path.exists(path.join(folder, module_name + '.py')) for folder in folders):
+        test_case.skipTest("The module " + module_name + " of the pipelines is not checked out next to the exporter")
+    for folder in folders:
+        if folder not in sys.path:
+            sys.path.append(folder)
+    return importlib.import_module(module_name)
+
 
 class CrisExporterTest(unittest.TestCase):
     MONGODB_URI = getenv("CRISETL_ENV_MONGO_URI", 'mongodb://localhost:27017/')
@@ -86,6 +134,22 @@ class CrisExporterTest(unittest.TestCase):
 
             assert "The Filename " + query_template.stem + " does not follow naming convention."
 
+    def test_profile_manifests(self):
+        """
+        Test if the templates compiled with every export profile are valid queries that can still be paginated.
+        """
+        dir_path = path.dirname(path.realpath(__file__))
+        graphql_queries_folder = path.join(dir_path, 'queries')
+        for profile in pathlib.Path(dir_path, 'profiles').glob('*.json'):
+            compiler = QueryCompiler.from_profile(profile.stem)
+            for query_template in pathlib.Path(graphql_queries_folder).glob('get_*.graphql'):
+                with open(query_template, 'r') as query_file:
+                    template = query_file.read()
+                query = compiler.compile(template)
+                gql(query)
+                if query != template:
+                    assert 'after: $after' in query, f"The compiled {query_template.name} cannot be paginated."
+
     def gql_object_type_exists(self, gql_object_type, schema_path):
         """
         Check if the gql_object_type exists in the schema.
@@ -98,5 +162,1040 @@ class CrisExporterTest(unittest.TestCase):
             schema = schema_file.read()
         assert re.search(regex, schema), f"The object type {gql_object_type} does not exist in the schema."
 
+
+class CrisStubServerTest(unittest.TestCase):
+    PUBLICATION_QUERY = """
+        query {
+            publicationList(first: 100, after: "250") {
+                pageInfo {
+                    endCursor
+                    hasNextPage
+                }
+                list {
+                    node {
+                        id
+                        cfTitle
+                    }
+                }
+            }
+        }"""
+    CONNECTION_QUERY = """
+        query {
+            person(id: "7") {
+                connections {
+                    publications(first: 100, after: "") {
+                        pageInfo {
+                            hasNextPage
+                        }
+                        edges {
+                            node {
+                                id
+                            }
+                        }
+                    }
+                }
+            }
+        }"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = CrisStubServer(list_sizes={'publication': 300}, max_connections=5).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+    def execute(self, query):
+        schema_path = path.join(path.dirname(path.realpath(__file__)), 'queries', 'schema.graphql')
+        with open(schema_path, 'r') as schema_file:
+            schema = schema_file.read()
+        client = Client(transport=AIOHTTPTransport(self.server.url), schema=schema, execute_timeout=400)
+        return client.execute(document=gql(query))
+
+    def test_list_pagination(self):
+        """
+        Test that the stand-in server paginates lists.
+        """
+        result = self.execute(self.PUBLICATION_QUERY)['publicationList']
+        assert [element['node']['id'] for element in result['list']] == [str(i) for i in range(250, 300)]
+        assert result['pageInfo'] == {'endCursor': '300', 'hasNextPage': False}
+
+    def test_connections(self):
+        """
+        Test that the stand-in server returns at most max_connections connections of existing publications.
+        """
+        edges = self.execute(self.CONNECTION_QUERY)['person']['connections']['publications']['edges']
+        assert len(edges) <= 5
+        assert all(0 <= int(edge['node']['id']) < 300 for edge in edges)
+
+
+class ExportErrorTest(unittest.TestCase):
+
+    def test_server_errors(self):
+        """
+        Test that throttling and gateway errors are retried and other HTTP errors are fatal.
+        """
+        throttled = TransportServerError('429, message=Too Many Requests', 429)
+        throttled.__cause__ = ClientResponseError(None, (), status=429, headers={'Retry-After': '7'})
+        export_error = classify_error(throttled)
+        assert isinstance(export_error, RetryableExportError)
+        assert export_error.throttled and export_error.retry_after == 7.0
+
+        export_error = classify_error(TransportServerError('502, message=Bad Gateway', 502))
+        assert isinstance(export_error, RetryableExportError)
+        assert not export_error.throttled and export_error.retry_after is None
+
+        assert isinstance(classify_error(TransportServerError('400, message=Bad Request', 400)), FatalExportError)
+
+    def test_retry_after_date(self):
+        """
+        Test that a Retry-After header with an HTTP date is turned into the seconds to wait.
+        """
+        throttled = TransportServerError('503, message=Service Unavailable', 503)
+        retry_at = datetime.now(timezone.utc) + timedelta(seconds=60)
+        throttled.__cause__ = ClientResponseError(None, (), status=503,
+                                                  headers={'Retry-After': format_datetime(retry_at, usegmt=True)})
+        export_error = classify_error(throttled)
+        assert export_error.throttled and 50 < export_error.retry_after <= 60
+
+    def test_other_errors(self):
+        """
+        Test that timeouts and dropped connections are retried, query errors are fatal and export errors are kept.
+        """
+        assert isinstance(classify_error(asyncio.TimeoutError()), RetryableExportError)
+        assert isinstance(classify_error(ConnectionResetError()), RetryableExportError)
+        assert isinstance(classify_error(TransportQueryError('Cannot query field')), FatalExportError)
+        export_error = FatalExportError('invalid query')
+        assert classify_error(export_error) is export_error
+
+
+class AdaptiveRateLimiterTest(unittest.TestCase):
+
+    def test_rate_bounds(self):
+        """
+        Test that the rate grows after fast requests, drops after slow or failed ones and stays within its bounds.
+        """
+        limiter = AdaptiveRateLimiter(rate=100, min_rate=1, max_rate=6, increase_step=0.5, decrease_factor=0.5)
+        assert limiter.rate == 6
+        limiter.record_success(10.0)
+        assert limiter.rate == 3
+        for _ in range(10):
+            limiter.record_success(0.1)
+        assert limiter.rate == 6
+        for _ in range(10):
+            limiter.record_failure()
+        assert limiter.rate == 1
+
+    def test_retry_after_pauses_requests(self):
+        """
+        Test that a Retry-After hint pauses the next request.
+        """
+        limiter = AdaptiveRateLimiter(rate=50, max_rate=50)
+        limiter.record_failure(retry_after=0.3)
+        started = time.monotonic()
+        asyncio.run(limiter.acquire())
+        assert time.monotonic() - started >= 0.25
+
+    def test_pacing(self):
+        """
+        Test that requests are paced to the rate once the burst is used up.
+        """
+        limiter = AdaptiveRateLimiter(rate=20, max_rate=20, burst=1)
+
+        async def acquire_all():
+            for _ in range(6):
+                await limiter.acquire()
+
+        started = time.monotonic()
+        asyncio.run(acquire_all())
+        assert time.monotonic() - started >= 5 / 20 * 0.8
+
+
+class AdaptivePageSizerTest(unittest.TestCase):
+
+    def test_bounds(self):
+        """
+        Test that the page size grows after fast and small pages, shrinks after slow, large or failed pages and stays
+        within its bounds.
+        """
+        sizer = AdaptivePageSizer(500, min_page_size=10, max_page_size=100, target_latency=5.0,
+                                  max_page_bytes=1024 * 1024)
+        assert sizer.page_size == 100
+        for _ in range(10):
+            sizer.record_failure()
+        assert sizer.page_size == 10
+        for _ in range(30):
+            sizer.record_page(0.1, 1024)
+        assert sizer.page_size == 100
+        assert sizer.record_page(10.0, 1024) == 50
+        assert sizer.record_page(0.1, 2 * 1024 * 1024) == 25
+        assert sizer.record_page(3.0, 1024) == 25
+        assert AdaptivePageSizer(5, min_page_size=0).page_size == 5
+
+    def test_template_pagination(self):
+        """
+        Test that only the pagination of the template is resized and adjusts the page size, other queries of the
+        exporter are sent as they are.
+        """
+        server = CrisStubServer(list_sizes={'person': 300, 'publication': 200}, max_connections=12).start()
+        self.addCleanup(server.stop)
+        for patcher in [mock.patch.object(GraphqlExporter, 'GRAPHQL_URL', server.url),
+                        mock.patch.object(GraphqlExporter, 'ARCHIVE_FOLDER', None),
+                        mock.patch.object(GraphqlExporter, 'ADAPTIVE_PAGE_SIZE', True)]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        exporter = GraphqlListExporter(path.join(QUERIES_FOLDER, 'get_persons.graphql'))
+        self.addCleanup(exporter.close_session)
+        exporter.page_sizer.page_size = 20
+
+        result = exporter.execute_graphql_query("""
+            query ($id: ID!) {
+                person(id: $id) {
+                    connections { publications(first: 12) { edges { node { id } } } }
+                }
+            }""", variable_values={'id': '1'})
+        assert len(result['person']['connections']['publications']['edges']) <= 12
+        assert exporter.page_sizer.page_size == 20
+
+        result = exporter.execute_graphql_query(exporter.query_template,
+                                                variable_values=exporter.make_pagination_variables())
+        assert len(result['personList']['list']) == 20
+        assert exporter.page_sizer.page_size == 25
+
+
+class ExportSchedulerTest(unittest.TestCase):
+
+    class RecordingTask:
+        """
+        Task that records when it ran instead of exporting.
+        """
+
+        def __init__(self, name: str, produces: str, depends_on: list, events: list, fail: bool = False):
+            self.name = name
+            self.produces = produces
+            self.depends_on = depends_on
+            self.events = events
+            self.fail = fail
+
+        def run(self):
+            self.events.append(('start', self.name))
+            time.sleep(0.05)
+            if self.fail:
+                raise ValueError(self.name + " failed")
+            self.events.append(('end', self.name))
+
+    def setUp(self):
+        for patcher in [mock.patch.object(GraphqlConnectionExporter, 'SCOPED', False),
+                        mock.patch.object(GraphqlOrganisationHierarchyExporter, 'ROOT_ORGANISATION_IDS', [])]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_dependencies(self):
+        """
+        Test that connections depend on their source list, the hierarchy on the organisations and that exports
+        other exports wait for are started first.
+        """
+        tasks = ExportScheduler(QUERIES_FOLDER).tasks
+        depends_on = {task.name: task.depends_on for task in tasks}
+        assert depends_on['get_connection_person_publication.graphql'] == ['person']
+        assert depends_on['get_connection_organisation_person.graphql'] == ['organisation']
+        assert depends_on['get_organisations_hierarchy.graphql'] == ['organisation']
+        assert depends_on['get_publications.graphql'] == []
+        names = [task.name for task in tasks]
+        assert names.index('get_organisations.graphql') < names.index('get_publications.graphql')
+        assert names.index('get_persons.graphql') < names.index('get_publications.graphql')
+
+    def test_missing_dependency(self):
+        """
+        Test that an export whose source collection no template exports is rejected.
+        """
+        events = []
+        with self.assertRaises(ValueError):
+            ExportScheduler.check_dependencies([self.RecordingTask('a', 'a', ['b'], events)])
+
+    def test_run_order(self):
+        """
+        Test that every export starts after the exports it depends on finished and independent exports overlap.
+        """
+        events = []
+        scheduler = ExportScheduler(QUERIES_FOLDER, max_parallel_exports=3)
+        scheduler.tasks = [self.RecordingTask('organisation', 'organisation', [], events),
+                           self.RecordingTask('person', 'person', [], events),
+                           self.RecordingTask('organisation_person', 'organisation_persons', ['organisation'],
+                                              events),
+                           self.RecordingTask('person_publication', 'person_publications',
+                                              ['person', 'organisation_persons'], events)]
+        scheduler.run()
+        for task in scheduler.tasks:
+            for dependency in [other for other in scheduler.tasks if other.produces in task.depends_on]:
+                assert events.index(('end', dependency.name)) < events.index(('start', task.name))
+        assert events[:2] == [('start', 'organisation'), ('start', 'person')]
+
+    def test_failed_export(self):
+        """
+        Test that a failed export is raised and the exports that depend on it are not started.
+        """
+        events = []
+        scheduler = ExportScheduler(QUERIES_FOLDER)
+        scheduler.tasks = [self.RecordingTask('person', 'person', [], events, fail=True),
+                           self.RecordingTask('person_publication', 'person_publications', ['person'], events)]
+        with self.assertRaises(ValueError):
+            scheduler.run()
+        assert ('start', 'person_publication') not in events
+
+
+class AliasedQueryTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = CrisStubServer(list_sizes={'person': 20, 'publication': 100}, max_connections=5).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+    def test_aliased_variables(self):
+        """
+        Test that the variables of every copy are prefixed with its alias.
+        """
+        variables = GraphqlExporter.make_aliased_variables({'c0': {'id': '1', 'after': ''}, 'c1': {'id': '2'}})
+        assert variables == {'c0_id': '1', 'c0_after': '', 'c1_id': '2'}
+
+    def test_aliased_query(self):
+        """
+        Test that the aliased query is valid and returns the result of every copy under its alias.
+        """
+        exporter = GraphqlListExporter(path.join(QUERIES_FOLDER, 'get_persons.graphql'), inline_connections=False)
+        exporter.GRAPHQL_URL = self.server.url
+        with open(path.join(QUERIES_FOLDER, 'get_connection_person_publication.graphql'), 'r') as template_file:
+            template = template_file.read()
+        aliases = ['c0', 'c1', 'c2']
+        query = exporter.make_aliased_query(template, aliases)
+        assert exporter.make_aliased_query(template, aliases) is query
+        assert not validate(exporter.load_schema(), parse(query))
+        variables = exporter.make_aliased_variables({alias: {'id': str(index)} for index, alias in enumerate(aliases)})
+        try:
+            result = exporter.execute_graphql_query(query, variable_values=variables)
+            for index, alias in enumerate(aliases):
+                single_result = exporter.execute_graphql_query(template, variable_values={'id': str(index)})
+                assert result[alias] == single_result['person']
+        finally:
+            exporter.close_session()
+
+
+class ContentHashTest(unittest.TestCase):
+
+    def test_delta_export_hash(self):
+        """
+        Test that the hash of a CRIS document ignores the order of its keys but not its content.
+        """
+        document = {'id': '1', 'cfTitle': 'Title', 'authors': ['a', 'b'], 'publYear': 2020}
+        reordered = {'publYear': 2020, 'authors': ['a', 'b'], 'cfTitle': 'Title', 'id': '1'}
+        assert DeltaExport.content_hash(document) == DeltaExport.content_hash(reordered)
+        assert DeltaExport.content_hash(document) != DeltaExport.content_hash(dict(document, publYear=2021))
+        assert DeltaExport.content_hash(document) != DeltaExport.content_hash(dict(document, authors=['b', 'a']))
+
+    def test_web_export_hash(self):
+        """
+        Test that the hash of a web document ignores the order of its keys, also in nested documents.
+        """
+        web_export = import_pipeline_module(self, 'web_export')
+        document = {'id': '1', 'publicationList': [{'id': 'x', 'publYear': 2020}]}
+        reordered = {'publicationList': [{'publYear': 2020, 'id': 'x'}], 'id': '1'}
+        assert web_export.content_hash(document) == web_export.content_hash(reordered)
+        assert web_export.content_hash(document) != web_export.content_hash({'id': '1', 'publicationList': []})
+
+
+class MongoDBTestCase(unittest.TestCase):
+    """
+    Base of the tests that need a MongoDB instance. They write to a scratch database that is dropped afterwards
+    and are skipped if no instance is reachable.
+    """
+    MONGODB_URI = getenv("CRISETL_ENV_MONGO_URI", 'mongodb://localhost:27017/')
+    DATABASE = 'FLK_Exporter_Test'
+
+    def setUp(self):
+        self.client = pm.MongoClient(self.MONGODB_URI, serverSelectionTimeoutMS=2000)
+        try:
+            self.client.server_info()
+        except ServerSelectionTimeoutError:
+            self.client.close()
+            self.skipTest("No MongoDB instance at " + self.MONGODB_URI)
+        self.client.drop_database(self.DATABASE)
+        self.database = self.client[self.DATABASE]
+
+    def tearDown(self):
+        self.client.drop_database(self.DATABASE)
+        self.client.close()
+
+
+class DeltaExportTest(MongoDBTestCase):
+
+    def test_changesets(self):
+        """
+        Test that only new and changed documents are written, missing documents are marked as deleted and every run
+        records its changeset.
+        """
+        delta_export = DeltaExport(self.MONGODB_URI, self.DATABASE, 'publication')
+        assert delta_export.write([{'id': '1', 'cfTitle': 'a'}, {'id': '2', 'cfTitle': 'b'}]) == 2
+        changeset = delta_export.finish()
+        assert (changeset['added'], changeset['changed'], changeset['deleted']) == (['1', '2'], [], [])
+
+        delta_export = DeltaExport(self.MONGODB_URI, self.DATABASE, 'publication')
+        assert delta_export.write([{'id': '1', 'cfTitle': 'A'}, {'id': '3', 'cfTitle': 'c'}]) == 2
+        changeset = delta_export.finish()
+        assert (changeset['added'], changeset['changed'], changeset['deleted']) == (['3'], ['1'], ['2'])
+        assert self.database['publication'].find_one({'id': '2'})['deleted']
+
+        delta_export = DeltaExport(self.MONGODB_URI, self.DATABASE, 'publication')
+        assert delta_export.write([{'id': '1', 'cfTitle': 'A'}, {'id': '2', 'cfTitle': 'b'},
+                                   {'id': '3', 'cfTitle': 'c'}]) == 1
+        changeset = delta_export.finish()
+        assert (changeset['added'], changeset['changed'], changeset['deleted']) == (['2'], [], [])
+        assert not self.database['publication'].find_one({'id': '2'})['deleted']
+        assert self.database['publication'].count_documents(DeltaExport.not_deleted()) == 3
+        assert self.database[DeltaExport.CHANGESET_COLLECTION].count_documents({'collection': 'publication'}) == 3
+
+
+class CheckpointExportTest(MongoDBTestCase):
+    TEMPLATE = path.join(QUERIES_FOLDER, 'get_persons.graphql')
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = CrisStubServer(list_sizes={'person': 350}).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+    def setUp(self):
+        super().setUp()
+        for patcher in [mock.patch.object(GraphqlExporter, 'MONGODB_URI', self.MONGODB_URI),
+                        mock.patch.object(GraphqlExporter, 'DATABASE', self.DATABASE),
+                        mock.patch.object(GraphqlExporter, 'GRAPHQL_URL', self.server.url),
+                        mock.patch.object(GraphqlExporter, 'ARCHIVE_FOLDER', None),
+                        mock.patch.object(GraphqlListExporter, 'PAGES_PER_WRITE', 1)]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_resume(self):
+        """
+        Test that an export that failed partway through continues after the last saved cursor and writes every
+        document exactly once.
+        """
+        execute_graphql_query = GraphqlExporter.execute_graphql_query
+        requests = []
+        failed = []
+
+        def fail_third_page(exporter, *args, **kwargs):
+            requests.append(args)
+            if len(requests) == 3 and not failed:
+                failed.append(args)
+                raise FatalExportError('CRIS is unavailable')
+            return execute_graphql_query(exporter, *args, **kwargs)
+
+        with mock.patch.object(GraphqlExporter, 'execute_graphql_query', fail_third_page):
+            with self.assertRaises(FatalExportError):
+                GraphqlListExporter(self.TEMPLATE, checkpoint=True).export()
+            progress = self.database['exporter_person'].find_one({'_id': 'progress'})
+            assert progress['pages'] <= 2
+            assert self.database['person'].count_documents({}) == progress['documents']
+
+            requests.clear()
+            GraphqlListExporter(self.TEMPLATE, checkpoint=True).export()
+        assert len(requests) == 4 - progress['pages']
+        ids = [document['id'] for document in self.database['person'].find({}, {'id': 1})]
+        assert len(ids) == 350 and set(ids) == {str(person_id) for person_id in range(350)}
+        assert self.database['exporter_person'].count_documents({}) == 0
+
+
+class HierarchyExportTest(MongoDBTestCase):
+    TEMPLATE = path.join(QUERIES_FOLDER, 'get_organisations_hierarchy.graphql')
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = CrisStubServer(list_sizes={'organisation': 10}).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+    def setUp(self):
+        super().setUp()
+        for patcher in [mock.patch.object(GraphqlExporter, 'MONGODB_URI', self.MONGODB_URI),
+                        mock.patch.object(GraphqlExporter, 'DATABASE', self.DATABASE),
+                        mock.patch.object(GraphqlExporter, 'GRAPHQL_URL', self.server.url),
+                        mock.patch.object(GraphqlExporter, 'ARCHIVE_FOLDER', None)]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def hierarchy(self):
+        return sorted((document['organisation_id'], document['child_organisation_id'])
+                      for document in self.database['organisation_organisation'].find())
+
+    def test_walk(self):
+        """
+        Test that the hierarchy below the roots is walked level by level and replaces the hierarchy of an earlier
+        export, also if the roots have no children.
+        """
+        GraphqlOrganisationHierarchyExporter(self.TEMPLATE, root_organisation_ids=['1'], batch_size=2).export()
+        assert self.hierarchy() == [('1', '3'), ('1', '4'), ('3', '7'), ('3', '8'), ('4', '9')]
+        GraphqlOrganisationHierarchyExporter(self.TEMPLATE, root_organisation_ids=['8']).export()
+        assert self.hierarchy() == []
+
+
+class RebuildTest(MongoDBTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = CrisStubServer(list_sizes={'person': 30, 'publication': 200}, max_connections=5).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+    def setUp(self):
+        super().setUp()
+        archive_folder = tempfile.TemporaryDirectory()
+        self.addCleanup(archive_folder.cleanup)
+        self.archive_folder = archive_folder.name
+        for patcher in [mock.patch.object(GraphqlExporter, 'MONGODB_URI', self.MONGODB_URI),
+                        mock.patch.object(GraphqlExporter, 'DATABASE', self.DATABASE),
+                        mock.patch.object(GraphqlExporter, 'GRAPHQL_URL', self.server.url),
+                        mock.patch.object(GraphqlExporter, 'ARCHIVE_FOLDER', self.archive_folder),
+                        mock.patch.object(GraphqlConnectionExporter, 'LEASES', False),
+                        mock.patch.object(GraphqlConnectionExporter, 'SCOPED', False)]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def snapshot(self):
+        return {str(segment): segment.stat().st_size for segment in pathlib.Path(self.archive_folder).glob('*/*')}
+
+    def contents(self, db_collection: str):
+        return sorted(str(sorted(document.items())) for document in self.database[db_collection].find({}, {'_id': 0}))
+
+    def test_rebuild(self):
+        """
+        Test that a rebuild restores the exported collections from the archive without archiving again or seeding
+        the exporter collections of the connections.
+        """
+        GraphqlListExporter(path.join(QUERIES_FOLDER, 'get_persons.graphql')).export()
+        GraphqlConnectionExporter(path.join(QUERIES_FOLDER, 'get_connection_person_publication.graphql')).export()
+        persons = self.contents('person')
+        connections = self.contents('person_publications')
+        snapshot = self.snapshot()
+        assert persons and connections and snapshot
+        self.database['person'].delete_many({'id': {'$in': ['1', '2']}})
+        self.database['person_publications'].delete_many({'person_id': {'$in': ['1', '2']}})
+        kept_connections = self.database['person_publications'].count_documents({})
+
+        rebuild_collection = GraphqlExporter.rebuild_collection
+        started_rebuilds = {}
+
+        def record_start(exporter, snapshot_locations, db_collection, *args, **kwargs):
+            started_rebuilds[db_collection] = (self.database[db_collection].count_documents({}),
+                                               self.database.list_collection_names())
+            return rebuild_collection(exporter, snapshot_locations, db_collection, *args, **kwargs)
+
+        with mock.patch.object(GraphqlExporter, 'rebuild_collection', record_start):
+            CrisExporter().rebuild_all(archive_folder=self.archive_folder)
+        connections_count, collection_names = started_rebuilds['person_publications']
+        assert connections_count == kept_connections
+        assert 'exporter_person_publications' not in collection_names
+        assert self.contents('person') == persons
+        assert self.contents('person_publications') == connections
+        assert self.snapshot() == snapshot
+
+
+class StagedLoadTest(MongoDBTestCase):
+    TEMPLATE = path.join(QUERIES_FOLDER, 'get_persons.graphql')
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = CrisStubServer(list_sizes={'person': 120}).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+    def setUp(self):
+        super().setUp()
+        for patcher in [mock.patch.object(GraphqlExporter, 'MONGODB_URI', self.MONGODB_URI),
+                        mock.patch.object(GraphqlExporter, 'DATABASE', self.DATABASE),
+                        mock.patch.object(GraphqlExporter, 'GRAPHQL_URL', self.server.url),
+                        mock.patch.object(GraphqlExporter, 'ARCHIVE_FOLDER', None),
+                        mock.patch.object(GraphqlExporter, 'STAGED_LOAD', True)]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.database['person'].insert_one({'id': 'stale'})
+
+    def ids(self):
+        return sorted(document['id'] for document in self.database['person'].find())
+
+    def test_staged_writer(self):
+        """
+        Test that the collection keeps its documents while the staging collection is loaded and is replaced by it,
+        together with its indexes, when the writer is closed.
+        """
+        writer = MongoPageWriter(self.MONGODB_URI, self.DATABASE, 'person', truncate_collection=True, staged=True,
+                                 indexes=GraphqlListExporter.INDEXES).start()
+        writer.put([{'id': '1'}])
+        writer.put([{'id': '2'}])
+        assert self.ids() == ['stale']
+        assert writer.close() == 2
+        assert self.ids() == ['1', '2']
+        assert self.database['person'].index_information()['id_1']['unique']
+        assert not [collection_name for collection_name in self.database.list_collection_names()
+                    if collection_name.startswith(MongoPageWriter.STAGING_PREFIX)]
+
+    def test_staged_list_export(self):
+        """
+        Test that a staged list export replaces the collection, whether the pages are collected or streamed.
+        """
+        for stream in [False, True]:
+            with self.subTest(stream=stream):
+                GraphqlListExporter(self.TEMPLATE, stream=stream).export()
+                assert self.ids() == sorted(str(person_id) for person_id in range(120))
+                assert self.database['person'].index_information()['id_1']['unique']
+                assert not [collection_name for collection_name in self.database.list_collection_names()
+                            if collection_name.startswith(MongoPageWriter.STAGING_PREFIX)]
+                self.database['person'].insert_one({'id': 'stale'})
+
+
+class ConnectionLeaseTest(MongoDBTestCase):
+    TEMPLATE = path.join(QUERIES_FOLDER, 'get_connection_person_publication.graphql')
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = CrisStubServer(list_sizes={'person': 30, 'publication': 200}, max_connections=5).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+    def setUp(self):
+        super().setUp()
+        for patcher in [mock.patch.object(GraphqlExporter, 'MONGODB_URI', self.MONGODB_URI),
+                        mock.patch.object(GraphqlExporter, 'DATABASE', self.DATABASE),
+                        mock.patch.object(GraphqlExporter, 'GRAPHQL_URL', self.server.url),
+                        mock.patch.object(GraphqlExporter, 'ARCHIVE_FOLDER', None),
+                        mock.patch.object(GraphqlConnectionExporter, 'SCOPED', False),
+                        mock.patch.object(GraphqlConnectionExporter, 'LEASE_SHARD_SIZE', 10)]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.database['person'].insert_many([{'id': str(person_id)} for person_id in range(30)])
+        self.leases = self.database['leases_person_publications']
+
+    def connections(self):
+        return {(document['person_id'], document['publication_id'])
+                for document in self.database['person_publications'].find({}, {'_id': 0})}
+
+    def test_leased_export(self):
+        """
+        Test that a leased export writes the same connections as a plain export and is finalised for the run.
+        """
+        GraphqlConnectionExporter(self.TEMPLATE, leases=True).export()
+        state = self.leases.find_one({'_id': 'state'})
+        assert (state['state'], state['run_id']) == ('finalised', RUN_ID)
+        assert self.leases.count_documents({'shard': {'$exists': True}}) == 0
+        leased_connections = self.connections()
+
+        GraphqlConnectionExporter(self.TEMPLATE).export()
+        assert leased_connections and leased_connections == self.connections()
+
+    def test_sequential_export(self):
+        """
+        Test that the sequential export, one request at a time, writes the same connections as the concurrent export.
+        """
+        GraphqlConnectionExporter(self.TEMPLATE, concurrency=1, batch_size=1).export()
+        sequential_connections = self.connections()
+        assert 'exporter_person_publications' not in self.database.list_collection_names()
+
+        GraphqlConnectionExporter(self.TEMPLATE, concurrency=4, batch_size=5).export()
+        assert sequential_connections and sequential_connections == self.connections()
+
+    def test_finalised_run_is_not_joined(self):
+        """
+        Test that a worker does not join an export that was finalised in an earlier run, and that the export of the
+        run seeds it again.
+        """
+        self.leases.insert_one({'_id': 'state', 'state': 'finalised', 'run_id': 'earlier run', 'owner': 'other'})
+        assert not GraphqlConnectionExporter(self.TEMPLATE, leases=True).join_export()
+        GraphqlConnectionExporter(self.TEMPLATE, leases=True).export()
+        assert self.leases.find_one({'_id': 'state'})['run_id'] == RUN_ID
+        assert self.connections()
+
+    def test_dead_finaliser(self):
+        """
+        Test that the export is finalised by another worker once the lease of a finalising worker expired, but not
+        while it is alive.
+        """
+        now = datetime.now(timezone.utc)
+        self.leases.insert_one({'_id': 'state', 'state': 'finalising', 'run_id': RUN_ID, 'owner': 'other',
+                                'lease_expires': now + timedelta(minutes=5)})
+        assert not GraphqlConnectionExporter(self.TEMPLATE, leases=True).join_export()
+        self.leases.update_one({'_id': 'state'}, {'$set': {'lease_expires': now - timedelta(minutes=5)}})
+        assert GraphqlConnectionExporter(self.TEMPLATE, leases=True).join_export()
+        state = self.leases.find_one({'_id': 'state'})
+        assert (state['state'], state['run_id']) == ('finalised', RUN_ID)
+
+    def test_foreign_run(self):
+        """
+        Test that a worker of another run neither exports nor finalises the export, so the export of the run it
+        belongs to is finalised under its own run id.
+        """
+        self.leases.insert_many([
+            {'_id': 'state', 'state': 'exporting', 'run_id': 'main run', 'owner': 'main', 'shards': 1},
+            {'shard': 0, 'ids': ['0', '1'], 'after_cursors': [None, None], 'done': False, 'attempts': 0,
+             'lease_owner': None, 'lease_expires': datetime.fromtimestamp(0, timezone.utc)}])
+        assert RUN_ID != 'main run'
+        assert not GraphqlConnectionExporter(self.TEMPLATE, leases=True).join_export()
+        assert self.leases.count_documents({'shard': {'$exists': True}, 'done': False}) == 1
+        assert self.leases.find_one({'_id': 'state'})['state'] == 'exporting'
+
+        with mock.patch('graphql_connenction_exporter.RUN_ID', 'main run'):
+            assert GraphqlConnectionExporter(self.TEMPLATE, leases=True).join_export()
+        state = self.leases.find_one({'_id': 'state'})
+        assert (state['state'], state['run_id']) == ('finalised', 'main run')
+        assert self.connections()
+
+
+class InlineConnectionTest(MongoDBTestCase):
+    LIST_TEMPLATE = path.join(QUERIES_FOLDER, 'get_persons.graphql')
+    CONNECTION_TEMPLATE = path.join(QUERIES_FOLDER, 'get_connection_person_publication.graphql')
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = CrisStubServer(list_sizes={'person': 30, 'publication': 200}, max_connections=5).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+    def setUp(self):
+        super().setUp()
+        for patcher in [mock.patch.object(GraphqlExporter, 'MONGODB_URI', self.MONGODB_URI),
+                        mock.patch.object(GraphqlExporter, 'DATABASE', self.DATABASE),
+                        mock.patch.object(GraphqlExporter, 'GRAPHQL_URL', self.server.url),
+                        mock.patch.object(GraphqlExporter, 'ARCHIVE_FOLDER', None),
+                        mock.patch.object(GraphqlListExporter, 'INLINE_CONNECTIONS_FIRST', 2),
+                        mock.patch.object(GraphqlConnectionExporter, 'SCOPED', False)]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def connections(self):
+        return {(document['person_id'], document['publication_id'])
+                for document in self.database['person_publications'].find({}, {'_id': 0})}
+
+    def test_harvest(self):
+        """
+        Test that the list export harvests the first page of the connections of every node and leaves the ids with
+        more pages behind the marker document, and that the connection exporter completes only these ids.
+        """
+        GraphqlListExporter(self.LIST_TEMPLATE, inline_connections=True).export()
+        assert self.database['person'].count_documents({}) == 30
+        assert self.database['person'].count_documents({'connections': {'$exists': True}}) == 0
+        exporter_collection = self.database['exporter_person_publications']
+        assert exporter_collection.find_one({'_id': GraphqlConnectionExporter.INLINE_MARKER_ID})
+        follow_ups = list(exporter_collection.find({'_id': {'$ne': GraphqlConnectionExporter.INLINE_MARKER_ID}}))
+        assert follow_ups and all(follow_up['after_cursor'] == '2' for follow_up in follow_ups)
+        harvested = self.connections()
+        assert all(sum(1 for person_id, _ in harvested if person_id == follow_up['id']) == 2
+                   for follow_up in follow_ups)
+
+        GraphqlConnectionExporter(self.CONNECTION_TEMPLATE).export()
+        assert exporter_collection.count_documents({}) == 0
+        inline_connections = self.connections()
+        assert harvested < inline_connections
+
+        GraphqlConnectionExporter(self.CONNECTION_TEMPLATE).export()
+        assert inline_connections == self.connections()
+        connection_counts = {}
+        for person_id, _ in inline_connections:
+            connection_counts[person_id] = connection_counts.get(person_id, 0) + 1
+        assert {follow_up['id'] for follow_up in follow_ups} == {person_id for person_id, count
+                                                                 in connection_counts.items() if count > 2}
+
+
+class ScopedSeedingTest(MongoDBTestCase):
+
+    def setUp(self):
+        super().setUp()
+        for patcher in [mock.patch.object(GraphqlExporter, 'MONGODB_URI', self.MONGODB_URI),
+                        mock.patch.object(GraphqlExporter, 'DATABASE', self.DATABASE),
+                        mock.patch.object(GraphqlExporter, 'ARCHIVE_FOLDER', None),
+                        mock.patch.object(GraphqlConnectionExporter, 'LEASES', False),
+                        mock.patch.object(GraphqlOrganisationHierarchyExporter, 'ROOT_ORGANISATION_IDS', [])]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.database['organisation_organisation'].insert_many([
+            {'organisation_id': parent_id, 'child_organisation_id': child_id}
+            for parent_id, child_id in [('1', '2'), ('1', '3'), ('2', '4'), ('4', '1'), ('5', '6')]])
+        self.database['organisation_persons'].insert_many([
+            {'organisation_id': organisation_id, 'person_id': person_id}
+            for organisation_id, person_id in [('2', 'a'), ('4', 'b'), ('4', 'a'), ('6', 'c'), ('3', 'd')]])
+        self.database['organisation'].insert_many([{'id': str(organisation_id)} for organisation_id in range(1, 7)])
+        self.database['person'].insert_many([{'id': 'a'}, {'id': 'b'}, {'id': 'c'}, {'id': 'd', 'deleted': True}])
+
+    def seeded_ids(self, template: str, **exporter_arguments):
+        exporter = GraphqlConnectionExporter(path.join(QUERIES_FOLDER, template), **exporter_arguments)
+        ids = sorted(document['id'] for document in self.database[exporter.exporter_collection_name].find())
+        self.database[exporter.exporter_collection_name].drop()
+        return ids
+
+    def test_scoped_seeding(self):
+        """
+        Test that a scoped export is seeded with the organisations below the roots or their members that are not
+        deleted, and an unscoped export with every id of the source collection that is not deleted.
+        """
+        assert self.seeded_ids('get_connection_organisation_publication.graphql', scoped=True,
+                               root_organisation_ids=['1']) == ['1', '2', '3', '4']
+        assert self.seeded_ids('get_connection_person_publication.graphql', scoped=True,
+                               root_organisation_ids=['1']) == ['a', 'b']
+        assert self.seeded_ids('get_connection_person_publication.graphql', scoped=True,
+                               root_organisation_ids=['4', '5']) == ['a', 'b', 'c']
+        assert self.seeded_ids('get_connection_person_publication.graphql', scoped=False) == ['a', 'b', 'c']
+        with self.assertRaises(ValueError):
+            GraphqlConnectionExporter(path.join(QUERIES_FOLDER, 'get_connection_person_publication.graphql'),
+                                      scoped=True)
+
+
+class ConnectionIndexTest(MongoDBTestCase):
+    TEMPLATE = path.join(QUERIES_FOLDER, 'get_connection_person_publication.graphql')
+
+    def setUp(self):
+        super().setUp()
+        for patcher in [mock.patch.object(GraphqlExporter, 'MONGODB_URI', self.MONGODB_URI),
+                        mock.patch.object(GraphqlExporter, 'DATABASE', self.DATABASE)]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.connections = self.database['person_publications']
+
+    def test_duplicates_before_unique_index(self):
+        """
+        Test that duplicates of an earlier export are removed when they prevent the unique index, and that the index
+        keeps connections from being stored twice afterwards.
+        """
+        self.connections.insert_many([{'person_id': person_id, 'publication_id': publication_id}
+                                      for person_id, publication_id in [('a', 'x'), ('a', 'x'), ('a', 'y'),
+                                                                        ('b', 'x'), ('a', 'x'), ('b', 'x')]])
+        GraphqlConnectionExporter(self.TEMPLATE, rebuild=True).create_indexes()
+        assert sorted((document['person_id'], document['publication_id']) for document
+                      in self.connections.find()) == [('a', 'x'), ('a', 'y'), ('b', 'x')]
+        with self.assertRaises(DuplicateKeyError):
+            self.connections.insert_one({'person_id': 'b', 'publication_id': 'x'})
+
+    def test_pages_written_again(self):
+        """
+        Test that a page that is written again, e.g. after a resume, does not fail on the unique index.
+        """
+        GraphqlConnectionExporter(self.TEMPLATE, rebuild=True).create_indexes()
+        page = [{'person_id': 'a', 'publication_id': 'x'}, {'person_id': 'a', 'publication_id': 'y'}]
+        writer = MongoPageWriter(self.MONGODB_URI, self.DATABASE, 'person_publications').start()
+        writer.put([dict(document) for document in page])
+        writer.put([dict(document) for document in page] + [{'person_id': 'b', 'publication_id': 'x'}])
+        writer.close()
+        assert self.connections.count_documents({}) == 3
+
+    def test_concurrent_upserts(self):
+        """
+        Test that upserts of connections that another worker stored at the same time are ignored, but other write
+        errors are raised.
+        """
+        exporter = GraphqlConnectionExporter(self.TEMPLATE, rebuild=True)
+        collection = mock.Mock()
+        collection.bulk_write.side_effect = BulkWriteError({'writeErrors': [{'code': 11000}],
+                                                            'writeConcernErrors': []})
+        exporter._GraphqlConnectionExporter__write_connections(collection, [{'person_id': 'a',
+                                                                             'publication_id': 'x'}])
+        collection.bulk_write.side_effect = BulkWriteError({'writeErrors': [{'code': 11000}, {'code': 121}],
+                                                            'writeConcernErrors': []})
+        with self.assertRaises(BulkWriteError):
+            exporter._GraphqlConnectionExporter__write_connections(collection, [{'person_id': 'a',
+                                                                                 'publication_id': 'x'}])
+
+
+class SyncAggregationTest(MongoDBTestCase):
+
+    def sync(self):
+        return self.web_export.sync_aggregation(self.MONGODB_URI, self.DATABASE, 'organisation',
+                                                [{'$match': {'deleted': {'$ne': True}}}], self.MONGODB_URI,
+                                                self.DATABASE, 'organisations', batch_size=2)
+
+    def test_sync(self):
+        """
+        Test that only new and changed documents are written and documents that left the result are deleted.
+        """
+        self.web_export = import_pipeline_module(self, 'web_export')
+        organisations = self.database['organisation']
+        organisations.insert_many([{'id': str(organisation_id), 'cfName': 'Organisation ' + str(organisation_id)}
+                                   for organisation_id in range(5)])
+        assert self.sync() == (5, 0)
+        assert self.sync() == (0, 0)
+        organisations.update_one({'id': '1'}, {'$set': {'cfName': 'Renamed'}})
+        organisations.update_one({'id': '2'}, {'$set': {'deleted': True}})
+        organisations.insert_one({'id': '5', 'cfName': 'Organisation 5'})
+        assert self.sync() == (2, 1)
+        web_organisations = {document['id']: document for document in self.database['organisations'].find()}
+        assert sorted(web_organisations) == ['0', '1', '3', '4', '5']
+        assert web_organisations['1']['cfName'] == 'Renamed'
+        for document in web_organisations.values():
+            content = {key: value for key, value in document.items() if key not in ('_id', 'content_hash')}
+            assert document['content_hash'] == self.web_export.content_hash(content)
+
+
+
+class ExportAggregationTest(MongoDBTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.web_export = import_pipeline_module(self, 'web_export')
+        self.database['organisation'].insert_many([{'id': str(organisation_id), 'content_hash': 'hash'}
+                                                   for organisation_id in range(5)])
+        self.database['organisation'].update_one({'id': '3'}, {'$set': {'deleted': True}})
+
+    def export(self, mongodb_to_uri: str, pipeline: list):
+        self.database['organisations'].insert_one({'id': 'stale'})
+        self.database['organisations'].create_index('id', unique=True, name='id')
+        self.web_export.export_aggregation(self.MONGODB_URI, self.DATABASE, 'organisation', pipeline,
+                                           mongodb_to_uri, self.DATABASE, 'organisations', batch_size=2)
+        assert 'organisations_staging' not in self.database.list_collection_names()
+        return sorted(document['id'] for document in self.database['organisations'].find())
+
+    def test_export_aggregation(self):
+        """
+        Test that the result of the aggregation replaces the collection and keeps its indexes, written with $out on
+        the same server and streamed through a staging collection otherwise.
+        """
+        pipeline = [{'$match': self.web_export.not_deleted({})}, {'$unset': self.web_export.DATA_LAKE_FIELDS}]
+        # another uri of the same server makes the export stream the result
+        streaming_uri = self.MONGODB_URI[:-1] if self.MONGODB_URI.endswith('/') else self.MONGODB_URI + '/'
+        for mongodb_to_uri in [self.MONGODB_URI, streaming_uri]:
+            with self.subTest(mongodb_to_uri=mongodb_to_uri):
+                assert self.export(mongodb_to_uri, pipeline) == ['0', '1', '2', '4']
+                assert 'id' in self.database['organisations'].index_information()
+                assert self.database['organisations'].count_documents({'content_hash': {'$exists': True}}) == 0
+        assert self.export(streaming_uri, pipeline + [{'$match': {'id': 'none'}}]) == []
+
+
+class OrganisationHierarchyTest(MongoDBTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.organisation_pipeline = import_pipeline_module(self, 'organisation_pipeline')
+        self.database['organisation_organisation'].insert_many([
+            {'organisation_id': parent_id, 'child_organisation_id': child_id}
+            for parent_id, child_id in [('1', '2'), ('1', '3'), ('2', '4'), ('3', '4'), ('4', '5'), ('5', '1'),
+                                        ('6', '7')]])
+
+    def test_depths(self):
+        """
+        Test that the organisations below the head are found with their shortest depth, ordered by depth, across
+        organisations with several parents and cycles.
+        """
+        depths = self.organisation_pipeline.get_hierarchy_organisation_depths(1, self.MONGODB_URI, self.DATABASE)
+        assert depths == {'2': 1, '3': 1, '4': 2, '5': 3}
+        assert list(depths.values()) == sorted(depths.values())
+        assert self.organisation_pipeline.get_hierarchy_organisation_depths(7, self.MONGODB_URI,
+                                                                            self.DATABASE) == {}
+
+    def test_export_organisations(self):
+        """
+        Test that the organisations below the head that are not deleted are exported without the fields of the
+        Data Lake.
+        """
+        self.database['organisation'].insert_many([{'id': str(organisation_id), 'content_hash': 'hash'}
+                                                   for organisation_id in range(1, 8)])
+        self.database['organisation'].update_one({'id': '3'}, {'$set': {'deleted': True}})
+        with mock.patch.object(self.organisation_pipeline, 'INCREMENTAL_SYNC', False), \
+                mock.patch.object(self.organisation_pipeline, 'SERVER_SIDE_EXPORT', False):
+            self.organisation_pipeline.OrganisationPipeline(self.MONGODB_URI, self.DATABASE, self.MONGODB_URI,
+                                                            self.DATABASE).export_organisations(1)
+        organisations = list(self.database['organisations'].find({}, {'_id': 0}))
+        assert sorted(organisation['id'] for organisation in organisations) == ['2', '4', '5']
+        assert all(set(organisation) == {'id'} for organisation in organisations)
+
+
+class PersonFilterTest(MongoDBTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.person_pipeline = import_pipeline_module(self, 'person_pipeline')
+        self.database['organisation_organisation'].insert_many([
+            {'organisation_id': '1', 'child_organisation_id': '2'},
+            {'organisation_id': '6', 'child_organisation_id': '7'}])
+        self.database['organisation_persons'].insert_many([
+            {'organisation_id': organisation_id, 'person_id': person_id}
+            for organisation_id, person_id in [('1', 'a'), ('2', 'b'), ('2', 'c'), ('7', 'd'), ('2', 'e')]])
+        self.database['person'].insert_many([{'id': person_id, 'content_hash': 'hash'}
+                                             for person_id in ['a', 'b', 'c', 'd', 'e']])
+        self.database['person'].update_one({'id': 'e'}, {'$set': {'deleted': True}})
+        self.database['person_publications'].insert_many([
+            {'person_id': person_id, 'publication_id': publication_id}
+            for person_id, publication_id in [('a', 'x'), ('a', 'y'), ('b', 'x'), ('d', 'x'), ('e', 'y')]])
+        self.database['publication_filled'].insert_many([{'id': 'x', 'publYear': 2020},
+                                                         {'id': 'y', 'publYear': 2022}])
+
+    def test_export_persons(self):
+        """
+        Test that only the members of the head organisation and the organisations below it that have publications
+        and are not deleted are exported, with their publications sorted by year.
+        """
+        with mock.patch.object(self.person_pipeline, 'INCREMENTAL_SYNC', False), \
+                mock.patch.object(self.person_pipeline, 'SERVER_SIDE_EXPORT', False):
+            self.person_pipeline.PersonPipeline(self.MONGODB_URI, self.DATABASE, self.MONGODB_URI,
+                                                self.DATABASE).export_persons(1)
+        persons = {person['id']: person for person in self.database['persons'].find()}
+        assert sorted(persons) == ['a', 'b']
+        assert [publication['id'] for publication in persons['a']['publicationList']] == ['y', 'x']
+        assert [publication['id'] for publication in persons['b']['publicationList']] == ['x']
+        assert all('content_hash' not in person for person in persons.values())
+
+
+class VersionedPublishingTest(MongoDBTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.web_publisher = import_pipeline_module(self, 'web_publisher')
+        for patcher in [mock.patch.object(self.web_publisher, 'VERSIONED_PUBLISHING', True),
+                        mock.patch.object(self.web_publisher, 'MONGODB_TO_DB', self.DATABASE)]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def build(self, version: str, collections: dict):
+        with mock.patch.object(self.web_publisher, 'PUBLISH_VERSION', version):
+            for collection_name, documents in collections.items():
+                self.web_publisher.get_build_collection(self.database, collection_name).insert_many(documents)
+            return self.web_publisher.publish(self.database)
+
+    def ids(self, collection_name: str):
+        return sorted(document['id'] for document in self.database[collection_name].find())
+
+    def test_publish_and_rollback(self):
+        """
+        Test that publishing moves the published collections to __previous with their indexes, and that a rollback
+        restores them, drops the collections the version added and records the versions.
+        """
+        assert self.build('1', {'publications': [{'id': 'a'}, {'id': 'b'}]}) == ['publications']
+        self.database['publications'].create_index('id', unique=True, name='id')
+        assert self.build('2', {'publications': [{'id': 'c'}], 'network': [{'id': 'n'}]}) == \
+               ['publications', 'network']
+        assert self.ids('publications') == ['c'] and self.ids('publications__previous') == ['a', 'b']
+        assert self.ids('network') == ['n']
+        assert 'id' in self.database['publications'].index_information()
+        assert not [collection_name for collection_name in self.database.list_collection_names()
+                    if collection_name.startswith('publications__') and collection_name != 'publications__previous']
+
+        assert self.web_publisher.rollback(self.database) == ['publications', 'network']
+        assert self.ids('publications') == ['a', 'b']
+        assert {'network', 'publications__previous'}.isdisjoint(self.database.list_collection_names())
+        versions = {version['_id']: version for version in self.database['publish_versions'].find()}
+        assert (versions['1']['status'], versions['1']['new_collections']) == ('published', ['publications'])
+        assert (versions['2']['status'], versions['2']['new_collections']) == ('rolled_back', ['network'])
+        assert versions['2']['published_collections'] == ['publications', 'network']
+        with self.assertRaises(ValueError):
+            self.web_publisher.rollback(self.database, '2')
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,103 @@
+import hashlib
+import json
+from datetime import datetime
+
+import pymongo as pm
+
+
+class DeltaExport:
+    """
+    Incremental export of a collection. Every document carries a hash of its content, only new or changed
+    documents are written and documents that disappeared from CRIS are marked as deleted.
+    The ids added, changed and deleted by a run are recorded in the changeset collection.
+    """
+
+    CHANGESET_COLLECTION = 'export_changesets'
+
+    def __init__(self, mongodb_uri: str, database: str, db_collection: str):
+        """
+        Prepare the delta export by loading the hashes of the documents that are already stored.
+        :param mongodb_uri: uri of the MongoDB instance
+        :param database: name of the database
+        :param db_collection: name of the collection
+        """
+        self.db_collection = db_collection
+        self.mongodb_instance = pm.MongoClient(mongodb_uri, serverSelectionTimeoutMS=500000)
+        self.database = self.mongodb_instance[database]
+        self.stored_documents = {
+            document['id']: (document.get('content_hash'), document.get('deleted', False))
+            for document in self.database[db_collection].find({}, {"id": 1, "content_hash": 1, "deleted": 1,
+                                                                    "_id": 0})
+        }
+        self.started = datetime.utcnow()
+        self.seen_ids = set()
+        self.added_ids = []
+        self.changed_ids = []
+
+    @staticmethod
+    def not_deleted(query: dict = None):
+        """
+        Extend a query of an exported collection to skip the documents that were marked as deleted.
+        :param query: query of the collection
+        :return: query without deleted documents
+        """
+        return dict(query if query else {}, deleted={'$ne': True})
+
+    @staticmethod
+    def content_hash(document: dict):
+        """
+        Hash the content of a document independent of the order of its keys.
+        :param document: document as returned by CRIS
+        :return: sha256 hex digest
+        """
+        content = json.dumps(document, sort_keys=True, default=str, ensure_ascii=False)
+        return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+    def write(self, documents: list):
+        """
+        Upsert the new and changed documents of a page.
+        :param documents: documents as returned by CRIS
+        :return: number of written documents
+        """
+        requests = []
+        for document in documents:
+            document_id = document['id']
+            content_hash = self.content_hash(document)
+            self.seen_ids.add(document_id)
+            stored_hash, deleted = self.stored_documents.get(document_id, (None, True))
+            if stored_hash == content_hash and not deleted:
+                continue
+            if document_id in self.stored_documents and not deleted:
+                self.changed_ids.append(document_id)
+            else:
+                self.added_ids.append(document_id)
+            document = dict(document, content_hash=content_hash, deleted=False)
+            requests.append(pm.ReplaceOne({"id": document_id}, document, upsert=True))
+        if requests:
+            print("Upsert " + str(len(requests)) + " documents into collection: " + str(self.db_collection))
+            self.database[self.db_collection].bulk_write(requests, ordered=False)
+        return len(requests)
+
+    def finish(self):
+        """
+        Mark documents that were not exported in this run as deleted and record the changeset of the run.
+        :return: the changeset
+        """
+        deleted_ids = [document_id for document_id, (_, deleted) in self.stored_documents.items()
+                       if not deleted and document_id not in self.seen_ids]
+        if deleted_ids:
+            print("Mark " + str(len(deleted_ids)) + " documents as deleted in collection: " + str(self.db_collection))
+            self.database[self.db_collection].update_many({"id": {"$in": deleted_ids}}, {"$set": {"deleted": True}})
+        changeset = {
+            'collection': self.db_collection,
+            'started': self.started,
+            'finished': datetime.utcnow(),
+            'added': self.added_ids,
+            'changed': self.changed_ids,
+            'deleted': deleted_ids,
+        }
+        self.database[self.CHANGESET_COLLECTION].insert_one(changeset)
+        self.database[self.CHANGESET_COLLECTION].create_index([('collection', pm.ASCENDING),
+                                                                ('finished', pm.DESCENDING)])
+        self.mongodb_instance.close()
+        return changeset
@@ -0,0 +1,76 @@
+import asyncio
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+from aiohttp import ClientError
+from gql.transport.exceptions import TransportClosed, TransportProtocolError, TransportServerError
+
+RETRYABLE_STATUS_CODES = [408, 425, 429, 500, 502, 503, 504]
+
+
+class ExportError(Exception):
+    """
+    Base class of the errors raised by the exporters.
+    """
+
+
+class RetryableExportError(ExportError):
+    """
+    Transient error, e.g. a timeout, a dropped connection or a throttled request. The request may be sent again.
+    """
+
+    def __init__(self, message: str, retry_after: float = None, throttled: bool = False):
+        """
+        Constructor.
+        :param message: error message
+        :param retry_after: seconds the server asked us to wait before the next request
+        :param throttled: the server rejected the request because of its rate
+        """
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.throttled = throttled
+
+
+class FatalExportError(ExportError):
+    """
+    Error that does not go away by sending the request again, e.g. an invalid query or a rejected request.
+    """
+
+
+def classify_error(error: Exception):
+    """
+    Turn an exception raised while executing a query into a retryable or a fatal export error.
+    :param error: exception raised by the gql client
+    :return: RetryableExportError or FatalExportError
+    """
+    if isinstance(error, ExportError):
+        return error
+    if isinstance(error, TransportServerError):
+        if error.code in RETRYABLE_STATUS_CODES:
+            return RetryableExportError(str(error), retry_after=get_retry_after(error),
+                                        throttled=error.code in (429, 503))
+        return FatalExportError(str(error))
+    if isinstance(error, (asyncio.TimeoutError, ClientError, TransportProtocolError, TransportClosed,
+                          ConnectionError)):
+        return RetryableExportError(repr(error))
+    return FatalExportError(repr(error))
+
+
+def get_retry_after(error: TransportServerError):
+    """
+    Read the Retry-After header of the response that caused a server error.
+    :param error: server error raised by the aiohttp transport
+    :return: seconds to wait or None if the server sent no hint
+    """
+    headers = getattr(error.__cause__, 'headers', None)
+    if not headers or 'Retry-After' not in headers:
+        return None
+    retry_after = headers['Retry-After']
+    try:
+        return max(float(retry_after), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max((parsedate_to_datetime(retry_after) - datetime.now(timezone.utc)).total_seconds(), 0.0)
+    except (TypeError, ValueError):
+        return None
@@ -0,0 +1,179 @@
+import math
+import os
+import threading
+import time
+from datetime import datetime, timezone
+
+import pymongo as pm
+
+RUN_ID = os.getenv("CRISETL_RUN_ID", datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'))
+RUNS_COLLECTION = 'export_runs'
+PERCENTILES = [50, 90, 99]
+
+
+class ExportMetrics:
+    """
+    Metrics of the export of one query template: pages, documents, bytes received, request latencies, retries,
+    time spent writing to MongoDB and wall time. Safe to update from the exporter and its writer threads.
+    Finished exports are saved to the export_runs collection and, if configured, to a Prometheus textfile.
+    """
+
+    PROMETHEUS_TEXTFILE = os.getenv("CRISETL_PROMETHEUS_TEXTFILE")
+    finished_exports = {}  # summaries of the finished exports of this process by template, for the textfile
+    finished_exports_lock = threading.Lock()
+
+    def __init__(self, template_name: str, collection_name: str = None):
+        """
+        Start measuring an export.
+        :param template_name: name of the query template without extension, e.g. get_publications
+        :param collection_name: collection the export writes
+        """
+        self.template_name = template_name
+        self.collection_name = collection_name
+        self.started = datetime.now(timezone.utc)
+        self.started_monotonic = time.monotonic()
+        self.pages = 0
+        self.bytes = 0
+        self.latencies = []
+        self.retries = 0
+        self.documents = 0
+        self.write_seconds = 0.0
+        self.lock = threading.Lock()
+
+    def record_request(self, latency: float, page_bytes: int):
+        """
+        Record a successful request.
+        :param latency: seconds the request took
+        :param page_bytes: size of the JSON result
+        :return: None
+        """
+        with self.lock:
+            self.pages += 1
+            self.bytes += page_bytes
+            self.latencies.append(latency)
+
+    def record_retry(self):
+        """
+        Record a failed attempt of a request.
+        :return: None
+        """
+        with self.lock:
+            self.retries += 1
+
+    def record_write(self, documents: int, seconds: float):
+        """
+        Record a write to MongoDB.
+        :param documents: number of documents written
+        :param seconds: seconds the write took
+        :return: None
+        """
+        with self.lock:
+            self.documents += documents
+            self.write_seconds += seconds
+
+    def summary(self, status: str = 'succeeded', error: Exception = None):
+        """
+        Summarise the export.
+        :param status: succeeded or failed
+        :param error: error the export failed with
+        :return: dict with one entry per metric
+        """
+        with self.lock:
+            latencies = sorted(self.latencies)
+            summary = {
+                'run_id': RUN_ID,
+                'template': self.template_name,
+                'collection': self.collection_name,
+                'status': status,
+                'error': repr(error) if error else None,
+                'started': self.started,
+                'finished': datetime.now(timezone.utc),
+                'wall_seconds': time.monotonic() - self.started_monotonic,
+                'pages': self.pages,
+                'documents': self.documents,
+                'bytes': self.bytes,
+                'retries': self.retries,
+                'mongo_write_seconds': self.write_seconds,
+                'latency_seconds': {'p' + str(percentile): self.__percentile(latencies, percentile)
+                                    for percentile in PERCENTILES},
+            }
+            summary['latency_seconds']['max'] = latencies[-1] if latencies else None
+        return summary
+
+    def save(self, mongodb_uri: str, database: str, status: str = 'succeeded', error: Exception = None):
+        """
+        Save the summary of the export to the export_runs collection and the Prometheus textfile.
+        :param mongodb_uri: uri of the MongoDB instance
+        :param database: name of the database
+        :param status: succeeded or failed
+        :param error: error the export failed with
+        :return: summary
+        """
+        summary = self.summary(status, error)
+        print("Export of " + self.template_name + " " + status + ": " + str(summary['pages']) + " pages, " +
+              str(summary['documents']) + " documents in " + str(round(summary['wall_seconds'], 1)) + " s")
+        mongodb_instance = pm.MongoClient(mongodb_uri, serverSelectionTimeoutMS=300000)
+        runs = mongodb_instance[database][RUNS_COLLECTION]
+        runs.insert_one(dict(summary))
+        runs.create_index([('template', pm.ASCENDING), ('finished', pm.DESCENDING)])
+        mongodb_instance.close()
+        if self.PROMETHEUS_TEXTFILE:
+            with ExportMetrics.finished_exports_lock:
+                ExportMetrics.finished_exports[self.template_name] = summary
+                self.write_prometheus_textfile(self.PROMETHEUS_TEXTFILE, list(ExportMetrics.finished_exports.values()))
+        return summary
+
+    @staticmethod
+    def write_prometheus_textfile(location: os.PathLike, summaries: list):
+        """
+        Write summaries in the Prometheus text format, for the textfile collector of the node exporter.
+        The file is replaced atomically so the collector never reads a partial file.
+        :param location: path of the .prom file
+        :param summaries: summaries of the finished exports
+        :return: None
+        """
+        metrics = [
+            ('cris_export_pages', 'Pages fetched from CRIS', 'pages'),
+            ('cris_export_documents', 'Documents written to MongoDB', 'documents'),
+            ('cris_export_bytes', 'Size of the JSON results fetched from CRIS', 'bytes'),
+            ('cris_export_retries', 'Failed attempts of requests', 'retries'),
+            ('cris_export_mongo_write_seconds', 'Seconds spent writing to MongoDB', 'mongo_write_seconds'),
+            ('cris_export_wall_seconds', 'Wall time of the export', 'wall_seconds'),
+        ]
+        lines = []
+        for name, description, key in metrics:
+            lines.append('# HELP ' + name + ' ' + description + '.')
+            lines.append('# TYPE ' + name + ' gauge')
+            for summary in summaries:
+                lines.append('{}{{template="{}",status="{}"}} {}'.format(name, summary['template'], summary['status'],
+                                                                         summary[key]))
+        lines.append('# HELP cris_export_latency_seconds Latency of the requests to CRIS.')
+        lines.append('# TYPE cris_export_latency_seconds gauge')
+        for summary in summaries:
+            for percentile in PERCENTILES:
+                latency = summary['latency_seconds']['p' + str(percentile)]
+                if latency is not None:
+                    lines.append('cris_export_latency_seconds{{template="{}",quantile="{}"}} {}'.format(
+                        summary['template'], percentile / 100, latency))
+        lines.append('# HELP cris_export_finished_timestamp_seconds Time the export finished.')
+        lines.append('# TYPE cris_export_finished_timestamp_seconds gauge')
+        for summary in summaries:
+            lines.append('cris_export_finished_timestamp_seconds{{template="{}",status="{}"}} {}'.format(
+                summary['template'], summary['status'], summary['finished'].timestamp()))
+
+        temporary_location = str(location) + '.tmp'
+        with open(temporary_location, 'w') as textfile:
+            textfile.write('\n'.join(lines) + '\n')
+        os.replace(temporary_location, location)
+
+    @staticmethod
+    def __percentile(values: list, percentile: int):
+        """
+        Nearest-rank percentile of sorted values.
+        :param values: sorted values
+        :param percentile: percentile between 0 and 100
+        :return: percentile or None without values
+        """
+        if not values:
+            return None
+        return values[max(math.ceil(percentile / 100 * len(values)) - 1, 0)]
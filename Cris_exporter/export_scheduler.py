@@ -0,0 +1,167 @@
+import os
+import pathlib
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from os import path
+from re import findall
+
+from graphql_exporter import GraphqlExporter
+from graphql_list_exporter import GraphqlListExporter
+from graphql_connenction_exporter import GraphqlConnectionExporter
+from graphql_organisation_hierarchy_exporter import GraphqlOrganisationHierarchyExporter
+
+
+class ExportTask:
+    """
+    Export of one query template together with the collection it writes and the collections it reads.
+    """
+
+    def __init__(self, name: str, exporter_class, query_template_location: os.PathLike, produces: str,
+                 depends_on: list, exporter_arguments: dict = None):
+        """
+        Constructor.
+        :param name: name of the task, the file name of the query template
+        :param exporter_class: exporter class that exports the template
+        :param query_template_location: path to the query template
+        :param produces: collection written by the export
+        :param depends_on: collections that have to be exported before the export can start
+        :param exporter_arguments: keyword arguments the exporter is created with
+        """
+        self.name = name
+        self.exporter_class = exporter_class
+        self.query_template_location = query_template_location
+        self.produces = produces
+        self.depends_on = depends_on
+        self.exporter_arguments = exporter_arguments if exporter_arguments else {}
+
+    def run(self):
+        """
+        Create the exporter and run the export. Exporters are created here because
+        connection exporters read their source collection when they are created.
+        """
+        print("Start export of " + self.name)
+        exporter = self.exporter_class(self.query_template_location, **self.exporter_arguments)
+        try:
+            exporter.export()
+        except Exception as error:
+            exporter.save_metrics('failed', error)
+            raise
+        exporter.save_metrics()
+        print("Finished export of " + self.name)
+
+    def rebuild(self, snapshot_locations: list):
+        """
+        Create the exporter for a rebuild, which leaves the database and the archive untouched, and rebuild its
+        collection from an archived snapshot instead of exporting from CRIS.
+        :param snapshot_locations: paths to the segments of the snapshot of the query template
+        """
+        print("Start rebuild of " + self.name)
+        exporter = self.exporter_class(self.query_template_location, rebuild=True, **self.exporter_arguments)
+        exporter.rebuild(snapshot_locations)
+        print("Finished rebuild of " + self.name)
+
+
+class ExportScheduler:
+    """
+    Runs the exports of all query templates in dependency order: lists first, then the connections of a list as
+    soon as the list is exported and the organisation hierarchy once the organisations are exported.
+    Exports whose dependencies are met run concurrently, the number of requests in flight is limited globally
+    by GraphqlExporter.REQUEST_BUDGET.
+    """
+
+    MAX_PARALLEL_EXPORTS = int(os.getenv("CRISETL_MAX_PARALLEL_EXPORTS", 4))
+
+    def __init__(self, graphql_queries_folder: os.PathLike = None, max_parallel_exports: int = None,
+                 concurrency: int = None, batch_size: int = None):
+        """
+        Constructor.
+        :param graphql_queries_folder: folder with the query templates, defaults to the queries folder
+        :param max_parallel_exports: number of exports that may run at the same time
+        :param concurrency: number of requests each connection export sends at the same time,
+                            defaults to CRISETL_CONNECTION_CONCURRENCY
+        :param batch_size: number of ids combined into one request of a connection export,
+                           defaults to CRISETL_CONNECTION_BATCH_SIZE
+        """
+        if graphql_queries_folder is None:
+            graphql_queries_folder = os.path.join(path.dirname(path.realpath(__file__)), 'queries')
+        self.graphql_queries_folder = graphql_queries_folder
+        self.max_parallel_exports = max_parallel_exports if max_parallel_exports else self.MAX_PARALLEL_EXPORTS
+        self.connection_arguments = {'concurrency': concurrency, 'batch_size': batch_size}
+        self.tasks = self.make_tasks()
+
+    def make_tasks(self):
+        """
+        Create a task for every query template and read its dependencies from the template.
+        :return: list of tasks
+        """
+        tasks = []
+        for query_template in sorted(pathlib.Path(self.graphql_queries_folder).glob('**/*')):
+            filename = query_template.name
+            if "get_" not in filename:
+                continue
+            with open(query_template, 'r') as template_file:
+                template = template_file.read()
+            if "hierarchy" in filename:
+                depends_on = [] if GraphqlOrganisationHierarchyExporter.ROOT_ORGANISATION_IDS else ['organisation']
+                tasks.append(ExportTask(filename, GraphqlOrganisationHierarchyExporter, query_template,
+                                        'organisation_organisation', depends_on))
+            elif "connection" in filename:
+                from_collection_name = findall(GraphqlConnectionExporter.GRAPHQL_CONNECTION_REGEX, template)[0]
+                to_collection_name = findall(GraphqlExporter.GRAPHQL_TO_REGEX, template)[0].replace("List", '')
+                depends_on = [from_collection_name]
+                if GraphqlConnectionExporter.SCOPED:  # scoped exports read their ids from the hierarchy
+                    depends_on += GraphqlConnectionExporter.SCOPE_COLLECTIONS.get(from_collection_name, [])
+                tasks.append(ExportTask(filename, GraphqlConnectionExporter, query_template,
+                                        from_collection_name + "_" + to_collection_name, depends_on,
+                                        self.connection_arguments))
+            else:
+                db_collection = findall(GraphqlExporter.GRAPHQL_TO_REGEX, template)[0].replace("List", '')
+                tasks.append(ExportTask(filename, GraphqlListExporter, query_template, db_collection, []))
+        self.check_dependencies(tasks)
+        # start exports that other exports wait for first, so the longest dependency chain starts early
+        dependents = {task.name: len([other for other in tasks if task.produces in other.depends_on]) for task in tasks}
+        return sorted(tasks, key=lambda task: -dependents[task.name])
+
+    @staticmethod
+    def check_dependencies(tasks: list):
+        """
+        Make sure that every collection a task depends on is produced by another task.
+        :param tasks: list of tasks
+        :return: None
+        """
+        produced_collections = {task.produces for task in tasks}
+        for task in tasks:
+            missing_collections = [collection for collection in task.depends_on
+                                   if collection not in produced_collections]
+            if missing_collections:
+                raise ValueError("The export " + task.name + " depends on " + ", ".join(missing_collections) +
+                                 " which is not exported by any query template")
+
+    def run(self):
+        """
+        Run all tasks. A task starts as soon as all collections it depends on are exported.
+        If a task fails, no further tasks are started and the error is raised after the running tasks finished.
+        :return: None
+        """
+        pending_tasks = list(self.tasks)
+        exported_collections = set()
+        running = {}
+        error = None
+        with ThreadPoolExecutor(max_workers=self.max_parallel_exports) as executor:
+            while pending_tasks or running:
+                if error is None:
+                    for task in [task for task in pending_tasks
+                                 if all(collection in exported_collections for collection in task.depends_on)]:
+                        pending_tasks.remove(task)
+                        running[executor.submit(task.run)] = task
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    task = running.pop(future)
+                    if future.exception() is not None:
+                        print("Export of " + task.name + " failed: " + repr(future.exception()))
+                        error = error or future.exception()
+                    else:
+                        exported_collections.add(task.produces)
+        if error is not None:
+            raise error
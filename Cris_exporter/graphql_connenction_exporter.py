@@ -1,18 +1,55 @@
+import asyncio
 import os
+import socket
+import time
+from datetime import datetime, timedelta, timezone
+from delta_export import DeltaExport
 import pymongo as pm
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+from export_metrics import RUN_ID
 from graphql_exporter import GraphqlExporter
+from graphql_organisation_hierarchy_exporter import GraphqlOrganisationHierarchyExporter
 from re import findall
 
 
 class GraphqlConnectionExporter(GraphqlExporter):
     GRAPHQL_CONNECTION_REGEX = "([A-Za-z].+)\(id:"  # Example https://regex101.com/r/tt4tJG/1
+    CONCURRENCY = int(os.getenv("CRISETL_CONNECTION_CONCURRENCY", 1))
+    BATCH_SIZE = int(os.getenv("CRISETL_CONNECTION_BATCH_SIZE", 1))
+    LEASES = os.getenv("CRISETL_CONNECTION_LEASES", 'false').lower() == 'true'
+    LEASE_SECONDS = int(os.getenv("CRISETL_LEASE_SECONDS", 300))
+    LEASE_SHARD_SIZE = int(os.getenv("CRISETL_LEASE_SHARD_SIZE", 100))
+    WORKER_ID = os.getenv("CRISETL_WORKER_ID", socket.gethostname() + '-' + str(os.getpid()))
+    INLINE_MARKER_ID = 'inline'  # marks an exporter collection of follow-ups left by a list export with connections
+    SCOPED = os.getenv("CRISETL_SCOPED_CONNECTIONS", 'false').lower() == 'true'
+    # collections the ids of a scoped export are read from, by source collection
+    SCOPE_COLLECTIONS = {'organisation': ['organisation_organisation'],
+                         'person': ['organisation_organisation', 'organisation_persons']}
 
-    def __init__(self, query_template_location: os.PathLike):
+    def __init__(self, query_template_location: os.PathLike, concurrency: int = None, batch_size: int = None,
+                 leases: bool = None, scoped: bool = None, root_organisation_ids: list = None,
+                 rebuild: bool = False):
         """
         Prepare the exporter by setting creating a GraphqlExporter.
         :param query_template_location:
+        :param concurrency: number of requests that are sent at the same time, 1 sends them one after another
+        :param batch_size: number of ids that are combined into one query by field aliases
+        :param leases: share the export with other processes by leasing shards of ids from the lease collection,
+                       defaults to CRISETL_CONNECTION_LEASES
+        :param scoped: only export the connections of the organisations below the root organisations and of their
+                       members instead of all ids of the source collection, defaults to CRISETL_SCOPED_CONNECTIONS
+        :param root_organisation_ids: roots of the scope, defaults to CRISETL_ORGANISATION_ROOT_IDS
+        :param rebuild: create the exporter only to rebuild the connections from the archive, without seeding the
+                        exporter collection
         """
-        super().__init__(query_template_location)
+        super().__init__(query_template_location, rebuild=rebuild)
+        self.concurrency = concurrency if concurrency else self.CONCURRENCY
+        self.batch_size = batch_size if batch_size else self.BATCH_SIZE
+        self.leases = self.LEASES if leases is None else leases
+        self.scoped = self.SCOPED if scoped is None else scoped
+        self.root_organisation_ids = root_organisation_ids if root_organisation_ids \
+            else GraphqlOrganisationHierarchyExporter.ROOT_ORGANISATION_IDS
         self.id_to_export = None
         self.after_cursor = None
         self.has_next_page = True
@@ -27,8 +64,17 @@ class GraphqlConnectionExporter(GraphqlExporter):
         json_list_name = str(db_collection[0])
         self.to_collection_name = json_list_name.replace("List", '')
         self.collection_name = self.from_collection_name + "_" + self.to_collection_name
+        self.from_key = self.from_collection_name + '_id'
+        self.to_key = self.to_collection_name[:-1] + '_id'
         self.exporter_collection_name = 'exporter_' + self.collection_name
-        self.__make_exporter_collection()
+        self.lease_collection_name = 'leases_' + self.collection_name
+        self.metrics.collection_name = self.collection_name
+        if self.scoped and self.from_collection_name not in self.SCOPE_COLLECTIONS:
+            raise ValueError("The connections of " + self.from_collection_name + " cannot be scoped to organisations")
+        if self.scoped and not self.root_organisation_ids:
+            raise ValueError("Set CRISETL_ORGANISATION_ROOT_IDS to scope the connection export")
+        if not self.leases and not self.rebuilding:
+            self.__make_exporter_collection()
 
     def __make_exporter_collection(self):
         """
@@ -40,67 +86,412 @@ class GraphqlConnectionExporter(GraphqlExporter):
         if self.exporter_collection_name in database.list_collection_names():
             exporter_ids = list(database[self.exporter_collection_name].find({}, {"id": 1, "_id": 0}))
             if len(exporter_ids) == 0:
-                from_collection_ids = list(database[self.from_collection_name].find({}, {"id": 1, "_id": 0}))
+                from_collection_ids = self.__find_from_ids(database)
                 database[self.exporter_collection_name].insert_many(from_collection_ids)
         else:
-            from_collection_ids = list(database[self.from_collection_name].find({}, {"id": 1, "_id": 0}))
+            self.start_archive()
+            from_collection_ids = self.__find_from_ids(database)
             database[self.exporter_collection_name].insert_many(from_collection_ids)
             database[self.collection_name].delete_many({})
         mongodb_instance.close()
+        self.create_indexes()  # the unique index keeps pages that are fetched again after a resume from duplicating
+
+    def __find_from_ids(self, database):
+        """
+        Find the ids whose connections are exported: all ids of the source collection or, in scoped mode, the
+        organisations below the root organisations in organisation_organisation or their members in
+        organisation_persons. Ids that were marked as deleted are left out.
+        :param database: database of the Data Lake
+        :return: list of dicts with the id
+        """
+        if not self.scoped:
+            return list(database[self.from_collection_name].find(DeltaExport.not_deleted(), {"id": 1, "_id": 0}))
+        children = {}
+        for document in database['organisation_organisation'].find({}, {"organisation_id": 1,
+                                                                        "child_organisation_id": 1, "_id": 0}):
+            children.setdefault(document['organisation_id'], []).append(document['child_organisation_id'])
+        organisation_ids = [str(organisation_id) for organisation_id in self.root_organisation_ids]
+        visited_ids = set(organisation_ids)
+        for organisation_id in organisation_ids:  # the list grows while it is walked, breadth-first
+            for child_organisation_id in children.get(organisation_id, []):
+                if child_organisation_id not in visited_ids:
+                    visited_ids.add(child_organisation_id)
+                    organisation_ids.append(child_organisation_id)
+        if self.from_collection_name == 'organisation':
+            from_ids = organisation_ids
+        else:
+            from_ids = sorted(database['organisation_persons'].distinct(
+                'person_id', {'organisation_id': {'$in': organisation_ids}}))
+        deleted_ids = set(database[self.from_collection_name].distinct('id', {'deleted': True}))
+        from_ids = [from_id for from_id in from_ids if from_id not in deleted_ids]
+        print("Scope " + self.collection_name + " to " + str(len(from_ids)) + " ids below " +
+              ", ".join(str(organisation_id) for organisation_id in self.root_organisation_ids))
+        return [{'id': from_id} for from_id in from_ids]
 
     def export(self):
         """
         Export connections of the GraphQL list and inserts them into the database.
+        With leases the export is seeded, or joined if another process seeded it, and the method returns once
+        every shard is exported and the indexes are built.
         :return: None
         """
-        exporter_collection_name = 'exporter_' + self.collection_name
+        if self.leases:
+            try:
+                self.run(self.__export_with_leases(seed=True))
+            finally:
+                self.close_session()
+            return
+        if self.concurrency > 1 or self.batch_size > 1:
+            self.run(self.__export_concurrently())
+            self.close_session()
+            self.__drop_exporter_collection()
+            self.create_indexes()
+            return
+
+        # one client for all ids, the pages are written and the exported ids removed through it
         mongodb_instance = pm.MongoClient(self.MONGODB_URI, serverSelectionTimeoutMS=300000)
         database = mongodb_instance[self.DATABASE]
-        from_ids = list(database[exporter_collection_name].find({}, {"id": 1, "_id": 0}))
-        mongodb_instance.close()
-
-        for id_dict in from_ids:
-            self.has_next_page = True
-            self.after_cursor = None
-            self.id_to_export = id_dict['id']
-            while self.has_next_page:
-                self.__export_page()
-            mongodb_instance = pm.MongoClient(self.MONGODB_URI, serverSelectionTimeoutMS=300000)
-            database = mongodb_instance[self.DATABASE]
-            database[exporter_collection_name].delete_one({"id": self.id_to_export})
+        try:
+            from_ids = list(database[self.exporter_collection_name].find({"id": {"$exists": True}},
+                                                                         {"id": 1, "after_cursor": 1, "_id": 0}))
+            for id_dict in from_ids:
+                self.has_next_page = True
+                self.after_cursor = id_dict.get('after_cursor')
+                self.id_to_export = id_dict['id']
+                while self.has_next_page:
+                    self.__export_page(database[self.collection_name])
+                database[self.exporter_collection_name].delete_one({"id": self.id_to_export})
+        finally:
+            mongodb_instance.close()
+            self.close_session()
         self.__drop_exporter_collection()
         self.create_indexes()
 
-    def __export_page(self):
+    def __export_page(self, collection):
         """
         Export one page of the list.
-        :return: list of documents
+        :param collection: connection collection the page is written to
+        :return: None
+        """
+        result = self.execute_graphql_query(self.query_template, self.after_cursor,
+                                            {self.from_collection_name: self.id_to_export},
+                                            self.__make_connection_variables(self.id_to_export, self.after_cursor))
+        documents, self.after_cursor, self.has_next_page = self.__parse_connection_page(
+            self.id_to_export, result[self.from_collection_name])
+        if documents:
+            self.__write_connections(collection, documents)
+
+    async def __export_concurrently(self):
+        """
+        Export the ids of the exporter collection with up to `concurrency` requests of `batch_size` ids in flight
+        at once. All requests share one aiohttp session. Every page is written as soon as it arrives and an id is
+        only removed from the exporter collection after its last page has been written.
+        :return: None
+        """
+        mongodb_instance = pm.MongoClient(self.MONGODB_URI, serverSelectionTimeoutMS=300000)
+        database = mongodb_instance[self.DATABASE]
+        from_ids = asyncio.Queue()
+        for id_dict in database[self.exporter_collection_name].find({"id": {"$exists": True}},
+                                                                    {"id": 1, "after_cursor": 1, "_id": 0}):
+            from_ids.put_nowait((id_dict['id'], id_dict.get('after_cursor')))
+
+        await self.get_session()  # connect once before the workers share the session
+        workers = [asyncio.create_task(self.__export_worker(database, from_ids, self.exporter_collection_name))
+                   for _ in range(self.concurrency)]
+        await asyncio.gather(*workers)
+        mongodb_instance.close()
+
+    async def __export_worker(self, database, from_ids: asyncio.Queue, exporter_collection_name: str = None):
+        """
+        Export ids from the queue until it is empty. The worker keeps a batch of ids and requests the next page of
+        all of them in one query. Ids with more pages stay in the batch, finished ids are replaced from the queue.
+        :param database: data lake database
+        :param from_ids: queue of ids that still have to be exported and the cursors to continue after
+        :param exporter_collection_name: collection finished ids are removed from
+        :return: None
+        """
+        after_cursors = {}
+        while after_cursors or not from_ids.empty():
+            while len(after_cursors) < self.batch_size and not from_ids.empty():
+                from_id, after_cursor = from_ids.get_nowait()
+                after_cursors[from_id] = after_cursor
+            batch = list(after_cursors.items())
+            aliases = ['c' + str(index) for index in range(len(batch))]
+            result = await self.execute_graphql_query_async(
+                self.make_aliased_query(self.query_template, aliases),
+                {alias: after_cursor for alias, (_, after_cursor) in zip(aliases, batch)},
+                {alias: from_id for alias, (from_id, _) in zip(aliases, batch)},
+                self.make_aliased_variables({alias: self.__make_connection_variables(from_id, after_cursor)
+                                             for alias, (from_id, after_cursor) in zip(aliases, batch)}))
+            documents = []
+            finished_ids = []
+            for index, (from_id, _) in enumerate(batch):
+                page_documents, after_cursor, has_next_page = self.__parse_connection_page(
+                    from_id, result['c' + str(index)])
+                documents.extend(page_documents)
+                if has_next_page:
+                    after_cursors[from_id] = after_cursor
+                else:
+                    finished_ids.append(from_id)
+                    del after_cursors[from_id]
+            if documents:
+                await asyncio.to_thread(self.__write_connections, database[self.collection_name], documents)
+            if finished_ids and exporter_collection_name:
+                await asyncio.to_thread(database[exporter_collection_name].delete_many,
+                                        {"id": {"$in": finished_ids}})
+
+    def join_export(self):
+        """
+        Help with an export that another process seeded with leases, e.g. in an additional worker container.
+        Workers of the same export have to share CRISETL_RUN_ID.
+        :return: True once the export of the run is finalised, False if it is not seeded yet or other workers
+                 still hold leases, so the caller should try again later
+        """
+        try:
+            return self.run(self.__export_with_leases(seed=False))
+        finally:
+            self.close_session()
+
+    async def __export_with_leases(self, seed: bool):
+        """
+        Export shards of ids leased from the lease collection until no shard is left.
+        The lease collection holds a state document and one document per shard of LEASE_SHARD_SIZE ids. A worker
+        leases a shard with findOneAndUpdate for LEASE_SECONDS and renews the lease while it exports the shard.
+        Shards whose lease expired, e.g. because their worker died, are leased again by the next worker.
+        The worker that finds every shard done builds the indexes and marks the export as finalised. If it dies
+        while finalising, the next worker takes over once its lease expired.
+        :param seed: seed the shards if the run has not been seeded yet and wait until the export is finalised
+        :return: True once the export is finalised
+        """
+        mongodb_instance = pm.MongoClient(self.MONGODB_URI, serverSelectionTimeoutMS=300000)
+        database = mongodb_instance[self.DATABASE]
+        leases = database[self.lease_collection_name]
+        try:
+            while True:
+                state = await asyncio.to_thread(self.__join_run, database, leases, seed)
+                if state is not None and state['state'] == 'finalised' and state['run_id'] == RUN_ID:
+                    return True
+                if state is not None and state['state'] == 'exporting':
+                    await self.get_session()
+                    shard = await asyncio.to_thread(self.__lease_shard, leases)
+                    while shard is not None:
+                        await self.__export_shard(database, leases, shard)
+                        shard = await asyncio.to_thread(self.__lease_shard, leases)
+                if state is not None and state['state'] in ('exporting', 'finalising'):
+                    if await asyncio.to_thread(self.__finalise, leases):
+                        return True
+                if not seed:
+                    return False
+                await asyncio.sleep(min(self.LEASE_SECONDS / 3, 5))
+        finally:
+            mongodb_instance.close()
+
+    def __join_run(self, database, leases, seed: bool):
+        """
+        Read the state of the export and seed the shards if this worker may seed and the export of the run has not
+        been seeded, e.g. because the last export was finalised in an earlier run or its seeding worker died.
+        An export of an earlier run that was not finalised is continued as this run instead of seeded again.
+        Workers that do not seed only join the export of their own run.
+        :param database: data lake database
+        :param leases: lease collection
+        :param seed: seed the shards if necessary
+        :return: state document or None if the export is not seeded
+        """
+        state = leases.find_one({'_id': 'state'})
+        if not seed:
+            if state is None or state['run_id'] != RUN_ID:
+                return None
+            return state
+
+        now = datetime.now(timezone.utc)
+        seeding = {'$set': {'run_id': RUN_ID, 'state': 'seeding', 'owner': self.WORKER_ID,
+                            'lease_expires': now + timedelta(seconds=self.LEASE_SECONDS)}}
+        try:
+            state = leases.find_one_and_update(
+                {'_id': 'state', '$or': [{'state': 'finalised', 'run_id': {'$ne': RUN_ID}},
+                                         {'state': 'seeding', 'lease_expires': {'$lt': now}}]},
+                seeding, upsert=state is None, return_document=ReturnDocument.AFTER)
+        except DuplicateKeyError:  # another worker created the state document first
+            state = None
+        if state is None or state['owner'] != self.WORKER_ID or state['state'] != 'seeding':
+            state = leases.find_one({'_id': 'state'})
+            if state is not None and state['state'] in ('exporting', 'finalising') and state['run_id'] != RUN_ID:
+                print("Continue the export of " + self.collection_name + " of run " + state['run_id'] + " as run " +
+                      RUN_ID)
+                state = leases.find_one_and_update({'_id': 'state', 'run_id': state['run_id']},
+                                                   {'$set': {'run_id': RUN_ID}},
+                                                   return_document=ReturnDocument.AFTER)
+            return state
+
+        print("Seed shards of " + self.collection_name + " for run " + RUN_ID)
+        leases.delete_many({'shard': {'$exists': True}})
+        inline_marker = database[self.exporter_collection_name].find_one({'_id': self.INLINE_MARKER_ID})
+        if not inline_marker:
+            self.start_archive()
+        if inline_marker:  # only follow up on the ids the list export could not harvest completely
+            from_ids = list(database[self.exporter_collection_name].find({"id": {"$exists": True}},
+                                                                         {"id": 1, "after_cursor": 1, "_id": 0}))
+        else:
+            from_ids = self.__find_from_ids(database)
+        shards = []
+        for number, start in enumerate(range(0, len(from_ids), self.LEASE_SHARD_SIZE)):
+            shard_ids = from_ids[start:start + self.LEASE_SHARD_SIZE]
+            shards.append({'shard': number, 'ids': [id_dict['id'] for id_dict in shard_ids],
+                           'after_cursors': [id_dict.get('after_cursor') for id_dict in shard_ids], 'done': False,
+                           'attempts': 0, 'lease_owner': None,
+                           'lease_expires': datetime.fromtimestamp(0, timezone.utc)})
+        if shards:
+            leases.insert_many(shards)
+        leases.create_index([('done', pm.ASCENDING), ('lease_expires', pm.ASCENDING)])
+        if not inline_marker:
+            database[self.collection_name].delete_many({})
+        self.create_indexes()
+        return leases.find_one_and_update({'_id': 'state', 'owner': self.WORKER_ID},
+                                          {'$set': {'state': 'exporting', 'shards': len(shards)}},
+                                          return_document=ReturnDocument.AFTER)
+
+    def __lease_shard(self, leases):
+        """
+        Lease a shard that is not done and not leased, or whose lease expired.
+        :param leases: lease collection
+        :return: shard document or None if there is none
+        """
+        now = datetime.now(timezone.utc)
+        return leases.find_one_and_update(
+            {'shard': {'$exists': True}, 'done': False, 'lease_expires': {'$lt': now}},
+            {'$set': {'lease_owner': self.WORKER_ID, 'lease_expires': now + timedelta(seconds=self.LEASE_SECONDS)},
+             '$inc': {'attempts': 1}},
+            sort=[('shard', pm.ASCENDING)], return_document=ReturnDocument.AFTER)
+
+    async def __export_shard(self, database, leases, shard: dict):
+        """
+        Export the ids of a leased shard while a heartbeat renews the lease, then mark the shard as done.
+        If a previous lease holder gave up the shard, its ids are exported again from their first page, the
+        connections it already wrote are not duplicated thanks to the unique index. If the heartbeat loses the lease
+        to another worker, the export of the shard is stopped and the shard is left to that worker.
+        :param database: data lake database
+        :param leases: lease collection
+        :param shard: shard document
+        :return: None
+        """
+        after_cursors = shard['after_cursors']
+        if shard['attempts'] > 1:
+            after_cursors = [None] * len(shard['ids'])
+        from_ids = asyncio.Queue()
+        for from_id, after_cursor in zip(shard['ids'], after_cursors):
+            from_ids.put_nowait((from_id, after_cursor))
+        workers = asyncio.gather(*[self.__export_worker(database, from_ids) for _ in range(self.concurrency)])
+        heartbeat = asyncio.create_task(self.__renew_lease(leases, shard['_id'], workers))
+        try:
+            await workers
+        except asyncio.CancelledError:
+            if heartbeat.done() and not heartbeat.cancelled():  # the heartbeat lost the lease and stopped the workers
+                return
+            raise
+        finally:
+            heartbeat.cancel()
+        await asyncio.to_thread(leases.update_one, {'_id': shard['_id'], 'lease_owner': self.WORKER_ID},
+                                {'$set': {'done': True}})
+
+    async def __renew_lease(self, leases, shard_id, workers: asyncio.Future):
+        """
+        Renew the lease of a shard every third of LEASE_SECONDS until cancelled. If another worker leased the shard
+        in the meantime, the workers exporting it are cancelled, so they stop writing a shard they no longer own.
+        :param leases: lease collection
+        :param shard_id: _id of the shard document
+        :param workers: future of the workers exporting the shard
+        :return: None
+        """
+        while True:
+            await asyncio.sleep(self.LEASE_SECONDS / 3)
+            result = await asyncio.to_thread(
+                leases.update_one, {'_id': shard_id, 'lease_owner': self.WORKER_ID},
+                {'$set': {'lease_expires': datetime.now(timezone.utc) + timedelta(seconds=self.LEASE_SECONDS)}})
+            if result.matched_count == 0:
+                print("Lost the lease of a shard of " + self.collection_name + " to another worker, stop exporting it")
+                workers.cancel()
+                return
+
+    def __finalise(self, leases):
+        """
+        Build the indexes and mark the export as finalised if every shard is done and no other worker is
+        finalising it.
+        :param leases: lease collection
+        :return: True if the export is finalised
+        """
+        if leases.count_documents({'shard': {'$exists': True}, 'done': False}) > 0:
+            return False
+        now = datetime.now(timezone.utc)
+        state = leases.find_one_and_update(
+            {'_id': 'state', 'run_id': RUN_ID,
+             '$or': [{'state': 'exporting'}, {'state': 'finalising', 'lease_expires': {'$lt': now}}]},
+            {'$set': {'state': 'finalising', 'owner': self.WORKER_ID,
+                      'lease_expires': now + timedelta(seconds=self.LEASE_SECONDS)}},
+            return_document=ReturnDocument.AFTER)
+        if state is None:
+            state = leases.find_one({'_id': 'state'})
+            return state['state'] == 'finalised' and state['run_id'] == RUN_ID
+        print("Finalise export of " + self.collection_name)
+        self.create_indexes()
+        self.__drop_exporter_collection()
+        leases.delete_many({'shard': {'$exists': True}})
+        leases.update_one({'_id': 'state'}, {'$set': {'state': 'finalised', 'run_id': RUN_ID,
+                                                      'finished': datetime.now(timezone.utc)}})
+        return True
+
+    def __parse_connection_page(self, from_id, from_object: dict):
+        """
+        Turn one page of connections into documents.
+        :param from_id: id of the object the connections belong to
+        :param from_object: object of the connection query, i.e. the result under the name or alias of the root field
+        :return: documents, cursor of the last connection and the has_next_page flag
         """
         documents = []
-        query = self.__make_connection_query()
-        result = self.execute_graphql_query(query)
-        self.after_cursor = result[self.from_collection_name]['connections'][self.to_collection_name]['pageInfo'][
-            'endCursor']
-        self.has_next_page = result[self.from_collection_name]['connections'][self.to_collection_name]['pageInfo'][
-            'hasNextPage']
-        connections = result[self.from_collection_name]['connections'][self.to_collection_name]['edges']
-        for connection in connections:
+        if not from_object or not from_object['connections'] or not from_object['connections'][self.to_collection_name]:
+            return documents, None, False
+        page = from_object['connections'][self.to_collection_name]
+        for connection in page['edges']:
             to_id = connection['node']['id']
-            document = {self.from_collection_name + '_id': self.id_to_export, self.to_collection_name[:-1] + '_id': to_id}
+            document = {self.from_key: from_id, self.to_key: to_id}
             documents.append(document)
-        self.insert_documents(self.DATABASE, self.collection_name, documents)
+        return documents, page['pageInfo']['endCursor'], page['pageInfo']['hasNextPage']
 
-    def __make_connection_query(self):
+    def parse_archived_page(self, page: dict):
+        """
+        Turn a page of the archive into documents. The context of the page maps the name or alias of each root field
+        to the id whose connections it holds. The pages of the list the connections were harvested from inline are
+        read as well, its list pages have no context and no connections.
+        :param page: record of PageArchive
+        :return: list of documents
         """
-        Create the queries to fetch connections from graphql.
+        documents = []
+        for field_name, from_id in (page['context'] or {}).items():
+            page_documents, _, _ = self.__parse_connection_page(from_id, page['result'][field_name])
+            documents.extend(page_documents)
+        return documents
 
-        :return: graphQL query as string
+    def rebuild(self, snapshot_locations: list):
         """
-        query = self.make_pagination_query(self.after_cursor)
-        query = query.replace(
-            'id: ""', 'id: "{}"'.format(str(self.id_to_export))
-        )
-        return query
+        Replace the connections with the documents of an archived snapshot, without requests to CRIS.
+        :param snapshot_locations: paths to the segments of the snapshot, see PageArchive.segments
+        :return: None
+        """
+        self.rebuild_collection(snapshot_locations, self.collection_name, self.index_models(),
+                                lambda document: (document[self.from_key], document[self.to_key]))
+        self.__drop_exporter_collection()
+        self.create_indexes()
+
+    def __make_connection_variables(self, from_id, after_cursor: str = None):
+        """
+        Create the variables of the query that fetches connections from graphql.
+
+        :param from_id: id of the object whose connections are fetched
+        :param after_cursor: cursor of the last connection that is returned
+        :return: variable values
+        """
+        variable_values = self.make_pagination_variables(after_cursor)
+        variable_values['id'] = str(from_id)
+        return variable_values
 
     def __drop_exporter_collection(self):
         """
@@ -113,13 +504,65 @@ class GraphqlConnectionExporter(GraphqlExporter):
             database[self.exporter_collection_name].drop()
         mongodb_instance.close()
 
+    def __write_connections(self, collection, documents: list):
+        """
+        Write connections with unordered bulk upserts on both sides of the connection, so connections that are
+        already stored, e.g. pages fetched again after a resume or by another worker, are not duplicated.
+        :param collection: connection collection
+        :param documents: connection documents
+        :return: None
+        """
+        print("Upsert " + str(len(documents)) + " documents into collection: " + str(self.collection_name))
+        started = time.monotonic()
+        requests = [UpdateOne({self.from_key: document[self.from_key], self.to_key: document[self.to_key]},
+                              {'$setOnInsert': document}, upsert=True) for document in documents]
+        try:
+            collection.bulk_write(requests, ordered=False)
+        except BulkWriteError as error:  # concurrent upserts of the same connection, one of them wins
+            write_errors = error.details['writeErrors']
+            if error.details.get('writeConcernErrors') or any(
+                    write_error['code'] != 11000 for write_error in write_errors):
+                raise
+        self.metrics.record_write(len(documents), time.monotonic() - started)
+
+    def index_models(self):
+        """
+        Indexes of the collection, a unique index on both sides of the connection, which also serves queries by the
+        source id, and one on the target id.
+        :return: list of pymongo IndexModels
+        """
+        return [pm.IndexModel([(self.from_key, pm.ASCENDING), (self.to_key, pm.ASCENDING)], unique=True),
+                pm.IndexModel([(self.to_key, pm.ASCENDING)])]
+
     def create_indexes(self):
         """
-        Create indexes for the collection.
+        Create indexes for the collection. If duplicates of an earlier export prevent the unique index, they are
+        removed first.
         :return:
         """
         mongodb_instance = pm.MongoClient(self.MONGODB_URI, serverSelectionTimeoutMS=300000)
         database = mongodb_instance[self.DATABASE]
-        database[self.collection_name].create_index([(self.from_collection_name + '_id', pm.ASCENDING)])
-        database[self.collection_name].create_index([(self.to_collection_name[:-1] + '_id', pm.ASCENDING)])
-        mongodb_instance.close()
\ No newline at end of file
+        try:
+            database[self.collection_name].create_indexes(self.index_models())
+        except OperationFailure as error:
+            if error.code != 11000:
+                raise
+            self.__remove_duplicates(database[self.collection_name])
+            database[self.collection_name].create_indexes(self.index_models())
+        mongodb_instance.close()
+
+    def __remove_duplicates(self, collection):
+        """
+        Keep one document of every connection that is stored more than once.
+        :param collection: connection collection
+        :return: None
+        """
+        duplicates = collection.aggregate([
+            {'$group': {'_id': {'from': '$' + self.from_key, 'to': '$' + self.to_key},
+                        'ids': {'$push': '$_id'}, 'count': {'$sum': 1}}},
+            {'$match': {'count': {'$gt': 1}}},
+        ], allowDiskUse=True)
+        duplicate_ids = [document_id for duplicate in duplicates for document_id in duplicate['ids'][1:]]
+        for start in range(0, len(duplicate_ids), 10000):
+            collection.delete_many({'_id': {'$in': duplicate_ids[start:start + 10000]}})
+        print("Removed " + str(len(duplicate_ids)) + " duplicate connections from " + self.collection_name)
\ No newline at end of file
@@ -1,82 +1,384 @@
+import asyncio
+import json
+from abc import ABC, abstractmethod
 import os
+import re
 import time
 import pymongo as pm
 from gql import gql, Client
 from gql.transport.aiohttp import AIOHTTPTransport
+from graphql import (DocumentNode, FieldNode, NameNode, OperationDefinitionNode, OperationType, SelectionSetNode,
+                     VariableNode, Visitor, build_schema, print_ast, validate, visit)
+from export_errors import FatalExportError, classify_error
+from export_metrics import ExportMetrics
+from mongo_page_writer import MongoPageWriter
+from page_archive import PageArchive
+from page_sizer import AdaptivePageSizer
+from query_compiler import FULL_PROFILE, QueryCompiler
+from rate_limiter import AdaptiveRateLimiter
+from request_budget import RequestBudget
 
 
-class GraphqlExporter:
+class VariableAliaser(Visitor):
+    """
+    Prefixes every variable of a query with an alias, e.g. $id becomes $c0_id, so that copies of the query can be
+    combined into one query with make_aliased_query.
+    """
+
+    def __init__(self, alias: str):
+        """
+        Prepare the visitor.
+        :param alias: alias the variables are prefixed with
+        """
+        super().__init__()
+        self.alias = alias
+
+    def enter_variable(self, node: VariableNode, *_):
+        """
+        Rename a variable.
+        :param node: variable of the query
+        :return: renamed variable
+        """
+        return VariableNode(name=NameNode(value=self.alias + '_' + node.name.value))
+
+
+class GraphqlExporter(ABC):
 
     GRAPHQL_TO_REGEX = "([A-Za-z].+)\(first:"  # Example https://regex101.com/r/JMTXsT/1
+    GRAPHQL_PAGE_SIZE_REGEX = r"(first:\s*)(\d+)(?=\s*,\s*after:\s*\$)"  # the page size of the paginated field
     GRAPHQL_URL = os.getenv("GRAPHQL_URL", 'https://cris-api.uni-muenster.de/')
     MONGODB_URI = os.getenv("CRISETL_ENV_MONGO_URI", 'mongodb://localhost:27017/')
     DATABASE = os.getenv("DATA_LAKE_DB_NAME", 'FLK_Data_Lake')
+    SCHEMA_LOCATION = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'queries', 'schema.graphql')
+    VALIDATE_QUERIES = os.getenv("CRISETL_VALIDATE_QUERIES", 'true').lower() != 'false'
+    REQUEST_BUDGET = RequestBudget(int(os.getenv("CRISETL_MAX_REQUESTS_IN_FLIGHT", 16)))  # shared by all exporters
+    RATE_LIMITER = AdaptiveRateLimiter(rate=float(os.getenv("CRISETL_REQUESTS_PER_SECOND", 10)),
+                                       max_rate=float(os.getenv("CRISETL_MAX_REQUESTS_PER_SECOND", 50)),
+                                       target_latency=float(os.getenv("CRISETL_TARGET_LATENCY", 2.0)))
+    MAX_ATTEMPTS = int(os.getenv("CRISETL_MAX_ATTEMPTS", 10))
+    EXPORT_PROFILE = os.getenv("CRISETL_EXPORT_PROFILE", FULL_PROFILE)
+    ARCHIVE_FOLDER = os.getenv("CRISETL_ARCHIVE_FOLDER")  # archive every fetched page below this folder if set
+    ADAPTIVE_PAGE_SIZE = os.getenv("CRISETL_ADAPTIVE_PAGE_SIZE", 'false').lower() == 'true'
+    MIN_PAGE_SIZE = int(os.getenv("CRISETL_MIN_PAGE_SIZE", 10))
+    MAX_PAGE_SIZE = int(os.getenv("CRISETL_MAX_PAGE_SIZE", 100))  # CRIS rejects more than 100
+    PAGE_TARGET_LATENCY = float(os.getenv("CRISETL_PAGE_TARGET_LATENCY", 5.0))
+    MAX_PAGE_BYTES = int(os.getenv("CRISETL_MAX_PAGE_BYTES", 2 * 1024 * 1024))
+    STAGED_LOAD = os.getenv("CRISETL_STAGED_LOAD", 'false').lower() == 'true'
+
+    schema = None  # GraphQL schema shared by all exporters, loaded or fetched only once
 
-    def __init__(self, query_template_location: os.PathLike):
+    def __init__(self, query_template_location: os.PathLike, validate_queries: bool = None,
+                 export_profile: str = None, adaptive_page_size: bool = None, rebuild: bool = False):
         """
         Prepare the exporter by loading the query template and the collection name.
         :param query_template_location: path to the query template
+        :param validate_queries: validate queries against the schema before sending them, defaults to
+                                 CRISETL_VALIDATE_QUERIES
+        :param export_profile: name of the field manifest in the profiles folder the list templates are compiled
+                               with, e.g. lean. The full profile uses the templates as they are. Defaults to
+                               CRISETL_EXPORT_PROFILE
+        :param adaptive_page_size: adjust the `first:` argument of the template to the response time and size of
+                                   the previous pages, defaults to CRISETL_ADAPTIVE_PAGE_SIZE
+        :param rebuild: create the exporter only to rebuild its collection from the archive, see rebuild_collection.
+                        Nothing is archived and the exporter does not prepare its export in the database.
         """
 
         template_file = open(query_template_location, 'r')
         template_content = template_file.read()
         self.query_template = template_content
         template_file.close()
+        self.validate_queries = self.VALIDATE_QUERIES if validate_queries is None else validate_queries
+        self.export_profile = self.EXPORT_PROFILE if export_profile is None else export_profile
+        if self.export_profile != FULL_PROFILE:
+            compiler = QueryCompiler.from_profile(self.export_profile, self.load_schema())
+            self.query_template = compiler.compile(self.query_template)
+        self.loop = None
+        self.client = None
+        self.session = None
+        self.documents = {}  # prepared documents by query, every query is only parsed and validated once
+        self.aliased_queries = {}  # queries combined by make_aliased_query by template and aliases
+        template_name = os.path.splitext(os.path.basename(query_template_location))[0]
+        self.metrics = ExportMetrics(template_name)
+        self.rebuilding = rebuild
+        self.archive = None
+        if self.ARCHIVE_FOLDER and not self.rebuilding:
+            self.archive = PageArchive(self.ARCHIVE_FOLDER, template_name)
+        self.page_sizer = None
+        page_sizes = re.findall(self.GRAPHQL_PAGE_SIZE_REGEX, self.query_template)
+        if (self.ADAPTIVE_PAGE_SIZE if adaptive_page_size is None else adaptive_page_size) and page_sizes:
+            self.page_sizer = AdaptivePageSizer(int(page_sizes[0][1]), self.MIN_PAGE_SIZE, self.MAX_PAGE_SIZE,
+                                                self.PAGE_TARGET_LATENCY, self.MAX_PAGE_BYTES)
 
+    def load_schema(self):
+        """
+        Load the GraphQL schema from the queries folder. The schema is built once and shared by all exporters.
+        :return: schema or None if there is no local schema file
+        """
+        if GraphqlExporter.schema is None and os.path.exists(self.SCHEMA_LOCATION):
+            with open(self.SCHEMA_LOCATION, 'r') as schema_file:
+                GraphqlExporter.schema = build_schema(schema_file.read())
+        return GraphqlExporter.schema
+
+    def make_client(self):
+        """
+        Create the GraphQL client. The client has no schema, queries are validated once when they are prepared.
+        If validation is enabled but no local schema exists, the client fetches the schema from the server once
+        and validates every request itself.
+        :return: gql client
+        """
+        transport = AIOHTTPTransport(url=self.GRAPHQL_URL)
+        if self.validate_queries and self.load_schema() is None:
+            return Client(transport=transport, fetch_schema_from_transport=True, execute_timeout=400)
+        return Client(transport=transport, execute_timeout=400)
+
+    def prepare_query(self, query: str):
+        """
+        Parse a query into a document and validate it against the schema if validation is enabled.
+        Documents are cached, so the requests of an export reuse the document of their query.
+        :param query: graphql query
+        :return: DocumentNode
+        """
+        document = self.documents.get(query)
+        if document is None:
+            document = gql(query)
+            schema = self.load_schema() if self.validate_queries else None
+            if schema is not None:
+                errors = validate(schema, document)
+                if errors:
+                    raise FatalExportError("The query is invalid: " + "; ".join(error.message for error in errors))
+            self.documents[query] = document
+        return document
+
+    async def get_session(self):
+        """
+        Return the session of the exporter and connect it on first use.
+        The session keeps its HTTP connections open and is reused by every query of the exporter run.
+        :return: connected gql client session
+        """
+        if self.session is None:
+            self.client = self.make_client()
+            self.session = await self.client.connect_async()
+            if self.validate_queries and GraphqlExporter.schema is None:
+                GraphqlExporter.schema = self.client.schema
+        return self.session
+
+    def run(self, coroutine):
+        """
+        Run a coroutine on the event loop of the exporter.
+        :param coroutine: coroutine to run
+        :return: result of the coroutine
+        """
+        if self.loop is None:
+            self.loop = asyncio.new_event_loop()
+        return self.loop.run_until_complete(coroutine)
+
+    def close_session(self):
+        """
+        Close the session and the event loop of the exporter and finish the snapshot of the archive.
+        :return: None
+        """
+        if self.archive is not None:
+            self.archive.close()
+        if self.session is not None:
+            self.run(self.client.close_async())
+            self.session = None
+        if self.loop is not None:
+            self.loop.close()
+            self.loop = None
 
-    def execute_graphql_query(self, query: str):
+    def execute_graphql_query(self, query: str, cursor=None, context: dict = None, variable_values: dict = None):
         """
         Execute a graphql query and return the result.
         :param query: graphql query
+        :param cursor: cursor of the query, only stored in the archive
+        :param context: information needed to turn the result into documents, only stored in the archive
+        :param variable_values: values of the variables of the query
         :return: result of graphql query
         """
-        base_time = 0.1
-        time.sleep(base_time)
-        for attempt in range(10):
-            base_time = base_time * 2
+        return self.run(self.execute_graphql_query_async(query, cursor, context, variable_values))
+
+    async def execute_graphql_query_async(self, query: str, cursor=None, context: dict = None,
+                                          variable_values: dict = None):
+        """
+        Execute a graphql query on the session of the exporter and return the result.
+        The session can be shared by several coroutines to keep multiple requests in flight.
+        Requests are paced by the shared rate limiter. Retryable errors are retried with exponential backoff
+        or after the time the server asked for, fatal errors and exhausted retries raise a FatalExportError.
+        Successful pages are written to the archive if one is configured. With adaptive page sizes the `first:`
+        argument next to `after:`, the pagination of the template, is set to the current page size of the exporter
+        before every attempt. Only the pages of the template adjust the page size, other queries of the exporter,
+        e.g. the inline connections of a list, are sent as they are.
+        The query is prepared once by prepare_query and sent with the variable values of the request.
+        :param query: graphql query
+        :param cursor: cursor of the query, only stored in the archive
+        :param context: information needed to turn the result into documents, only stored in the archive
+        :param variable_values: values of the variables of the query
+        :return: result of graphql query
+        """
+        backoff = 0.1
+        page_sizer = self.page_sizer if re.search(self.GRAPHQL_PAGE_SIZE_REGEX, query) else None
+        for attempt in range(1, self.MAX_ATTEMPTS + 1):
+            await self.RATE_LIMITER.acquire()
+            if page_sizer is not None:
+                query = re.sub(self.GRAPHQL_PAGE_SIZE_REGEX, r'\g<1>' + str(page_sizer.page_size), query)
+            document = self.prepare_query(query)
+            started = time.monotonic()
             try:
-                transport = AIOHTTPTransport(url=self.GRAPHQL_URL)
-                client = Client(transport=transport, fetch_schema_from_transport=True, execute_timeout=400)
-                result = client.execute(document=gql(query))
-            except:
-                time.sleep(base_time)
+                session = await self.get_session()
+                async with self.REQUEST_BUDGET:
+                    result = await session.execute(document, variable_values=variable_values)
+            except Exception as error:
+                export_error = classify_error(error)
+                if isinstance(export_error, FatalExportError):
+                    raise export_error from error
+                self.RATE_LIMITER.record_failure(export_error.retry_after)
+                if page_sizer is not None and not export_error.throttled:
+                    page_sizer.record_failure()
+                backoff = backoff * 2
+                self.metrics.record_retry()
+                print("Attempt " + str(attempt) + " failed: " + str(export_error))
+                await asyncio.sleep(export_error.retry_after if export_error.retry_after else backoff)
             else:
-                break
-        else:
-            raise SystemExit(0)
-        return result
+                latency = time.monotonic() - started
+                page_bytes = len(json.dumps(result))
+                self.RATE_LIMITER.record_success(latency)
+                self.metrics.record_request(latency, page_bytes)
+                if page_sizer is not None:
+                    page_sizer.record_page(latency, page_bytes)
+                if self.archive is not None:
+                    self.archive.write(query, result, cursor, context, variable_values)
+                return result
+        raise FatalExportError("Query failed after " + str(self.MAX_ATTEMPTS) + " attempts") from export_error
 
-    def make_pagination_query(self, after_cursor: str = None):
+    def make_pagination_variables(self, after_cursor: str = None):
         """
-        Generates the next graphql query for pagination.
+        Generates the variables of the next page of a paginated query template.
 
-        :param: query_template: name of the query template located in the queries' folder
         :param: after_cursor: cursor of the last object that is returned
+        :return: variable values
+        """
+        return {'after': after_cursor if after_cursor else ''}
+
+    def make_aliased_query(self, query: str, aliases: list):
+        """
+        Combine copies of a query into one query by giving the root field of each copy an alias.
+        The variables of each copy are prefixed with its alias, see make_aliased_variables.
+        The result of each copy is returned under its alias.
+
+        :param query: query with a single root field
+        :param aliases: alias of each copy
         :return: graphQL query as string
         """
-        return self.query_template.replace(
-            'after: ""', 'after: "{}"'.format(after_cursor) if after_cursor else 'after: ""'
-        )
+        key = (query, tuple(aliases))
+        if key not in self.aliased_queries:
+            operation = self.prepare_query(query).definitions[0]
+            variable_definitions = []
+            fields = []
+            for alias in aliases:
+                aliased_operation = visit(operation, VariableAliaser(alias))
+                variable_definitions.extend(aliased_operation.variable_definitions)
+                field = aliased_operation.selection_set.selections[0]
+                fields.append(FieldNode(alias=NameNode(value=alias), name=field.name, arguments=field.arguments,
+                                        directives=field.directives, selection_set=field.selection_set))
+            self.aliased_queries[key] = print_ast(DocumentNode(definitions=(OperationDefinitionNode(
+                operation=OperationType.QUERY, variable_definitions=tuple(variable_definitions), directives=(),
+                selection_set=SelectionSetNode(selections=tuple(fields))),)))
+        return self.aliased_queries[key]
+
+    @staticmethod
+    def make_aliased_variables(variable_values: dict):
+        """
+        Combine the variables of the copies of a query for the query of make_aliased_query.
 
-    def insert_documents(self, database: str, db_collection: str,  documents: list, truncate_collection: bool = False):
+        :param variable_values: variable values of each copy by alias
+        :return: variable values of the aliased query
+        """
+        return {alias + '_' + name: value for alias, values in variable_values.items() for name, value in values.items()}
+
+    @abstractmethod
+    def parse_archived_page(self, page: dict):
+        """
+        Turn a page of the archive into the documents the export would have written.
+        :param page: record of PageArchive with the result, cursor and context of the page
+        :return: list of documents
+        """
+
+    def start_archive(self, template_names: list = None):
+        """
+        Mark the start of an export that replaces its collection in the archive, if one is configured.
+        :param template_names: templates whose export starts, defaults to the template of the exporter
+        :return: None
+        """
+        if self.archive is not None:
+            self.archive.start(template_names)
+
+    def rebuild_collection(self, snapshot_locations: list, db_collection: str, indexes: list = None,
+                           document_key=None):
+        """
+        Replace the documents of a collection with the documents of the segments of an archived snapshot, without
+        requests to CRIS. Pages that were fetched again, e.g. after a resume, are written only once. The exporter has
+        to be created with rebuild, so that it does not archive the rebuild or prepare an export.
+        :param snapshot_locations: paths to the segments written by PageArchive, in the order they were written
+        :param db_collection: name of the collection
+        :param indexes: pymongo IndexModels built on the staging collection of a staged load
+        :param document_key: function that returns the key documents are de-duplicated by
+        :return: number of documents written
+        """
+        print("Rebuild collection " + db_collection + " from " + ", ".join(str(location)
+                                                                         for location in snapshot_locations))
+        writer = MongoPageWriter(self.MONGODB_URI, self.DATABASE, db_collection, pages_per_write=50,
+                                 max_pending_pages=100, truncate_collection=True, staged=self.STAGED_LOAD,
+                                 indexes=indexes).start()
+        written_keys = set()
+        for snapshot_location in snapshot_locations:
+            for page in PageArchive.read(snapshot_location):
+                documents = self.parse_archived_page(page)
+                if document_key is not None:
+                    documents = [document for document in documents if document_key(document) not in written_keys]
+                    written_keys.update(document_key(document) for document in documents)
+                writer.put(documents)
+        return writer.close()
+
+    def insert_documents(self, database: str, db_collection: str,  documents: list, truncate_collection: bool = False,
+                         indexes: list = None):
         """
         Insert documents into the database.
+        With CRISETL_STAGED_LOAD a truncating insert loads a staging collection with unordered inserts instead,
+        builds the indexes on it and renames it to the collection, so readers never see it empty or half filled.
         :param database: name of the database
         :param db_collection: name of the collection
         :param documents: documents to insert
         :param truncate_collection: truncate the collection before inserting
+        :param indexes: pymongo IndexModels built on the staging collection of a staged load
         """
         if not documents:
             return
+        if truncate_collection and self.STAGED_LOAD:
+            writer = MongoPageWriter(self.MONGODB_URI, database, db_collection, staged=True, indexes=indexes,
+                                     metrics=self.metrics).start()
+            writer.put(documents)
+            writer.close()
+            return
         mongodb_instance = pm.MongoClient(self.MONGODB_URI, serverSelectionTimeoutMS=500000)
         database = mongodb_instance[database]
         print("Insert " + str(len(documents)) + " documents into collection: " + str(db_collection))
+        started = time.monotonic()
         if db_collection in database.list_collection_names() and truncate_collection:
             database[db_collection].delete_many({})  # delete all existing documents
         for chunk in self.__chunks(documents, 50000):
             database[db_collection].insert_many(chunk)
+        self.metrics.record_write(len(documents), time.monotonic() - started)
         mongodb_instance.close()
 
+    def save_metrics(self, status: str = 'succeeded', error: Exception = None):
+        """
+        Save the metrics of the export to the export_runs collection and the Prometheus textfile if configured.
+        :param status: succeeded or failed
+        :param error: error the export failed with
+        :return: summary of the metrics
+        """
+        return self.metrics.save(self.MONGODB_URI, self.DATABASE, status, error)
+
     def __chunks(self, lst: list, n: int):
         """
         Yield successive n-sized chunks from lst.
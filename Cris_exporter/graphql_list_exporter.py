@@ -1,17 +1,48 @@
 import os
+import pathlib
+import time
 import pymongo as pm
+from graphql import ArgumentNode, IntValueNode, NameNode, SelectionSetNode, parse, print_ast
+from delta_export import DeltaExport
+from graphql_connenction_exporter import GraphqlConnectionExporter
 from graphql_exporter import GraphqlExporter
+from mongo_page_writer import MongoPageWriter
+from query_compiler import find_field
 from re import findall
 
 
 class GraphqlListExporter(GraphqlExporter):
+    INDEXES = [pm.IndexModel("id", unique=True)]
+    STREAM = os.getenv("CRISETL_STREAM_LIST_EXPORT", 'false').lower() == 'true'
+    PAGES_PER_WRITE = int(os.getenv("CRISETL_PAGES_PER_WRITE", 10))
+    INCREMENTAL = os.getenv("CRISETL_INCREMENTAL_EXPORT", 'false').lower() == 'true'
+    CHECKPOINT = os.getenv("CRISETL_CHECKPOINT_LIST_EXPORT", 'false').lower() == 'true'
+    INLINE_CONNECTIONS = os.getenv("CRISETL_INLINE_CONNECTIONS", 'false').lower() == 'true'
+    INLINE_CONNECTIONS_FIRST = int(os.getenv("CRISETL_INLINE_CONNECTIONS_FIRST", 100))
+    INLINE_CONNECTIONS_BATCH_SIZE = int(os.getenv("CRISETL_INLINE_CONNECTIONS_BATCH_SIZE", 10))
 
-    def __init__(self, query_template_location: os.PathLike):
+    def __init__(self, query_template_location: os.PathLike, stream: bool = None, incremental: bool = None,
+                 checkpoint: bool = None, inline_connections: bool = None, rebuild: bool = False):
         """
         Prepare the exporter by setting creating a GraphqlExporter, setting the cursor and setting the has_next_page flag.
         :param query_template_location:
+        :param stream: write pages while the next pages are fetched instead of collecting the whole list first,
+                       defaults to CRISETL_STREAM_LIST_EXPORT
+        :param incremental: only write new and changed documents and record the changes of the run instead of
+                            reloading the collection, defaults to CRISETL_INCREMENTAL_EXPORT
+        :param checkpoint: stream the pages and save the cursor of every written page, so that a restarted export
+                           continues after the last written page, defaults to CRISETL_CHECKPOINT_LIST_EXPORT.
+                           Not used for incremental exports, which only write changed documents anyway.
+        :param inline_connections: request the first page of every connection of the nodes of each page and write
+                                   them into the connection collections page by page, defaults to
+                                   CRISETL_INLINE_CONNECTIONS.
+                                   Not used for checkpointed exports, which cannot resume the harvested connections.
+        :param rebuild: create the exporter only to rebuild the list from the archive
         """
-        super().__init__(query_template_location)
+        super().__init__(query_template_location, rebuild=rebuild)
+        self.stream = self.STREAM if stream is None else stream
+        self.incremental = self.INCREMENTAL if incremental is None else incremental
+        self.checkpoint = (self.CHECKPOINT if checkpoint is None else checkpoint) and not self.incremental
         self.has_next_page = True
         self.after_cursor = None
         db_collection = findall(self.GRAPHQL_TO_REGEX, self.query_template)
@@ -19,36 +50,277 @@ class GraphqlListExporter(GraphqlExporter):
             raise ValueError("The file " + (os.path.basename(query_template_location)) + " has no list object")
         json_list_name = str(db_collection[0])
         self.db_collection = json_list_name.replace("List", '')
+        self.exporter_collection_name = 'exporter_' + self.db_collection
+        self.metrics.collection_name = self.db_collection
+        self.connections = {}  # harvested connections by the name of their connection field, e.g. publications
+        self.connections_query_template = None
+        if (self.INLINE_CONNECTIONS if inline_connections is None else inline_connections) and not self.checkpoint:
+            self.__add_inline_connections(os.path.dirname(os.path.realpath(query_template_location)))
+
+    def __add_inline_connections(self, graphql_queries_folder: os.PathLike):
+        """
+        Combine the connection templates of this list into one query that fetches the first
+        INLINE_CONNECTIONS_FIRST connections of every kind for one node. The items of CRIS lists have no connections,
+        so they are requested by id, with the ids of a page batched into one query by field aliases.
+        :param graphql_queries_folder: folder with the connection templates
+        :return: None
+        """
+        document = None
+        connection_fields = []
+        for connection_template_location in sorted(pathlib.Path(graphql_queries_folder).glob('get_connection_*')):
+            with open(connection_template_location, 'r') as connection_template_file:
+                connection_template = connection_template_file.read()
+            from_collection_name = findall(GraphqlConnectionExporter.GRAPHQL_CONNECTION_REGEX, connection_template)[0]
+            if from_collection_name != self.db_collection:
+                continue
+            to_collection_name = findall(self.GRAPHQL_TO_REGEX, connection_template)[0].replace("List", '')
+            connection_document = parse(connection_template)
+            connection_field = find_field(connection_document.definitions[0].selection_set.selections[0],
+                                          ['connections', to_collection_name])
+            connection_field.arguments = (ArgumentNode(name=NameNode(value='first'),
+                                                       value=IntValueNode(value=str(self.INLINE_CONNECTIONS_FIRST))),)
+            connection_fields.append(connection_field)
+            document = document or connection_document
+            self.connections[to_collection_name] = {
+                'template': os.path.splitext(connection_template_location.name)[0],
+                'collection': self.db_collection + '_' + to_collection_name,
+                'exporter_collection': 'exporter_' + self.db_collection + '_' + to_collection_name,
+                'from_key': self.db_collection + '_id',
+                'to_key': to_collection_name[:-1] + '_id',
+                'writer': None,
+                'follow_ups': [],
+            }
+        if document is not None:
+            operation = document.definitions[0]
+            connections_field = find_field(operation.selection_set.selections[0], ['connections'])
+            connections_field.selection_set = SelectionSetNode(selections=tuple(connection_fields))
+            operation.variable_definitions = tuple(variable_definition for variable_definition
+                                                   in operation.variable_definitions
+                                                   if variable_definition.variable.name.value != 'after')
+            self.connections_query_template = print_ast(document)
 
     def export(self):
         """
         Export all pages of the GraphQL list and inserts them into the database.
         :return: None
         """
-        documents = []
-        while self.has_next_page:
-            page_documents = self.__export_page()
-            documents.extend(page_documents)
+        if self.checkpoint:
+            self.__export_with_checkpoints()
+            self.create_index()
+            return
 
-        self.insert_documents(self.DATABASE, self.db_collection, documents, True)
-        self.create_index()
+        # the harvested connections replace their collections as well
+        self.start_archive([self.metrics.template_name] + [connection['template']
+                                                           for connection in self.connections.values()])
+        try:
+            self.__start_connection_writers()
+            delta_export = None
+            if self.incremental:
+                self.create_index()
+                delta_export = DeltaExport(self.MONGODB_URI, self.DATABASE, self.db_collection)
+            if self.stream:
+                self.__export_streaming(delta_export)
+            else:
+                documents = []
+                while self.has_next_page:
+                    page_documents = self.__export_page()
+                    documents.extend(page_documents)
+                self.close_session()
+                if delta_export:
+                    started = time.monotonic()
+                    delta_export.write(documents)
+                    self.metrics.record_write(len(documents), time.monotonic() - started)
+                else:
+                    self.insert_documents(self.DATABASE, self.db_collection, documents, True, self.INDEXES)
+            if delta_export:
+                delta_export.finish()
+            self.create_index()
+            self.__write_inline_connections()
+        finally:
+            self.__abort_connection_writers()
+            self.close_session()
+
+    def __start_connection_writers(self):
+        """
+        Start a writer for every harvested connection, which replaces the connection collection with the connections
+        of each page as they are harvested.
+        :return: None
+        """
+        for connection in self.connections.values():
+            connection['writer'] = MongoPageWriter(self.MONGODB_URI, self.DATABASE, connection['collection'],
+                                                   pages_per_write=self.PAGES_PER_WRITE,
+                                                   max_pending_pages=2 * self.PAGES_PER_WRITE,
+                                                   truncate_collection=True, staged=self.STAGED_LOAD).start()
+            connection['follow_ups'] = []
+
+    def __write_inline_connections(self):
+        """
+        Finish writing the harvested connections and leave the ids whose connections have
+        more pages in the exporter collection of the connection, together with the cursor to continue after.
+        The connection exporter then only follows up on these ids. The marker document tells it that the exporter
+        collection holds follow-ups rather than an interrupted export.
+        :return: None
+        """
+        if not self.connections:
+            return
+        mongodb_instance = pm.MongoClient(self.MONGODB_URI, serverSelectionTimeoutMS=500000)
+        database = mongodb_instance[self.DATABASE]
+        for connection in self.connections.values():
+            harvested = connection['writer'].close()
+            print("Harvested " + str(harvested) + " connections of " + connection['collection'] +
+                  ", " + str(len(connection['follow_ups'])) + " ids have more pages")
+            database[connection['exporter_collection']].drop()
+            # the marker comes last, so it only exists if all follow-ups were written
+            database[connection['exporter_collection']].insert_many(
+                connection['follow_ups'] + [{'_id': GraphqlConnectionExporter.INLINE_MARKER_ID}])
+        mongodb_instance.close()
+
+    def __abort_connection_writers(self):
+        """
+        Stop the writers of the harvested connections that were not closed because the export failed. With
+        STAGED_LOAD, the connection collections keep the connections of the last complete export.
+        :return: None
+        """
+        for connection in self.connections.values():
+            if connection['writer'] is not None:
+                connection['writer'].abort()
+
+    def __export_streaming(self, delta_export: DeltaExport = None):
+        """
+        Export all pages of the GraphQL list and hand every page to a writer thread as soon as it arrives.
+        Only a few pages are held in memory at any time. If a page fails, the writer is stopped without writing the
+        pending pages.
+        :param delta_export: write only changed documents through the delta export instead of reloading
+        :return: None
+        """
+        writer = MongoPageWriter(self.MONGODB_URI, self.DATABASE, self.db_collection,
+                                 pages_per_write=self.PAGES_PER_WRITE, max_pending_pages=2 * self.PAGES_PER_WRITE,
+                                 truncate_collection=delta_export is None,
+                                 write_documents=delta_export.write if delta_export else None,
+                                 staged=self.STAGED_LOAD, indexes=self.INDEXES, metrics=self.metrics).start()
+        try:
+            while self.has_next_page:
+                writer.put(self.__export_page())
+            self.close_session()
+            writer.close()
+        finally:
+            writer.abort()
+            self.close_session()
+
+    def __export_with_checkpoints(self):
+        """
+        Export all pages of the GraphQL list like the streaming export and save the cursor after every written page
+        in the exporter collection. If the exporter collection holds a cursor from an interrupted run, the export
+        continues after that cursor instead of starting over.
+        :return: None
+        """
+        mongodb_instance = pm.MongoClient(self.MONGODB_URI, serverSelectionTimeoutMS=500000)
+        database = mongodb_instance[self.DATABASE]
+        progress = database[self.exporter_collection_name]
+        checkpoint = progress.find_one({"_id": "progress"})
+        if checkpoint:
+            self.after_cursor = checkpoint['after_cursor']
+            print("Resume export of " + self.db_collection + " after " + str(checkpoint['pages']) + " pages")
+        else:
+            self.start_archive()
+            database[self.db_collection].delete_many({})
+            progress.insert_one({"_id": "progress", "after_cursor": None, "pages": 0, "documents": 0})
+        self.create_index()  # pages written again after a resume are skipped by the unique index
+
+        def save_checkpoint(after_cursor: str, pages: int, documents: int):
+            progress.update_one({"_id": "progress"},
+                                {"$set": {"after_cursor": after_cursor}, "$inc": {"pages": pages, "documents": documents}})
+
+        writer = MongoPageWriter(self.MONGODB_URI, self.DATABASE, self.db_collection,
+                                 pages_per_write=self.PAGES_PER_WRITE, max_pending_pages=2 * self.PAGES_PER_WRITE,
+                                 on_written=save_checkpoint, metrics=self.metrics).start()
+        try:
+            while self.has_next_page:
+                documents = self.__export_page()
+                writer.put(documents, self.after_cursor)
+            self.close_session()
+            writer.close()
+            progress.drop()
+        finally:
+            # pages that were not written yet are not in the checkpoint and are fetched again on resume
+            writer.abort()
+            self.close_session()
+            mongodb_instance.close()
 
     def __export_page(self):
         """
         Export one page of the list.
         :return: list of documents
         """
-        documents = []
-        query = self.make_pagination_query(self.after_cursor)
-        result = self.execute_graphql_query(query)
+        result = self.execute_graphql_query(self.query_template, self.after_cursor,
+                                            variable_values=self.make_pagination_variables(self.after_cursor))
         json_list_name = self.db_collection + 'List'
         self.after_cursor = result[json_list_name]['pageInfo']['endCursor']
         self.has_next_page = result[json_list_name]['pageInfo']['hasNextPage']
-        for list_element in result[json_list_name]['list']:
-            documents.append(list_element['node'])
-
+        documents = self.__parse_page(result)
+        if self.connections:
+            self.__harvest_connections([document['id'] for document in documents])
         return documents
 
+    def __parse_page(self, result: dict):
+        """
+        Turn one page of the list into documents.
+        :param result: result of the list query
+        :return: list of documents
+        """
+        return [list_element['node'] for list_element in result[self.db_collection + 'List']['list']]
+
+    def __harvest_connections(self, from_ids: list):
+        """
+        Fetch the first page of every connection of the nodes of a page and hand the connection documents to the
+        writers of the connections. Ids whose connections have more pages are kept as follow-ups with the cursor to
+        continue after.
+        :param from_ids: ids of the nodes of the page
+        :return: None
+        """
+        page_documents = {to_collection_name: [] for to_collection_name in self.connections}
+        for start in range(0, len(from_ids), self.INLINE_CONNECTIONS_BATCH_SIZE):
+            batch = from_ids[start:start + self.INLINE_CONNECTIONS_BATCH_SIZE]
+            context = {'c' + str(index): from_id for index, from_id in enumerate(batch)}
+            result = self.execute_graphql_query(
+                self.make_aliased_query(self.connections_query_template, list(context)), None, context,
+                self.make_aliased_variables({alias: {'id': str(from_id)} for alias, from_id in context.items()}))
+            for alias, from_id in context.items():
+                from_object = result[alias]
+                connections = from_object['connections'] if from_object and from_object['connections'] else {}
+                for to_collection_name, connection in self.connections.items():
+                    page = connections.get(to_collection_name)
+                    if not page:
+                        continue
+                    for edge in page['edges']:
+                        page_documents[to_collection_name].append({connection['from_key']: from_id,
+                                                                   connection['to_key']: edge['node']['id']})
+                    if page['pageInfo']['hasNextPage']:
+                        connection['follow_ups'].append({'id': from_id,
+                                                         'after_cursor': page['pageInfo']['endCursor']})
+        for to_collection_name, connection in self.connections.items():
+            connection['writer'].put(page_documents[to_collection_name])
+
+    def parse_archived_page(self, page: dict):
+        """
+        Turn a page of the archive into documents.
+        :param page: record of PageArchive
+        :return: list of documents, none for the pages of inline connections, which have a context
+        """
+        if page['context']:
+            return []
+        return self.__parse_page(page['result'])
+
+    def rebuild(self, snapshot_locations: list):
+        """
+        Replace the collection with the documents of an archived snapshot of the list, without requests to CRIS.
+        :param snapshot_locations: paths to the segments of the snapshot, see PageArchive.segments
+        :return: None
+        """
+        self.rebuild_collection(snapshot_locations, self.db_collection, self.INDEXES,
+                                lambda document: document['id'])
+        self.create_index()
+
     def create_index(self):
         """
         Create an index on the id field of the collection.
@@ -56,4 +328,4 @@ class GraphqlListExporter(GraphqlExporter):
         """
         mongodb_instance = pm.MongoClient(self.MONGODB_URI, serverSelectionTimeoutMS=500000)
         database = mongodb_instance[self.DATABASE]
-        database[self.db_collection].create_index("id", unique=True)
\ No newline at end of file
+        database[self.db_collection].create_indexes(self.INDEXES)
\ No newline at end of file
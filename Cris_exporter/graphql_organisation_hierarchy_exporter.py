@@ -1,57 +1,114 @@
+from delta_export import DeltaExport
 from graphql_exporter import GraphqlExporter
 import pymongo as pm
 import os
 
 
 class GraphqlOrganisationHierarchyExporter(GraphqlExporter):
+    ROOT_ORGANISATION_IDS = [organisation_id.strip() for organisation_id
+                             in os.getenv("CRISETL_ORGANISATION_ROOT_IDS", '').split(',') if organisation_id.strip()]
+    BATCH_SIZE = int(os.getenv("CRISETL_HIERARCHY_BATCH_SIZE", 50))
 
-    def __init__(self, query_template_location: os.PathLike):
+    def __init__(self, query_template_location: os.PathLike, root_organisation_ids: list = None,
+                 batch_size: int = None, rebuild: bool = False):
         """
         Constructor.
+        :param query_template_location: path to the query template
+        :param root_organisation_ids: organisations whose subtrees are exported, defaults to
+                                      CRISETL_ORGANISATION_ROOT_IDS. Without roots all organisations are exported.
+        :param batch_size: number of organisations that are combined into one query by field aliases
+        :param rebuild: create the exporter only to rebuild the hierarchy from the archive
         """
-        super().__init__(query_template_location)
+        super().__init__(query_template_location, rebuild=rebuild)
         self.collection_name = "organisation_organisation"
-        self.organisation_id = ""
+        self.metrics.collection_name = self.collection_name
+        self.root_organisation_ids = root_organisation_ids if root_organisation_ids else self.ROOT_ORGANISATION_IDS
+        self.batch_size = batch_size if batch_size else self.BATCH_SIZE
 
     def export(self):
         """
         Export the organisation hierarchy.
+        With root organisations the tree is walked breadth-first from the roots, one batched pass per level.
+        Otherwise the children of every organisation in the organisation collection are exported.
         """
+        self.start_archive()
         documents = []
-        mongodb_instance = pm.MongoClient(self.MONGODB_URI, serverSelectionTimeoutMS=300000)
-        database = mongodb_instance[self.DATABASE]
-        organisations = list(database['organisation'].find({}, {"id": 1, "_id": 0}))
-        mongodb_instance.close()
-        for organisation in organisations:
-            self.organisation_id = organisation['id']
-            organisation_documents = self.export_organisation()
-            documents.extend(organisation_documents)
+        if self.root_organisation_ids:
+            visited_ids = set(str(organisation_id) for organisation_id in self.root_organisation_ids)
+            level = list(visited_ids)
+            while level:
+                level_documents = self.export_organisations(level)
+                documents.extend(level_documents)
+                level = []
+                for document in level_documents:
+                    child_organisation_id = document['child_organisation_id']
+                    if child_organisation_id not in visited_ids:
+                        visited_ids.add(child_organisation_id)
+                        level.append(child_organisation_id)
+        else:
+            mongodb_instance = pm.MongoClient(self.MONGODB_URI, serverSelectionTimeoutMS=300000)
+            database = mongodb_instance[self.DATABASE]
+            organisations = list(database['organisation'].find(DeltaExport.not_deleted(), {"id": 1, "_id": 0}))
+            mongodb_instance.close()
+            documents = self.export_organisations([organisation['id'] for organisation in organisations])
+        self.close_session()
 
-        self.insert_documents(self.DATABASE, self.collection_name, documents, True)
+        if documents:
+            self.insert_documents(self.DATABASE, self.collection_name, documents, True)
+        else:  # insert_documents skips an empty result, which would keep the hierarchy of an earlier export
+            mongodb_instance = pm.MongoClient(self.MONGODB_URI, serverSelectionTimeoutMS=300000)
+            mongodb_instance[self.DATABASE][self.collection_name].delete_many({})
+            mongodb_instance.close()
+            print("The organisation hierarchy is empty, cleared collection: " + self.collection_name)
 
-    def export_organisation(self):
+    def export_organisations(self, organisation_ids: list):
         """
-        Export a single organisation.
-        :return:
+        Export the child organisations of the given organisations, batch_size organisations per query.
+        :param organisation_ids: ids of the parent organisations
+        :return: one document per parent and child organisation
         """
         documents = []
-        query = self.__make_connection_query()
-        result = self.execute_graphql_query(query)
+        for start in range(0, len(organisation_ids), self.batch_size):
+            batch = organisation_ids[start:start + self.batch_size]
+            context = {'o' + str(index): organisation_id for index, organisation_id in enumerate(batch)}
+            result = self.execute_graphql_query(
+                self.make_aliased_query(self.query_template, list(context)), context=context,
+                variable_values=self.make_aliased_variables({alias: {'id': str(organisation_id)}
+                                                             for alias, organisation_id in context.items()}))
+            documents.extend(self.__parse_page(result, context))
+        return documents
 
-        child_organisations = result['organisation']['connections']['organisations']['edges']
-        for child_organisation in child_organisations:
-            child_organisation_id = child_organisation['node']['id']
-            documents.append({'organisation_id': self.organisation_id, 'child_organisation_id': child_organisation_id})
+    def __parse_page(self, result: dict, context: dict):
+        """
+        Turn the result of a batch into one document per parent and child organisation.
+        :param result: result of the aliased query
+        :param context: id of the parent organisation by alias
+        :return: list of documents
+        """
+        documents = []
+        for alias, organisation_id in context.items():
+            organisation = result[alias]
+            if not organisation or not organisation['connections']:
+                continue
+            for child_organisation in organisation['connections']['organisations']['edges']:
+                child_organisation_id = child_organisation['node']['id']
+                documents.append({'organisation_id': organisation_id,
+                                  'child_organisation_id': child_organisation_id})
         return documents
 
-    def __make_connection_query(self):
+    def parse_archived_page(self, page: dict):
+        """
+        Turn a page of the archive into documents.
+        :param page: record of PageArchive
+        :return: list of documents
         """
-        Create the queries to fetch connections from grpahql.
+        return self.__parse_page(page['result'], page['context'])
 
-        :param cris_id: cris_id to which the connections should be found
-        :return: graphQL query as string
+    def rebuild(self, snapshot_locations: list):
+        """
+        Replace the organisation hierarchy with the documents of an archived snapshot, without requests to CRIS.
+        :param snapshot_locations: paths to the segments of the snapshot, see PageArchive.segments
+        :return: None
         """
-        query = self.query_template.replace(
-            'id: ""', 'id: "{}"'.format(str(self.organisation_id))
-        )
-        return query
+        self.rebuild_collection(snapshot_locations, self.collection_name, document_key=lambda document: (
+            document['organisation_id'], document['child_organisation_id']))
@@ -0,0 +1,195 @@
+import queue
+import threading
+import time
+import pymongo as pm
+from pymongo.errors import BulkWriteError
+
+
+class MongoPageWriter:
+    """
+    Consumer that bulk-writes pages of documents into a collection on a background thread,
+    so the exporter can fetch the next page while the previous one is written.
+    A staged writer loads the pages into an empty staging collection without indexes instead, builds the indexes
+    once all pages are written and then replaces the collection with the staging collection in one rename,
+    so readers never see a partially loaded collection.
+    """
+
+    STAGING_PREFIX = 'staging_'
+
+    def __init__(self, mongodb_uri: str, database: str, db_collection: str, pages_per_write: int = 1,
+                 max_pending_pages: int = 4, truncate_collection: bool = False, write_documents=None,
+                 on_written=None, staged: bool = False, indexes: list = None, metrics=None):
+        """
+        Prepare the writer.
+        :param mongodb_uri: uri of the MongoDB instance
+        :param database: name of the database
+        :param db_collection: name of the collection
+        :param pages_per_write: number of pages that are grouped into one bulk write
+        :param max_pending_pages: number of pages that may wait for the writer before put blocks
+        :param truncate_collection: truncate the collection before the first write
+        :param write_documents: callable that writes a list of documents instead of inserting them
+        :param on_written: callable that is called with the checkpoint of the last page, the number of pages and
+                           the number of documents after every bulk write
+        :param staged: replace the collection by loading a staging collection and renaming it on close,
+                       implies truncate_collection and is ignored together with write_documents
+        :param indexes: pymongo IndexModels the staging collection gets before it replaces the collection
+        :param metrics: ExportMetrics the writes are recorded in
+        """
+        self.mongodb_uri = mongodb_uri
+        self.database = database
+        self.db_collection = db_collection
+        self.pages_per_write = max(pages_per_write, 1)
+        self.truncate_collection = truncate_collection
+        self.write_documents = write_documents
+        self.on_written = on_written
+        self.staged = staged and write_documents is None
+        self.indexes = indexes
+        self.metrics = metrics
+        self.pages = queue.Queue(maxsize=max(max_pending_pages, 1))
+        self.thread = threading.Thread(target=self.__write_pages, daemon=True)
+        self.error = None
+        self.aborted = False
+        self.written_documents = 0
+
+    def start(self):
+        """
+        Start the writer thread.
+        :return: the writer
+        """
+        self.thread.start()
+        return self
+
+    def put(self, documents: list, checkpoint=None):
+        """
+        Hand a page over to the writer. Blocks while max_pending_pages pages are waiting.
+        :param documents: documents of the page
+        :param checkpoint: position after the page, passed to on_written once the page is written
+        :return: None
+        """
+        self.__raise_error()
+        self.pages.put((documents, checkpoint))
+
+    def close(self):
+        """
+        Write the remaining pages and stop the writer thread.
+        :return: number of written documents
+        """
+        self.pages.put(None)
+        self.thread.join()
+        self.__raise_error()
+        return self.written_documents
+
+    def abort(self):
+        """
+        Stop the writer thread after the export failed, without writing the pages that are still waiting.
+        A staged load is dropped instead of replacing the collection. Does nothing once the writer is closed.
+        :return: None
+        """
+        if not self.thread.is_alive():
+            return
+        self.aborted = True
+        self.pages.put(None)
+        self.thread.join()
+
+    def __raise_error(self):
+        """
+        Re-raise an exception of the writer thread in the producer thread.
+        :return: None
+        """
+        if self.error is not None:
+            raise self.error
+
+    def __write_pages(self):
+        """
+        Consume pages from the queue until the end marker arrives.
+        :return: None
+        """
+        mongodb_instance = pm.MongoClient(self.mongodb_uri, serverSelectionTimeoutMS=500000)
+        database = mongodb_instance[self.database]
+        collection = database[self.db_collection]
+        try:
+            if self.staged:
+                collection = database[self.STAGING_PREFIX + self.db_collection]
+                collection.drop()  # left over by a failed load
+                database.create_collection(collection.name)
+            elif self.truncate_collection:
+                collection.delete_many({})
+            documents = []
+            grouped_pages = 0
+            checkpoint = None
+            while True:
+                page = self.pages.get()
+                if page is None or self.aborted:
+                    break
+                page_documents, checkpoint = page
+                documents.extend(page_documents)
+                grouped_pages += 1
+                if grouped_pages >= self.pages_per_write:
+                    self.__write(collection, documents, grouped_pages, checkpoint)
+                    documents = []
+                    grouped_pages = 0
+            if self.aborted:
+                if self.staged:
+                    collection.drop()
+                return
+            if grouped_pages:
+                self.__write(collection, documents, grouped_pages, checkpoint)
+            if self.staged:
+                self.__swap_in(collection)
+        except Exception as error:
+            self.error = error
+            self.__drain()
+        finally:
+            mongodb_instance.close()
+
+    def __write(self, collection, documents: list, pages: int, checkpoint):
+        """
+        Bulk-write documents into the collection. Documents that already exist under a unique index,
+        e.g. pages written again after a resume, are skipped.
+        :param collection: target collection
+        :param documents: documents to write
+        :param pages: number of pages the documents belong to
+        :param checkpoint: position after the last of the pages
+        :return: None
+        """
+        started = time.monotonic()
+        if self.write_documents is not None:
+            self.write_documents(documents)
+        elif documents:
+            print("Insert " + str(len(documents)) + " documents into collection: " + str(self.db_collection))
+            try:
+                collection.insert_many(documents, ordered=False)
+            except BulkWriteError as error:
+                write_errors = error.details['writeErrors']
+                if error.details.get('writeConcernErrors') or any(
+                        write_error['code'] != 11000 for write_error in write_errors):
+                    raise
+        if self.metrics is not None:
+            self.metrics.record_write(len(documents), time.monotonic() - started)
+        self.written_documents += len(documents)
+        if self.on_written is not None:
+            self.on_written(checkpoint, pages, len(documents))
+
+    def __swap_in(self, staging_collection):
+        """
+        Build the indexes of the staging collection and let it replace the collection.
+        :param staging_collection: fully loaded staging collection
+        :return: None
+        """
+        started = time.monotonic()
+        if self.indexes:
+            staging_collection.create_indexes(self.indexes)
+        staging_collection.rename(self.db_collection, dropTarget=True)
+        if self.metrics is not None:
+            self.metrics.record_write(0, time.monotonic() - started)
+        print("Replaced collection " + self.db_collection + " with " + str(self.written_documents) + " documents")
+
+    def __drain(self):
+        """
+        Discard pending pages after a failed write so that the producer is not blocked forever.
+        :return: None
+        """
+        while True:
+            page = self.pages.get()
+            if page is None:
+                return
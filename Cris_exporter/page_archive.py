@@ -0,0 +1,165 @@
+import gzip
+import json
+import os
+import pathlib
+import threading
+from datetime import datetime, timezone
+
+try:
+    import zstandard
+except ImportError:  # zstandard is optional, snapshots are gzip-compressed without it
+    zstandard = None
+
+
+class PageArchive:
+    """
+    Writes every GraphQL page an exporter fetches to a compressed JSON lines snapshot, together with the query,
+    the cursor and the ids the page belongs to. Snapshots are partitioned by date:
+    <archive_folder>/<YYYY-MM-DD>/<template>-<HHMMSSffffff>-<pid>.jsonl.zst (or .jsonl.gz if zstandard is not
+    installed). Every exporter writes its own segment, so an export that was resumed or shared by several workers is
+    spread over several segments. A snapshot can be read again to rebuild the data lake without sending requests to
+    CRIS.
+    """
+
+    def __init__(self, archive_folder: os.PathLike, template_name: str):
+        """
+        Prepare the archive. The snapshot file is created with the first page.
+        :param archive_folder: folder the date partitions are created in
+        :param template_name: name of the query template without extension, e.g. get_publications
+        """
+        self.archive_folder = archive_folder
+        self.template_name = template_name
+        self.location = None
+        self.file = None
+        self.pages = 0
+        self.start_record = None  # start of an export, written at the beginning of the next segment
+        self.lock = threading.Lock()
+
+    def write(self, query: str, result: dict, cursor=None, context: dict = None, variable_values: dict = None):
+        """
+        Append a page to the snapshot.
+        :param query: query that was sent
+        :param result: result of the query
+        :param cursor: cursor the page was requested after
+        :param context: information needed to turn the result into documents, e.g. the id of each alias
+        :param variable_values: variables the query was sent with
+        :return: None
+        """
+        record = {'template': self.template_name, 'fetched': datetime.now(timezone.utc).isoformat(),
+                  'cursor': cursor, 'context': context, 'query': query, 'variables': variable_values,
+                  'result': result}
+        line = json.dumps(record, default=str) + '\n'
+        with self.lock:
+            if self.file is None:
+                self.file = self.__open()
+            self.file.write(line)
+            self.pages += 1
+
+    def start(self, template_names: list = None):
+        """
+        Mark the start of an export that replaces its collection, e.g. after truncating it. The start record begins
+        a new segment, which is created with the next page or when the archive is closed. A rebuild replays the
+        segments of a template from its latest start, see segments.
+        :param template_names: templates whose export starts, defaults to the template of the archive
+        :return: None
+        """
+        with self.lock:
+            self.__close_file()
+            self.start_record = {'template': self.template_name, 'fetched': datetime.now(timezone.utc).isoformat(),
+                                 'start': template_names if template_names else [self.template_name]}
+
+    def close(self):
+        """
+        Finish the snapshot file.
+        :return: location of the snapshot or None if no page was written
+        """
+        with self.lock:
+            if self.file is None and self.start_record is not None:  # an export without pages replaces as well
+                self.file = self.__open()
+            self.__close_file()
+        return self.location
+
+    def __close_file(self):
+        """
+        Close the current segment, if one is open.
+        :return: None
+        """
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            print("Archived " + str(self.pages) + " pages in " + self.location)
+            self.pages = 0
+
+    def __open(self):
+        """
+        Create the snapshot file in the partition of the current date, beginning with the pending start record.
+        :return: writable text file
+        """
+        now = datetime.now(timezone.utc)
+        partition = os.path.join(self.archive_folder, now.strftime('%Y-%m-%d'))
+        os.makedirs(partition, exist_ok=True)
+        extension = '.jsonl.zst' if zstandard else '.jsonl.gz'
+        self.location = os.path.join(partition, self.template_name + '-' + now.strftime('%H%M%S%f') + '-' +
+                                     str(os.getpid()) + extension)
+        if zstandard:
+            snapshot_file = zstandard.open(self.location, 'wt', encoding='utf-8')
+        else:
+            snapshot_file = gzip.open(self.location, 'wt', encoding='utf-8')
+        if self.start_record is not None:
+            snapshot_file.write(json.dumps(self.start_record) + '\n')
+            self.start_record = None
+        return snapshot_file
+
+    @staticmethod
+    def read(snapshot_location: os.PathLike, include_starts: bool = False):
+        """
+        Read the pages of a snapshot.
+        :param snapshot_location: path to a .jsonl.zst or .jsonl.gz snapshot
+        :param include_starts: also yield the start records written by start
+        :return: generator of page records
+        """
+        if str(snapshot_location).endswith('.zst'):
+            if zstandard is None:
+                raise ValueError("Reading " + str(snapshot_location) + " requires the zstandard package")
+            snapshot_file = zstandard.open(snapshot_location, 'rt', encoding='utf-8')
+        else:
+            snapshot_file = gzip.open(snapshot_location, 'rt', encoding='utf-8')
+        with snapshot_file:
+            for line in snapshot_file:
+                if line.strip():
+                    record = json.loads(line)
+                    if include_starts or 'start' not in record:
+                        yield record
+
+    @staticmethod
+    def segments(archive_folder: os.PathLike, snapshot_date: str = None):
+        """
+        Find the segments to rebuild every template from in a date partition. The segments of a template are replayed
+        in the order of their first record, from the latest segment that started an export of the template, so
+        resumed exports and the workers of a shared export are merged, but earlier exports of the day are left out.
+        The starting segment can belong to another template, e.g. a list export that harvested its connections
+        inline. Segments of archives without start records are all replayed.
+        :param archive_folder: folder of the date partitions
+        :param snapshot_date: partition to read, e.g. 2023-01-31, defaults to the latest partition
+        :return: list of segment locations by template name
+        """
+        partitions = sorted(folder.name for folder in pathlib.Path(archive_folder).iterdir() if folder.is_dir())
+        if snapshot_date is None and partitions:
+            snapshot_date = partitions[-1]
+        if snapshot_date not in partitions:
+            raise ValueError("The archive " + str(archive_folder) + " has no snapshot of " + str(snapshot_date))
+        first_records = {}
+        for segment in pathlib.Path(archive_folder, snapshot_date).glob('*.jsonl.*'):
+            first_records[segment] = next(PageArchive.read(segment, include_starts=True), None) or {}
+        # a start record holds the time the export started, which can be before the first page of other workers
+        segments = sorted(first_records, key=lambda segment: first_records[segment].get('fetched', ''))
+        template_names = [segment.name.split('.')[0].split('-')[0] for segment in segments]
+        started_templates = [first_records[segment].get('start', []) for segment in segments]
+
+        snapshots = {}
+        for template_name in set(template_names).union(*started_templates):
+            starts = [index for index, templates in enumerate(started_templates) if template_name in templates]
+            first = starts[-1] if starts else 0
+            snapshots[template_name] = [str(segment) for index, segment in enumerate(segments) if index >= first and
+                                        (index == first and starts or template_names[index] == template_name)]
+        return snapshots
@@ -0,0 +1,62 @@
+import threading
+
+
+class AdaptivePageSizer:
+    """
+    Chooses the `first:` argument of a paginated query template from the response time and payload size of its
+    previous pages. The page size grows while pages are answered quickly and stay small and is halved as soon as a
+    page is slow, too large or fails, so fat nodes are fetched in smaller pages before they hit the timeout.
+    """
+
+    def __init__(self, page_size: int, min_page_size: int = 10, max_page_size: int = 100,
+                 target_latency: float = 5.0, max_page_bytes: int = 2 * 1024 * 1024, growth_factor: float = 1.25,
+                 shrink_factor: float = 0.5):
+        """
+        Prepare the page sizer.
+        :param page_size: initial page size, usually the `first:` argument of the template
+        :param min_page_size: smallest page size
+        :param max_page_size: largest page size, CRIS accepts at most 100
+        :param target_latency: seconds a page may take
+        :param max_page_bytes: size of the JSON result a page may have
+        :param growth_factor: factor the page size is multiplied with after a fast and small page
+        :param shrink_factor: factor the page size is multiplied with after a slow or large page
+        """
+        self.min_page_size = max(min_page_size, 1)
+        self.max_page_size = max(max_page_size, self.min_page_size)
+        self.page_size = min(max(page_size, self.min_page_size), self.max_page_size)
+        self.target_latency = target_latency
+        self.max_page_bytes = max_page_bytes
+        self.growth_factor = growth_factor
+        self.shrink_factor = shrink_factor
+        self.lock = threading.Lock()
+
+    def record_page(self, latency: float, page_bytes: int):
+        """
+        Adjust the page size after a page was fetched.
+        :param latency: seconds the page took
+        :param page_bytes: size of the JSON result of the page
+        :return: new page size
+        """
+        with self.lock:
+            if latency > self.target_latency or page_bytes > self.max_page_bytes:
+                self.__resize(self.page_size * self.shrink_factor)
+            elif latency < self.target_latency / 2 and page_bytes < self.max_page_bytes / 2:
+                self.__resize(max(self.page_size * self.growth_factor, self.page_size + 1))
+            return self.page_size
+
+    def record_failure(self):
+        """
+        Shrink the page size after a page timed out or failed on the server.
+        :return: new page size
+        """
+        with self.lock:
+            self.__resize(self.page_size * self.shrink_factor)
+            return self.page_size
+
+    def __resize(self, page_size: float):
+        """
+        Set the page size within the bounds.
+        :param page_size: requested page size
+        :return: None
+        """
+        self.page_size = int(min(max(page_size, self.min_page_size), self.max_page_size))
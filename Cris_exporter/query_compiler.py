@@ -0,0 +1,125 @@
+import argparse
+import json
+import os
+
+from graphql import (FieldNode, NameNode, SelectionSetNode, build_schema, get_named_type, is_object_type, parse,
+                     print_ast, validate)
+
+PROFILES_FOLDER = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'profiles')
+SCHEMA_LOCATION = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'queries', 'schema.graphql')
+FULL_PROFILE = 'full'
+
+
+def find_field(field, names: list):
+    """
+    Follow a path of field names through nested selections.
+    :param field: field to start at
+    :param names: field names to follow
+    :return: FieldNode or None if the path does not exist
+    """
+    for name in names:
+        if field.selection_set is None:
+            return None
+        field = next((selection for selection in field.selection_set.selections
+                      if isinstance(selection, FieldNode) and selection.name.value == name), None)
+        if field is None:
+            return None
+    return field
+
+
+class QueryCompiler:
+    """
+    Generates the node selection of list query templates from a field manifest, so that an export profile
+    only fetches the fields its consumers read.
+    A manifest maps the name of a list (e.g. publicationList) to dotted field paths of its nodes,
+    e.g. ["id", "cfTitle", "cfLang.cfName"]. Lists without an entry keep the selection of their template.
+    """
+
+    def __init__(self, manifest: dict, schema):
+        """
+        Prepare the compiler.
+        :param manifest: field paths per list name
+        :param schema: GraphQL schema the compiled queries are validated against
+        """
+        self.manifest = manifest
+        self.schema = schema
+
+    @classmethod
+    def from_profile(cls, profile: str, schema=None):
+        """
+        Create the compiler of an export profile, whose manifest is profiles/<profile>.json.
+        :param profile: name of the export profile, e.g. lean
+        :param schema: GraphQL schema, defaults to queries/schema.graphql
+        :return: QueryCompiler
+        """
+        manifest_location = os.path.join(PROFILES_FOLDER, profile + '.json')
+        if not os.path.exists(manifest_location):
+            raise ValueError("The export profile " + profile + " has no manifest " + manifest_location)
+        with open(manifest_location, 'r') as manifest_file:
+            manifest = json.load(manifest_file)
+        if schema is None:
+            with open(SCHEMA_LOCATION, 'r') as schema_file:
+                schema = build_schema(schema_file.read())
+        return cls(manifest, schema)
+
+    def compile(self, query_template: str):
+        """
+        Replace the node selection of the list in a query template with the fields of the manifest.
+        :param query_template: GraphQL query with a list at its root, e.g. queries/get_publications.graphql
+        :return: compiled query, or the unchanged template if the manifest has no entry for its list
+        """
+        document = parse(query_template)
+        list_field = document.definitions[0].selection_set.selections[0]
+        field_paths = self.manifest.get(list_field.name.value)
+        if field_paths is None:
+            return query_template
+
+        node_field = find_field(list_field, ['list', 'node'])
+        if node_field is None:
+            raise ValueError("The list " + list_field.name.value + " of the query has no list { node } selection")
+        node_type = get_named_type(self.schema.query_type.fields[list_field.name.value].type)
+        node_type = get_named_type(node_type.fields['list'].type)
+        node_type = get_named_type(node_type.fields['node'].type)
+        node_field.selection_set = self.make_selection_set(node_type, field_paths)
+
+        errors = validate(self.schema, document)
+        if errors:
+            raise ValueError("The compiled query of " + list_field.name.value + " is invalid: " +
+                             "; ".join(error.message for error in errors))
+        return print_ast(document)
+
+    def make_selection_set(self, object_type, field_paths: list):
+        """
+        Build a selection set from dotted field paths, e.g. ["id", "cfLang.cfName"] selects id and cfLang { cfName }.
+        :param object_type: GraphQL type the paths start at
+        :param field_paths: dotted field paths
+        :return: SelectionSetNode
+        """
+        children = {}
+        for field_path in field_paths:
+            name, _, rest = field_path.partition('.')
+            if name not in object_type.fields:
+                raise ValueError("The type " + object_type.name + " has no field " + name)
+            sub_paths = children.setdefault(name, [])
+            if rest:
+                sub_paths.append(rest)
+
+        selections = []
+        for name, sub_paths in children.items():
+            field_type = get_named_type(object_type.fields[name].type)
+            if is_object_type(field_type) and not sub_paths:
+                raise ValueError("The field " + object_type.name + "." + name + " is an object, select its fields "
+                                 "with a dotted path, e.g. " + name + ".id")
+            selection_set = self.make_selection_set(field_type, sub_paths) if sub_paths else None
+            selections.append(FieldNode(name=NameNode(value=name), arguments=(), directives=(),
+                                        selection_set=selection_set))
+        return SelectionSetNode(selections=tuple(selections))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Print a query template compiled for an export profile.')
+    parser.add_argument('query_template', help='path to the query template')
+    parser.add_argument('--profile', default='lean', help='name of the manifest in the profiles folder')
+    arguments = parser.parse_args()
+    with open(arguments.query_template, 'r') as template_file:
+        print(QueryCompiler.from_profile(arguments.profile).compile(template_file.read()))
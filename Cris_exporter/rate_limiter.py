@@ -0,0 +1,85 @@
+import asyncio
+import threading
+import time
+
+
+class AdaptiveRateLimiter:
+    """
+    Token bucket that limits the request rate of all exporters. The rate grows step by step while requests
+    are answered within the target latency and drops when CRIS gets slow, fails or throttles us.
+    Retry-After hints of the server pause all requests until the given time.
+    """
+
+    def __init__(self, rate: float, min_rate: float = 1.0, max_rate: float = 50.0, burst: int = 5,
+                 target_latency: float = 2.0, increase_step: float = 0.5, decrease_factor: float = 0.5):
+        """
+        Prepare the rate limiter.
+        :param rate: initial number of requests per second
+        :param min_rate: lowest number of requests per second
+        :param max_rate: highest number of requests per second
+        :param burst: number of requests that may be sent at once after an idle period
+        :param target_latency: seconds a healthy request may take
+        :param increase_step: requests per second added after a healthy request
+        :param decrease_factor: factor the rate is multiplied with after a slow or failed request
+        """
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.rate = min(max(rate, min_rate), max_rate)
+        self.burst = burst
+        self.target_latency = target_latency
+        self.increase_step = increase_step
+        self.decrease_factor = decrease_factor
+        self.tokens = 1.0
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    async def acquire(self):
+        """
+        Wait until a request may be sent. Safe to use from several threads and event loops.
+        :return: None
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.__refill(now)
+                if now >= self.paused_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay = max(self.paused_until - now, (1 - self.tokens) / self.rate)
+            await asyncio.sleep(delay)
+
+    def record_success(self, latency: float):
+        """
+        Raise the rate after a fast request, lower it after a slow one.
+        :param latency: seconds the request took
+        :return: None
+        """
+        with self.lock:
+            self.__refill(time.monotonic())
+            if latency <= self.target_latency:
+                self.rate = min(self.rate + self.increase_step, self.max_rate)
+            else:
+                self.rate = max(self.rate * self.decrease_factor, self.min_rate)
+
+    def record_failure(self, retry_after: float = None):
+        """
+        Lower the rate after a failed request and pause all requests if the server asked for it.
+        :param retry_after: seconds the server asked us to wait
+        :return: None
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.__refill(now)
+            self.rate = max(self.rate * self.decrease_factor, self.min_rate)
+            if retry_after:
+                self.paused_until = max(self.paused_until, now + retry_after)
+
+    def __refill(self, now: float):
+        """
+        Add the tokens earned since the last update.
+        :param now: current monotonic time
+        :return: None
+        """
+        self.tokens = min(self.tokens + (now - self.updated) * self.rate, self.burst)
+        self.updated = now
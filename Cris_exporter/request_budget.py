@@ -0,0 +1,77 @@
+import asyncio
+import threading
+from collections import deque
+
+
+class RequestBudget:
+    """
+    Limits the number of GraphQL requests that are in flight at the same time across all exporters,
+    no matter in which thread or event loop they run. Requests that find no free slot wait in the order they arrived
+    and a released slot is handed to the next of them by waking it in its own event loop, so waiting requests
+    neither poll nor block a thread.
+    """
+
+    def __init__(self, max_requests: int):
+        """
+        Prepare the budget.
+        :param max_requests: number of requests that may be in flight at the same time
+        """
+        self.max_requests = max_requests
+        self.in_flight = 0
+        self.waiters = deque()  # event loop and future of every waiting request
+        self.lock = threading.Lock()
+
+    async def __aenter__(self):
+        """
+        Wait for a free slot without blocking the event loop.
+        """
+        with self.lock:
+            if self.in_flight < self.max_requests and not self.waiters:
+                self.in_flight += 1
+                return self
+            waiter = (asyncio.get_running_loop(), asyncio.get_running_loop().create_future())
+            self.waiters.append(waiter)
+        try:
+            await waiter[1]
+        except asyncio.CancelledError:
+            with self.lock:
+                waiting = waiter in self.waiters
+                if waiting:
+                    self.waiters.remove(waiter)
+            # a slot that was handed over after the wait was cancelled is passed on by __wake
+            if not waiting and waiter[1].done() and not waiter[1].cancelled():
+                self.release()
+            raise
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        """
+        Release the slot.
+        """
+        self.release()
+
+    def release(self):
+        """
+        Hand the slot over to the longest waiting request or free it if no request waits.
+        :return: None
+        """
+        with self.lock:
+            while self.waiters:
+                loop, future = self.waiters.popleft()
+                try:
+                    loop.call_soon_threadsafe(self.__wake, future)
+                    return
+                except RuntimeError:  # the event loop of the request is closed
+                    continue
+            self.in_flight -= 1
+
+    def __wake(self, future: asyncio.Future):
+        """
+        Let a waiting request continue with the slot it was handed, or pass the slot on if it stopped waiting.
+        :param future: future the request waits for
+        :return: None
+        """
+        if future.done():
+            self.release()
+        else:
+            future.set_result(None)
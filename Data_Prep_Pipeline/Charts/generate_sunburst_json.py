@@ -1,6 +1,7 @@
 import pymongo as pm
 import os
 import data_prep_helper as helper
+import web_publisher
 from datetime import datetime
 
 MONGODB_TO_URI = os.getenv("MONGODB_TO_URI",
@@ -20,8 +21,10 @@ def generate_org_json(organisation_id: int):
     """
     client = pm.MongoClient(MONGODB_FROM_URI)
     db = client[MONGODB_FROM_DB]
-    organisation = db['organisation'].find_one({"id": str(organisation_id)})
+    organisation = db['organisation'].find_one(helper.not_deleted({"id": str(organisation_id)}))
     client.close()
+    if not organisation:
+        return {}
     organisation_json = {'id': str(organisation_id), 'name': organisation['cfName'], 'children': []}
     print("Generate JSON for Organisation: " + str(organisation_json['name']))
     for person_id in helper.get_persons_ids_for_organisation(organisation_id):
@@ -40,7 +43,7 @@ def generate_person_json(person_id: int):
     """
     client = pm.MongoClient(MONGODB_FROM_URI)
     db = client[MONGODB_FROM_DB]
-    person = db['person'].find_one({"id": str(person_id)})
+    person = db['person'].find_one(helper.not_deleted({"id": str(person_id)}))
     if not person:
         return {}
     person_json = {'name': get_full_name(person_id), 'id': str(person_id), 'children': []}
@@ -65,14 +68,14 @@ def generate_publication_json(publication_ids: list):
     publications = db['publication'].aggregate(
         [
             {
-                '$match': {
+                '$match': helper.not_deleted({
                     'id': {
                         '$in': publication_ids
                     },
                     'publYear': {
                         '$gt': datetime.now().year - 3
                     }
-                }
+                })
             },
             {
                 '$group': {
@@ -105,7 +108,7 @@ def get_full_name(person_id: int):
     """
     client = pm.MongoClient(MONGODB_FROM_URI)
     db = client[MONGODB_FROM_DB]
-    person = db['person'].find_one({"id": str(person_id)})
+    person = db['person'].find_one(helper.not_deleted({"id": str(person_id)}))
     client.close()
     academic_title = person['academicTitle'] if person['academicTitle'] is not None else ''
     first_name = person['cfFirstNames'] if person['cfFirstNames'] is not None else ''
@@ -127,6 +130,7 @@ def generate_sunburst_json():
 
     mongodb_instance = pm.MongoClient(MONGODB_TO_URI)
     to_db = mongodb_instance[MONGODB_TO_DB]
-    to_db['inst_wi_hrchy'].delete_many({})
-    to_db['inst_wi_hrchy'].insert_one({'children': sunburst_list})
+    sunburst_collection = web_publisher.get_build_collection(to_db, 'inst_wi_hrchy')
+    sunburst_collection.delete_many({})
+    sunburst_collection.insert_one({'children': sunburst_list})
     mongodb_instance.close()
@@ -2,6 +2,7 @@ from pymongo import MongoClient
 import pandas as pd
 import os
 import data_prep_helper as data_prep_helper
+import web_publisher
 
 uri = os.getenv('MONGODB_TO_URI', "mongodb://localhost:27017")
 color_mapper = {
@@ -31,13 +32,13 @@ def prepare_data(use_short_name):
     # first get publication_filled dataframa
 
     client = MongoClient(uri)
-    result = client['FLK_Web']['publications'].find({})
+    result = web_publisher.get_read_collection(client['FLK_Web'], 'publications').find({})
     df_publications = pd.DataFrame.from_records(result)
     result_orga = client['FLK_Data_Lake']['organisation_publications'].find({})
     df_organisation_publications = pd.DataFrame.from_records(result_orga)
     organisations = data_prep_helper.get_children_organisation_ids(31923392)['children']
     organisation_ids = [str(organisation['id']) for organisation in organisations]
-    df_organisation = pd.DataFrame.from_records(client['FLK_Data_Lake']['organisation'].find({'id': {'$in': organisation_ids}}))
+    df_organisation = pd.DataFrame.from_records(client['FLK_Data_Lake']['organisation'].find(data_prep_helper.not_deleted({'id': {'$in': organisation_ids}})))
     # left join pub df_publication_filled with df_organisation_publications on id=publication_id
     df_merged = pd.merge(df_publications, df_organisation_publications, how='left', left_on='id',
                          right_on='publication_id')
@@ -190,7 +191,7 @@ def psuh_results(result_dict):
     MONGODB_TO_DB = "FLK_Web"
     mongo_client = MongoClient(uri)
     to_db = mongo_client[MONGODB_TO_DB]
-    target_collection = to_db["data_bar_chart_research_output"]
+    target_collection = web_publisher.get_build_collection(to_db, "data_bar_chart_research_output")
     target_collection.delete_many({})
     target_collection.insert_many(result_dict)
     print('Inserted data into collection: ' + 'FLK WEB: ' + 'data_bar_chart_research_output')
@@ -11,6 +11,9 @@ import numpy as np
 import pandas as pd
 from pymongo import MongoClient
 
+import data_prep_helper as helper
+import web_publisher
+
 
 # Step 1: Get original data from Mongo
 def get_original_data(uri) -> pd.DataFrame:
@@ -22,7 +25,7 @@ def get_original_data(uri) -> pd.DataFrame:
     global df_publications
 
     client = MongoClient(uri)
-    result = client['FLK_Data_Lake']['publication'].find({})
+    result = client['FLK_Data_Lake']['publication'].find(helper.not_deleted())
     df_publications = pd.DataFrame.from_records(result)
 
     print("Original data shape: ", df_publications.shape)
@@ -104,7 +107,7 @@ def write_final_publications(df_final, collection_name, db_name, uri):
     """
     client = MongoClient(uri)
     db = client[db_name]
-    collection = db[collection_name]
+    collection = web_publisher.get_build_collection(db, collection_name)
 
     # delete old data
     collection.delete_many({})
@@ -353,7 +353,7 @@ def get_wi_publication_data_df(wi_ids=None):
     collection = 'publication'
 
     # query the data, id must be in wi_publications_ids
-    query = {'id': {'$in': wi_ids}}
+    query = helper.not_deleted({'id': {'$in': wi_ids}})
 
     df_res = pd.DataFrame.from_records(my_db[collection].find(query))
 
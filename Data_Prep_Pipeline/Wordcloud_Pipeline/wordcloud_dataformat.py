@@ -1,6 +1,7 @@
 import pymongo as pm
 import os
 import pandas as pd
+import web_publisher
 
 CLIENT = os.getenv('FILLER_ENV_MONGO_URI', "mongodb://localhost:27017")
 DATABASE_LAKE = os.getenv('FILLER_ENV_MONGO_DATABASE_DATA_LAKE', "FLK_Data_Lake")
@@ -42,9 +43,10 @@ def push_to_MongoDB(client, database, data):
     :param data: Any data that will push to the table worcloud institut
     """
     db = access_mongo_db(client, database)
-    if "wordcloud_institut" in db.list_collection_names():
-        db["wordcloud_institut"].delete_many({})
-    db["wordcloud_institut"].insert_many(data)
+    wordcloud_collection = web_publisher.get_build_collection(db, "wordcloud_institut")
+    if wordcloud_collection.name in db.list_collection_names():
+        wordcloud_collection.delete_many({})
+    wordcloud_collection.insert_many(data)
     
 def preprocess_WordCloud_data():
     """
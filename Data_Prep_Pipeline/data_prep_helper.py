@@ -6,6 +6,16 @@ MONGODB_FROM_URI = os.getenv("MONGODB_FROM_URI",
 MONGODB_FROM_DB = os.getenv("MONGODB_TO_DB", "FLK_Data_Lake")
 
 
+def not_deleted(query: dict = None):
+    """
+    Extend a query of publication, person or organisation to skip documents the incremental CRIS export marked as
+    deleted
+    :param query: query of the collection
+    :return: query without deleted documents
+    """
+    return dict(query if query else {}, deleted={'$ne': True})
+
+
 def get_children_organisation_ids(organisation_id: int):
     """
     Get all children organisation_ids for a given organisation_id
@@ -98,3 +108,14 @@ def get_wi_persons():
     return wi_ids
 
 
+def get_latest_changeset(collection_name: str):
+    """
+    Get the ids added, changed and deleted by the latest incremental CRIS export of a collection
+    :param collection_name: name of the exported collection, e.g. publication
+    :return: changeset with the id lists 'added', 'changed' and 'deleted', None if no incremental export ran
+    """
+    client = pm.MongoClient(MONGODB_FROM_URI)
+    db = client[MONGODB_FROM_DB]
+    changeset = db['export_changesets'].find_one({"collection": collection_name}, sort=[("finished", pm.DESCENDING)])
+    client.close()
+    return changeset
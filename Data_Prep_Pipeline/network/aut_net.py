@@ -9,6 +9,7 @@ import community
 import json
 import matplotlib.pyplot as plt
 import data_prep_helper as helper
+import web_publisher
 
 def get_data():
     MONGODB_TO_URI = os.getenv('PIPELINE_ENV_MONGODB_TO_URI',
@@ -24,7 +25,7 @@ def get_data():
     auth_ids = helper.get_wi_persons()
     auth_ids = [str(i) for i in auth_ids]
     authors = from_db["person"]
-    auth = authors.find({"id": {"$in": auth_ids}})
+    auth = authors.find(helper.not_deleted({"id": {"$in": auth_ids}}))
 
     # put the data in a dataframe
     auth_list = list(auth)
@@ -100,8 +101,8 @@ def run_aut_net():
                            "mongodb://localhost:27017/")
     mongo_client = pm.MongoClient(MONGODB_TO_URI)
     to_db = mongo_client[MONGODB_TO_DB]
-    network = to_db["author_networks"]
-    if "author_networks" in to_db.list_collection_names():
+    network = web_publisher.get_build_collection(to_db, "author_networks")
+    if network.name in to_db.list_collection_names():
         network.delete_many({})
     # get all the authors from WWU
     for i in set(df1["id"]):
@@ -11,6 +11,7 @@ import metaknowledge as mk
 import community                # pip install python-louvain
 import json
 import matplotlib.pyplot as plt
+import web_publisher
 
 plt.rc("savefig", dpi=1000)
 
@@ -122,8 +123,8 @@ def save_graph(graph, partition):
     MONGODB_TO_DB = "FLK_Web"
     mongo_client = pm.MongoClient(MONGODB_TO_URI)
     to_db = mongo_client[MONGODB_TO_DB]
-    network = to_db["network"]
-    if "network" in to_db.list_collection_names():
+    network = web_publisher.get_build_collection(to_db, "network")
+    if network.name in to_db.list_collection_names():
         network.delete_many({})
     network.insert_one(jsonGraph)
 
@@ -9,6 +9,7 @@ import Charts.generate_sunburst_json as sunburst
 import Data_Delivery.script_data_research_output as data_research_output
 import network.aut_net as aut_net
 import network.key_net as key_net
+import web_publisher
 
 
 data_filler.fire_total_filler_pipeline(target_collection='publication_filled')
@@ -22,3 +23,4 @@ wordcloud_pipeline_author.preprocess_data_for_wordcloud('publication_wordcloud_d
 data_research_output.create_data_and_push()
 aut_net.run_aut_net()
 key_net.run_key_net()
+web_publisher.publish_after_run()
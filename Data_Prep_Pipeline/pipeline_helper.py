@@ -6,6 +6,7 @@ import os
 import pymongo
 import pandas as pd
 import data_prep_helper as helper
+import web_publisher
 
 CLIENT = os.getenv('FILLER_ENV_MONGO_URI', "mongodb://localhost:27017")
 DATABASE_FLK_DATA_LAKE = os.getenv('FILLER_ENV_MONGO_DATABASE_DATA_LAKE', "FLK_Data_Lake")
@@ -153,7 +154,7 @@ def access_mongo_db_person_data():
     # database = "FLK_Data_Lake"
     database = DATABASE_FLK_DATA_LAKE
     my_db = access_mongo_db(client, database)
-    collection = my_db['person'].find({"id": {"$in": wi_persons}})
+    collection = my_db['person'].find(helper.not_deleted({"id": {"$in": wi_persons}}))
 
     # Daten aus der Sammlung abrufen
     data = [item for item in collection]
@@ -231,7 +232,7 @@ def complete_push_to_mongo_web(collection_name, data_as_dict, allowed_collection
     client = CLIENT
     database = DATABASE_FLK_WEB
     my_db = access_mongo_db(client, database)
-    collection = my_db[collection_name]
+    collection = web_publisher.get_build_collection(my_db, collection_name)
 
     print('Collection exist, wipe collection')
     wipe_mongo_collection_web(collection_name, allowed_collection=allowed_collection)
@@ -254,7 +255,7 @@ def wipe_mongo_collection_web(collection_name, allowed_collection):
     client = CLIENT
     database = DATABASE_FLK_WEB
     my_db = access_mongo_db(client, database)
-    collection = my_db[collection_name]
+    collection = web_publisher.get_build_collection(my_db, collection_name)
     print(f'Wiping collection {collection_name}')
     collection.delete_many({})
     print(f'Collection {collection_name} wiped')
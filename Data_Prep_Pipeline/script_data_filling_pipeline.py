@@ -8,6 +8,8 @@ This script should trigger the data filling process for new publications and pre
 Steps:
     1. Determine which publications are new
        - New publications are determined with Δ(publication.id,publication_filled.id)
+       - Publications changed or deleted by the latest incremental CRIS export are removed from publication_filled,
+         so changed publications are filled again
     2. Retrieve the information for the new publications and save the information in the mongo collection "publications"
     3. Prepare the new publications for further processing (for now add language attribute)
     4. Preprocessing for NLP
@@ -67,7 +69,23 @@ def fire_total_filler_pipeline(target_collection):
     wi_df_publication_filled = utils.get_collection_df_from_mongo(collection_name=target_collection)
     wi_ids_publication_filled = wi_df_publication_filled['id'].tolist() if not wi_df_publication_filled.empty else []
 
-    # 1.3. Determine which publications are new
+    # 1.3. Publications the latest incremental CRIS export changed are filled again, deleted ones are removed
+    # the pipeline runs after each CRIS export, so the latest changeset holds the changes since the last run
+    changeset = data_prep_helper.get_latest_changeset('publication')
+    if changeset:
+        deleted_publication_ids = set(str(x) for x in changeset['deleted'])
+        wi_ids_publication = [x for x in wi_ids_publication if x not in deleted_publication_ids]
+        outdated_publication_ids = set(str(x) for x in changeset['changed']) | deleted_publication_ids
+        if not wi_df_publication_filled.empty and wi_df_publication_filled['id'].isin(outdated_publication_ids).any():
+            wi_df_publication_filled = wi_df_publication_filled[
+                ~wi_df_publication_filled['id'].isin(outdated_publication_ids)]
+            wi_ids_publication_filled = wi_df_publication_filled['id'].tolist()
+            print(f'[Filling Pipeline] Start wiping to remove changed and deleted publications')
+            utils.wipe_mongo_collection(target_collection)
+            if not wi_df_publication_filled.empty:
+                utils.safe_push_to_mongo(df=wi_df_publication_filled, collection_name=target_collection)
+
+    # 1.4. Determine which publications are new
     new_publication_ids = set(wi_ids_publication) - set(wi_ids_publication_filled)
 
     # convert to list
@@ -0,0 +1,234 @@
+"""
+Versioned publishing of the frontend collections of FLK_Web.
+With PIPELINE_ENV_VERSIONED_PUBLISHING=true the writers do not wipe and refill the collections the frontend reads.
+They write into collections of the current version instead, e.g. publications__20230301T020000Z, and publish()
+switches all collections of the version at once after every stage succeeded. The collections they replace are
+kept as <collection>__previous, so rollback() can restore them. The versions are recorded in publish_versions.
+The Data_Prep_Pipeline and the web_pipeline both use this module, their images copy it from the shared folder.
+"""
+
+import argparse
+import os
+from datetime import datetime, timedelta, timezone
+
+import pymongo as pm
+
+VERSIONED_PUBLISHING = os.getenv('PIPELINE_ENV_VERSIONED_PUBLISHING', 'false').lower() == 'true'
+# Pipelines that set the same version build into the same version, only the last of them should publish
+PUBLISH_VERSION = os.getenv('PIPELINE_ENV_PUBLISH_VERSION', datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ'))
+PUBLISH_AFTER_RUN = os.getenv('PIPELINE_ENV_PUBLISH_AFTER_RUN', 'true').lower() == 'true'
+# Builds that were not published within this time are dropped by the next publish
+ABANDON_AFTER_HOURS = int(os.getenv('PIPELINE_ENV_PUBLISH_ABANDON_AFTER_HOURS', 72))
+# Settings the writers of FLK_Web read the uri of their MongoDB instance from
+WRITER_URI_SETTINGS = ['PIPELINE_ENV_MONGODB_TO_URI', 'MONGODB_TO_URI', 'FILLER_ENV_MONGO_URI']
+MONGODB_TO_DB = "FLK_Web"
+VERSIONS_COLLECTION = 'publish_versions'
+PREVIOUS_SUFFIX = '__previous'
+
+
+def writer_uris():
+    """
+    Uris of the MongoDB instances the writers of FLK_Web write to, resolved like the writers resolve them.
+    :return: list of distinct uris
+    """
+    uris = [os.getenv(setting, "mongodb://localhost:27017/").rstrip('/') + '/' for setting in WRITER_URI_SETTINGS]
+    return list(dict.fromkeys(uris))
+
+
+def version_collection_name(collection_name: str, version: str = None):
+    """
+    Name of the collection of a version.
+    :param collection_name: name of the collection the frontend reads
+    :param version: version, defaults to the version of this run
+    :return: name of the collection of the version
+    """
+    return collection_name + '__' + (version if version else PUBLISH_VERSION)
+
+
+def get_build_collection(database, collection_name: str, seed: bool = False):
+    """
+    Get the collection a writer should replace the content of. Without versioned publishing, and for databases other
+    than FLK_Web, this is the collection itself. Otherwise the collection is registered in the current version and
+    the collection of the version is returned.
+    :param database: database the writer writes to
+    :param collection_name: name of the collection the frontend reads
+    :param seed: start the collection of the version as a copy of the published collection, for writers that only
+                 write the changes
+    :return: Collection
+    """
+    if not VERSIONED_PUBLISHING or database.name != MONGODB_TO_DB:
+        return database[collection_name]
+    database[VERSIONS_COLLECTION].update_one(
+        {'_id': PUBLISH_VERSION},
+        {'$setOnInsert': {'status': 'building', 'created': datetime.now(timezone.utc)},
+         '$addToSet': {'collections': collection_name}},
+        upsert=True)
+    build_collection = database[version_collection_name(collection_name)]
+    if seed:
+        existing_collections = database.list_collection_names()
+        if build_collection.name not in existing_collections and collection_name in existing_collections:
+            database[collection_name].aggregate([{'$match': {}}, {'$out': build_collection.name}])
+            copy_indexes(database[collection_name], build_collection)
+    return build_collection
+
+
+def get_read_collection(database, collection_name: str):
+    """
+    Get the collection a later stage should read a result of this run from: the collection of the current version
+    if it was already built, else the published collection.
+    :param database: database to read from
+    :param collection_name: name of the collection the frontend reads
+    :return: Collection
+    """
+    if VERSIONED_PUBLISHING and database.name == MONGODB_TO_DB:
+        build_collection_name = version_collection_name(collection_name)
+        if build_collection_name in database.list_collection_names():
+            return database[build_collection_name]
+    return database[collection_name]
+
+
+def copy_indexes(from_collection, to_collection):
+    """
+    Create the indexes of a collection, e.g. those the frontend queries with, on another collection.
+    :param from_collection: collection whose indexes are copied
+    :param to_collection: collection that gets the indexes
+    :return: None
+    """
+    for name, index in from_collection.index_information().items():
+        if name != '_id_':
+            to_collection.create_index(index['key'], name=name, unique=index.get('unique', False))
+
+
+def publish(database, version: str = None):
+    """
+    Publish all collections of a version. Each published collection is renamed to <collection>__previous and the
+    collection of the version is renamed into its place right after, so no documents are copied. The renames run
+    back to back, so the frontend switches to the new version at once. Collections that are published for the first
+    time are recorded, so rollback() can drop them again.
+    :param database: FLK_Web database
+    :param version: version to publish, defaults to the version of this run
+    :return: names of the published collections
+    """
+    version = version if version else PUBLISH_VERSION
+    versions = database[VERSIONS_COLLECTION]
+    build = versions.find_one({'_id': version})
+    if build is None or build['status'] != 'building':
+        raise ValueError("The version " + version + " is not being built")
+
+    existing_collections = database.list_collection_names()
+    collection_names = []
+    new_collection_names = []
+    for collection_name in build['collections']:
+        build_collection = database[version_collection_name(collection_name, version)]
+        if build_collection.name not in existing_collections:
+            print("The version " + version + " has no " + collection_name + ", the published one is kept")
+            continue
+        if collection_name in existing_collections:
+            copy_indexes(database[collection_name], build_collection)
+        else:
+            database[collection_name + PREVIOUS_SUFFIX].drop()
+            new_collection_names.append(collection_name)
+        collection_names.append(collection_name)
+
+    for collection_name in collection_names:
+        if collection_name not in new_collection_names:
+            database[collection_name].rename(collection_name + PREVIOUS_SUFFIX, dropTarget=True)
+        database[version_collection_name(collection_name, version)].rename(collection_name, dropTarget=True)
+    versions.update_one({'_id': version}, {'$set': {'status': 'published', 'published': datetime.now(timezone.utc),
+                                                    'published_collections': collection_names,
+                                                    'new_collections': new_collection_names}})
+    print("Published version " + version + ": " + ", ".join(collection_names))
+    discard_abandoned_builds(database)
+    return collection_names
+
+
+def rollback(database, version: str = None):
+    """
+    Restore the collections a published version replaced from <collection>__previous and drop the collections it
+    published for the first time.
+    :param database: FLK_Web database
+    :param version: published version to roll back, defaults to the latest published version
+    :return: names of the restored collections
+    """
+    versions = database[VERSIONS_COLLECTION]
+    if version:
+        published = versions.find_one({'_id': version, 'status': 'published'})
+    else:
+        published = versions.find_one({'status': 'published'}, sort=[('published', pm.DESCENDING)])
+    if published is None:
+        raise ValueError("There is no published version to roll back" + (", " + version + " is not published"
+                                                                          if version else ""))
+
+    new_collection_names = published.get('new_collections', [])
+    existing_collections = database.list_collection_names()
+    missing_collections = [collection_name for collection_name in published['published_collections']
+                           if collection_name not in new_collection_names and
+                           collection_name + PREVIOUS_SUFFIX not in existing_collections]
+    if missing_collections:
+        raise ValueError("The previous collections of " + ", ".join(missing_collections) + " no longer exist")
+    for collection_name in published['published_collections']:
+        if collection_name in new_collection_names:
+            database[collection_name].drop()
+        else:
+            database[collection_name + PREVIOUS_SUFFIX].rename(collection_name, dropTarget=True)
+    versions.update_one({'_id': published['_id']}, {'$set': {'status': 'rolled_back',
+                                                             'rolled_back': datetime.now(timezone.utc)}})
+    print("Rolled back version " + published['_id'] + ": " + ", ".join(published['published_collections']))
+    return published['published_collections']
+
+
+def discard_abandoned_builds(database):
+    """
+    Drop the collections of versions that were not published within ABANDON_AFTER_HOURS, e.g. because a stage failed.
+    :param database: FLK_Web database
+    :return: None
+    """
+    versions = database[VERSIONS_COLLECTION]
+    abandoned_before = datetime.now(timezone.utc) - timedelta(hours=ABANDON_AFTER_HOURS)
+    for build in versions.find({'status': 'building', 'created': {'$lt': abandoned_before}}):
+        for collection_name in build['collections']:
+            database[version_collection_name(collection_name, build['_id'])].drop()
+        versions.update_one({'_id': build['_id']}, {'$set': {'status': 'abandoned'}})
+        print("Discarded abandoned version " + build['_id'])
+
+
+def publish_after_run():
+    """
+    Publish the version of this run at the end of a pipeline, if versioned publishing is enabled. The version is
+    published on every MongoDB instance of writer_uris() it was built on.
+    :return: None
+    """
+    if not VERSIONED_PUBLISHING or not PUBLISH_AFTER_RUN:
+        return
+    for mongodb_uri in writer_uris():
+        mongo_client = pm.MongoClient(mongodb_uri)
+        web_database = mongo_client[MONGODB_TO_DB]
+        if web_database[VERSIONS_COLLECTION].find_one({'_id': PUBLISH_VERSION, 'status': 'building'}):
+            publish(web_database)
+        mongo_client.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Publish or roll back a version of the FLK_Web collections.')
+    parser.add_argument('action', choices=['publish', 'rollback', 'status'])
+    parser.add_argument('--version', help='version, defaults to PIPELINE_ENV_PUBLISH_VERSION for publish and to '
+                                          'the latest published version for rollback')
+    parser.add_argument('--uri', help='uri of the MongoDB instance, defaults to the instances the writers use')
+    arguments = parser.parse_args()
+    for mongodb_uri in [arguments.uri] if arguments.uri else writer_uris():
+        mongo_client = pm.MongoClient(mongodb_uri)
+        web_database = mongo_client[MONGODB_TO_DB]
+        try:
+            if arguments.action == 'publish':
+                publish(web_database, arguments.version)
+            elif arguments.action == 'rollback':
+                rollback(web_database, arguments.version)
+            else:
+                latest_versions = web_database[VERSIONS_COLLECTION].find().sort('created', pm.DESCENDING).limit(10)
+                for publish_version in latest_versions:
+                    print(publish_version['_id'] + ": " + publish_version['status'] + ", " +
+                          ", ".join(publish_version.get('collections', [])))
+        except ValueError as error:
+            print(error)
+        finally:
+            mongo_client.close()
@@ -1,5 +1,8 @@
 import pymongo as pm
 import os
+from web_export import DATA_LAKE_FIELDS, INCREMENTAL_SYNC, SERVER_SIDE_EXPORT, export_aggregation, not_deleted, \
+    sync_aggregation
+from web_publisher import get_build_collection
 
 class OrganisationPipeline:
     MONGODB_FROM_URI = os.getenv('PIPELINE_ENV_MONGODB_FROM_URI', "mongodb://localhost:27017/")
@@ -23,18 +26,33 @@ class OrganisationPipeline:
 
         # Get all organisation ids that should be exported
         organisation_ids = get_all_hierarchy_organisation_ids(organisation_id, self.MONGODB_FROM_URI, self.MONGODB_FROM_DB)
+        query = not_deleted({"id": {"$in": organisation_ids}})
+        pipeline = [{'$match': query}, {'$unset': DATA_LAKE_FIELDS}]
+        # With versioned publishing the organisations are written to the collection of the current version
+        mongo_client = pm.MongoClient(self.MONGODB_TO_URI)
+        to_collection = get_build_collection(mongo_client[self.MONGODB_TO_DB], 'organisations',
+                                             seed=INCREMENTAL_SYNC).name
+        mongo_client.close()
+        if INCREMENTAL_SYNC:
+            sync_aggregation(self.MONGODB_FROM_URI, self.MONGODB_FROM_DB, 'organisation', pipeline,
+                             self.MONGODB_TO_URI, self.MONGODB_TO_DB, to_collection)
+            return
+        if SERVER_SIDE_EXPORT:
+            export_aggregation(self.MONGODB_FROM_URI, self.MONGODB_FROM_DB, 'organisation', pipeline,
+                               self.MONGODB_TO_URI, self.MONGODB_TO_DB, to_collection)
+            return
 
         # Get all selected organisations from data lake
         mongo_client = pm.MongoClient(self.MONGODB_FROM_URI)
         from_db = mongo_client[self.MONGODB_FROM_DB]
         organisations = from_db['organisation']
-        organisations_to_export = list(organisations.find({"id": {"$in": organisation_ids}}))
+        organisations_to_export = list(organisations.find(query, {field: 0 for field in DATA_LAKE_FIELDS}))
         mongo_client.close()
 
         # Export organisations to web database
         mongo_client = pm.MongoClient(self.MONGODB_TO_URI)
         to_db = mongo_client[self.MONGODB_TO_DB]
-        organisations = to_db['organisations']
+        organisations = to_db[to_collection]
         organisations.delete_many({})
         organisations.insert_many(organisations_to_export)
         mongo_client.close()
@@ -48,15 +66,45 @@ def get_all_hierarchy_organisation_ids(organisation_id: int, mongodb_from_uri: s
     :param mongodb_from_db: Name of the data lake database.
     :return: List of hierarchy organisation ids for the given organisation.
     """
+    return list(get_hierarchy_organisation_depths(organisation_id, mongodb_from_uri, mongodb_from_db))
+
 
-    organisation_ids = []
-    # Get all organisation ids that should be exported
+def get_hierarchy_organisation_depths(organisation_id: int, mongodb_from_uri: str, mongodb_from_db: str):
+    """
+    Get all organisations below an organisation with their depth in one $graphLookup on the data lake.
+    :param organisation_id: Organisation ID that is the head of the organisation hierarchy.
+    :param mongodb_from_uri: URI of the data lake database server.
+    :param mongodb_from_db: Name of the data lake database.
+    :return: Dict of the depth of every organisation below the given organisation by id, its children have depth 1,
+             ordered by depth.
+    """
     mongo_client = pm.MongoClient(mongodb_from_uri)
     from_db = mongo_client[mongodb_from_db]
-    organisations_hierarchy = from_db['organisation_organisation']
-    for child_id in organisations_hierarchy.find({"organisation_id": str(organisation_id)}):
-        child_id = child_id['child_organisation_id']
-        organisation_ids.append(child_id)
-        organisation_ids.extend(get_all_hierarchy_organisation_ids(child_id, mongodb_from_uri, mongodb_from_db))
+    hierarchy = list(from_db['organisation_organisation'].aggregate([
+        {
+            '$match': {'organisation_id': str(organisation_id)}
+        }, {
+            '$group': {'_id': '$organisation_id'}
+        }, {
+            '$graphLookup': {
+                'from': 'organisation_organisation',
+                'startWith': '$_id',
+                'connectFromField': 'child_organisation_id',
+                'connectToField': 'organisation_id',
+                'as': 'edges',
+                'depthField': 'depth'
+            }
+        }, {
+            '$project': {'edges.child_organisation_id': 1, 'edges.depth': 1}
+        }
+    ]))
     mongo_client.close()
-    return organisation_ids
+
+    # An edge found at depth 0 leads from the head to a child, an organisation below several parents keeps its
+    # shortest depth
+    depths = {}
+    for edge in (hierarchy[0]['edges'] if hierarchy else []):
+        child_id = edge['child_organisation_id']
+        if child_id != str(organisation_id):
+            depths[child_id] = min(depths.get(child_id, edge['depth'] + 1), edge['depth'] + 1)
+    return dict(sorted(depths.items(), key=lambda item: item[1]))
@@ -1,5 +1,9 @@
 import pymongo as pm
 import os
+from organisation_pipeline import get_all_hierarchy_organisation_ids
+from web_export import DATA_LAKE_FIELDS, INCREMENTAL_SYNC, SERVER_SIDE_EXPORT, export_aggregation, not_deleted, \
+    sync_aggregation
+from web_publisher import get_build_collection
 
 class PersonPipeline:
     MONGODB_FROM_URI = os.getenv('PIPELINE_ENV_MONGODB_FROM_URI', "mongodb://localhost:27017/")
@@ -16,13 +20,42 @@ class PersonPipeline:
 
     def export_persons(self, organisation_id: int):
         """
-        Exports all persons of a given organisation to the Web database.
+        Exports all persons of a given organisation and the organisations below it that have publications to the
+        Web database.
         :param organisation_id: The organisation id of the organisation to export the persons from.
         :return:
         """
-        persons = self.add_publications_to_persons()
+        organisation_ids = [str(organisation_id)] + get_all_hierarchy_organisation_ids(
+            organisation_id, self.MONGODB_FROM_URI, self.MONGODB_FROM_DB)
+        person_ids = self.get_person_ids_of_hierarchy(organisation_ids)
+        # With versioned publishing the persons are written to the collection of the current version
+        client = pm.MongoClient(self.MONGODB_TO_URI)
+        to_collection = get_build_collection(client[self.MONGODB_TO_DB], 'persons', seed=INCREMENTAL_SYNC).name
+        client.close()
+        if INCREMENTAL_SYNC:
+            sync_aggregation(self.MONGODB_FROM_URI, self.MONGODB_FROM_DB, 'person',
+                             self.make_person_aggregation(person_ids, sort_publications=True),
+                             self.MONGODB_TO_URI, self.MONGODB_TO_DB, to_collection)
+            return
+        if SERVER_SIDE_EXPORT:
+            export_aggregation(self.MONGODB_FROM_URI, self.MONGODB_FROM_DB, 'person',
+                               self.make_person_aggregation(person_ids, sort_publications=True),
+                               self.MONGODB_TO_URI, self.MONGODB_TO_DB, to_collection)
+            return
+        persons = self.add_publications_to_persons(person_ids)
         self.export_persons_to_mongodb(persons)
-        self.remove_persons_without_publications()
+
+    def get_person_ids_of_hierarchy(self, organisation_ids: list):
+        """
+        Gets the ids of all members of the given organisations.
+        :param organisation_ids: organisation ids to which the persons belong.
+        :return: list of person ids
+        """
+        client = pm.MongoClient(self.MONGODB_FROM_URI)
+        db = client[self.MONGODB_FROM_DB]
+        person_ids = db["organisation_persons"].distinct("person_id", {"organisation_id": {"$in": organisation_ids}})
+        client.close()
+        return person_ids
 
     def get_all_persons_of_hierarchy(self, organisation_ids: list):
         """
@@ -51,22 +84,55 @@ class PersonPipeline:
         client = pm.MongoClient(self.MONGODB_TO_URI)
         db = client[self.MONGODB_TO_DB]
         # Export persons
-        db["persons"].delete_many({})
-        db["persons"].insert_many(persons)
+        collection = get_build_collection(db, "persons")
+        collection.delete_many({})
+        if persons:
+            collection.insert_many(persons)
         # Close connection
         client.close()
 
-    def add_publications_to_persons(self):
+    def add_publications_to_persons(self, person_ids: list):
         """
-        Adds the publications to the persons.
-        :return:
+        Adds the publications to the given persons. Persons without publications are left out.
+        :param person_ids: ids of the persons.
+        :return: list of persons with their publications
         """
         # Connect to MongoDB
-        client = pm.MongoClient(self.MONGODB_TO_URI)
+        client = pm.MongoClient(self.MONGODB_FROM_URI)
         db = client[self.MONGODB_FROM_DB]
-        # Add publications to persons
-        persons = list(db["person"].aggregate([
+        # Add publications to persons, only the persons of the hierarchy are looked up
+        persons = list(db["person"].aggregate(self.make_person_aggregation(person_ids)))
+        client.close()
+
+        # Sort publications by year
+        for person in persons:
+            if "publicationList" in person and len(person["publicationList"]) > 0:
+                person["publicationList"].sort(key=lambda x: x["publYear"], reverse=True)
+        return persons
+
+    def make_person_aggregation(self, person_ids: list, sort_publications: bool = False):
+        """
+        Creates the aggregation that adds the publications to the given persons and leaves out persons without
+        publications.
+        :param person_ids: ids of the persons.
+        :param sort_publications: sort the publications of each person by year and id on the server, which
+                                  needs MongoDB 5.0.
+        :return: stages of the aggregation
+        """
+        publication_lookup = {
+            'from': 'publication_filled',
+            'localField': 'publicationList.publication_id',
+            'foreignField': 'id',
+            'as': 'publicationList'
+        }
+        if sort_publications:
+            publication_lookup['pipeline'] = [{'$sort': {'publYear': -1, 'id': 1}}]
+        return [
             {
+                '$match': not_deleted({'id': {'$in': person_ids}})
+            }, {
+                '$unset': DATA_LAKE_FIELDS
+            }, {
                 '$lookup': {
                     'from': 'person_publications',
                     'localField': 'id',
@@ -76,30 +142,8 @@ class PersonPipeline:
             }, {
                 '$unset': 'publicationList.person_id'
             }, {
-                '$lookup': {
-                    'from': 'publication_filled',
-                    'localField': 'publicationList.publication_id',
-                    'foreignField': 'id',
-                    'as': 'publicationList'
-                }
+                '$lookup': publication_lookup
+            }, {
+                '$match': {'publicationList': {'$ne': []}}
             }
-        ]))
-        client.close()
-
-        # Sort publications by year
-        for person in persons:
-            if "publicationList" in person and len(person["publicationList"]) > 0:
-                person["publicationList"].sort(key=lambda x: x["publYear"], reverse=True)
-        return persons
-
-    def remove_persons_without_publications(self):
-        """
-        Removes all persons without publications.
-        :return:
-        """
-        # Connect to MongoDB
-        client = pm.MongoClient(self.MONGODB_TO_URI)
-        db = client[self.MONGODB_TO_DB]
-        # Remove persons without publications
-        db["persons"].delete_many({"publicationList": []})
-        client.close()
+        ]
@@ -0,0 +1,143 @@
+import hashlib
+import json
+import pymongo as pm
+import os
+
+SERVER_SIDE_EXPORT = os.getenv('PIPELINE_ENV_SERVER_SIDE_EXPORT', 'false').lower() == 'true'
+INCREMENTAL_SYNC = os.getenv('PIPELINE_ENV_INCREMENTAL_SYNC', 'false').lower() == 'true'
+EXPORT_BATCH_SIZE = int(os.getenv('PIPELINE_ENV_EXPORT_BATCH_SIZE', 1000))
+# Fields the incremental CRIS export keeps in the Data Lake, the frontend does not need them
+DATA_LAKE_FIELDS = ['content_hash', 'deleted']
+
+
+def not_deleted(query: dict = None):
+    """
+    Extend a query of a Data Lake collection to skip the documents the incremental CRIS export marked as deleted.
+    :param query: query of the collection
+    :return: query without deleted documents
+    """
+    return dict(query if query else {}, deleted={'$ne': True})
+
+
+def export_aggregation(mongodb_from_uri: str, mongodb_from_db: str, from_collection: str, pipeline: list,
+                       mongodb_to_uri: str, mongodb_to_db: str, to_collection: str, batch_size: int = None):
+    """
+    Replace a collection of the web database with the result of an aggregation on the data lake without loading
+    the result into memory.
+    If both databases are on the same server, the aggregation writes its result with $out. Otherwise the result is
+    streamed in batches into a staging collection, which then replaces the collection. In both cases readers see
+    the old collection until the new one is complete.
+    :param mongodb_from_uri: URI of the data lake database server.
+    :param mongodb_from_db: Name of the data lake database.
+    :param from_collection: Collection the aggregation runs on.
+    :param pipeline: Stages of the aggregation.
+    :param mongodb_to_uri: URI of the web database server.
+    :param mongodb_to_db: Name of the web database.
+    :param to_collection: Collection that is replaced.
+    :param batch_size: Number of documents per batch of the streaming copy.
+    :return: None
+    """
+    batch_size = batch_size if batch_size else EXPORT_BATCH_SIZE
+    from_client = pm.MongoClient(mongodb_from_uri)
+    from_db = from_client[mongodb_from_db]
+    if mongodb_from_uri == mongodb_to_uri:
+        from_db[from_collection].aggregate(pipeline + [{'$out': {'db': mongodb_to_db, 'coll': to_collection}}],
+                                           allowDiskUse=True)
+        from_client.close()
+        print("Exported " + to_collection + " with $out")
+        return
+
+    to_client = pm.MongoClient(mongodb_to_uri)
+    to_db = to_client[mongodb_to_db]
+    staging_collection = to_db[to_collection + '_staging']
+    staging_collection.drop()
+    documents = 0
+    batch = []
+    for document in from_db[from_collection].aggregate(pipeline, allowDiskUse=True, batchSize=batch_size):
+        batch.append(document)
+        if len(batch) >= batch_size:
+            staging_collection.insert_many(batch, ordered=False)
+            documents += len(batch)
+            batch = []
+    if batch:
+        staging_collection.insert_many(batch, ordered=False)
+        documents += len(batch)
+    if documents:
+        # keep the indexes of the collection, e.g. those the frontend queries with
+        for name, index in to_db[to_collection].index_information().items():
+            if name != '_id_':
+                staging_collection.create_index(index['key'], name=name, unique=index.get('unique', False))
+        staging_collection.rename(to_collection, dropTarget=True)
+    else:
+        to_db[to_collection].delete_many({})
+    from_client.close()
+    to_client.close()
+    print("Exported " + str(documents) + " documents to " + to_collection)
+
+
+def content_hash(document: dict):
+    """
+    Hash the content of a document independent of the order of its keys.
+    :param document: document without _id and content_hash
+    :return: sha256 hex digest
+    """
+    content = json.dumps(document, sort_keys=True, default=str, ensure_ascii=False)
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+def sync_aggregation(mongodb_from_uri: str, mongodb_from_db: str, from_collection: str, pipeline: list,
+                     mongodb_to_uri: str, mongodb_to_db: str, to_collection: str, batch_size: int = None):
+    """
+    Synchronise a collection of the web database with the result of an aggregation on the data lake.
+    Every document of the web database carries a hash of its content. Only new and changed documents are
+    upserted and documents that are no longer in the result are deleted, so a run without changes writes nothing
+    and readers never see an empty collection. Documents are matched by their id.
+    :param mongodb_from_uri: URI of the data lake database server.
+    :param mongodb_from_db: Name of the data lake database.
+    :param from_collection: Collection the aggregation runs on.
+    :param pipeline: Stages of the aggregation, its result must be in a deterministic order within each document.
+    :param mongodb_to_uri: URI of the web database server.
+    :param mongodb_to_db: Name of the web database.
+    :param to_collection: Collection that is synchronised.
+    :param batch_size: Number of requests per bulk write.
+    :return: number of upserted and deleted documents
+    """
+    batch_size = batch_size if batch_size else EXPORT_BATCH_SIZE
+    to_client = pm.MongoClient(mongodb_to_uri)
+    collection = to_client[mongodb_to_db][to_collection]
+    stored_hashes = {document['id']: document.get('content_hash')
+                     for document in collection.find({}, {'id': 1, 'content_hash': 1, '_id': 0})}
+    if stored_hashes:
+        collection.create_index('id')
+
+    from_client = pm.MongoClient(mongodb_from_uri)
+    upserted = 0
+    requests = []
+    seen_ids = set()
+    for document in from_client[mongodb_from_db][from_collection].aggregate(pipeline, allowDiskUse=True,
+                                                                             batchSize=batch_size):
+        document.pop('_id', None)  # the data lake ids change when a collection is reloaded
+        document.pop('content_hash', None)
+        seen_ids.add(document['id'])
+        document['content_hash'] = content_hash(document)
+        if stored_hashes.get(document['id']) == document['content_hash']:
+            continue
+        requests.append(pm.ReplaceOne({'id': document['id']}, document, upsert=True))
+        if len(requests) >= batch_size:
+            collection.bulk_write(requests, ordered=False)
+            upserted += len(requests)
+            requests = []
+    if requests:
+        collection.bulk_write(requests, ordered=False)
+        upserted += len(requests)
+    from_client.close()
+
+    deleted_ids = [document_id for document_id in stored_hashes if document_id not in seen_ids]
+    for start in range(0, len(deleted_ids), batch_size):
+        collection.delete_many({'id': {'$in': deleted_ids[start:start + batch_size]}})
+    if not stored_hashes and upserted:
+        collection.create_index('id')
+    to_client.close()
+    print("Synchronised " + to_collection + ": " + str(upserted) + " upserted, " + str(len(deleted_ids)) +
+          " deleted, " + str(len(seen_ids) - upserted) + " unchanged")
+    return upserted, len(deleted_ids)
@@ -1,5 +1,6 @@
 from organisation_pipeline import OrganisationPipeline
 from person_pipeline import PersonPipeline
+from web_publisher import publish_after_run
 import os
 
 MONGODB_FROM_URI = os.getenv('PIPELINE_ENV_MONGODB_FROM_URI', "mongodb://localhost:27017/")
@@ -11,4 +12,6 @@ organisation_pipeline = OrganisationPipeline(mongodb_from_uri=MONGODB_FROM_URI,
 organisation_pipeline.export_organisations(organisation_id=31923392)
 
 person_pipeline = PersonPipeline(mongodb_from_uri=MONGODB_FROM_URI, mongodb_from_database=MONGODB_FROM_DB, mongodb_to_uri=MONGODB_TO_URI, mongodb_to_database=MONGODB_TO_DB)
-person_pipeline.export_persons(organisation_id=31923392)
\ No newline at end of file
+person_pipeline.export_persons(organisation_id=31923392)
+
+publish_after_run()